@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import aiohttp
+
+import loadtest
+
+"""
+Compare one POST /forecast/batch against the same forecasts as individual /forecast calls.
+
+Both are run cold (every coordinate misses the cache) and warm (every coordinate is cached) on a
+fresh server against the stub upstream. Prints one json result per server.
+"""
+
+async def singles(port, source, coordinates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def one(latitude, longitude):
+            async with semaphore:
+                async with session.get(f"http://127.0.0.1:{port}/forecast/{latitude}/{longitude}", params={"source": source, "apikey": "bench"}) as r:
+                    await r.read()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one(*c) for c in coordinates])
+        return time.perf_counter() - started
+
+async def batched(port, source, coordinates):
+    body = {
+        "coordinates": coordinates,
+        "sources": [source],
+        "parameters": {"apikey": "bench"},
+    }
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        async with session.post(f"http://127.0.0.1:{port}/forecast/batch", json=body) as r:
+            lines = 0
+            async for _ in r.content:
+                lines += 1
+        elapsed = time.perf_counter() - started
+    if lines != len(coordinates):
+        raise RuntimeError(f"expected {len(coordinates)} results, got {lines}")
+    return elapsed
+
+async def compare(port, source, count, concurrency):
+    # separate coordinates for each so neither warms the cache for the other
+    single = [loadtest.coordinate(i) for i in range(count)]
+    batch = [loadtest.coordinate(i) for i in range(count, 2*count)]
+    result = {}
+    for state in ["cold", "warm"]:
+        result[f"{state}_single_seconds"] = round(await singles(port, source, single, concurrency), 3)
+        result[f"{state}_batch_seconds"] = round(await batched(port, source, batch), 3)
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the batch endpoint against individual forecast calls.")
+    parser.add_argument("--server", choices=list(loadtest.SERVERS) + ["all"], default="all")
+    parser.add_argument("--source", type=str, default="openweathermap")
+    parser.add_argument("--coordinates", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, help="concurrent individual calls", default=16)
+    parser.add_argument("--latency", type=int, help="stub upstream latency in milliseconds", default=100)
+
+    args = parser.parse_args()
+
+    stub_port = loadtest.free_port()
+    stub = loadtest.start(os.path.join(loadtest.BENCH_DIR, "stubserver.py"), "--port", str(stub_port), "--latency", str(args.latency))
+    try:
+        loadtest.wait_for_port(stub_port)
+        for name in loadtest.SERVERS if args.server == "all" else [args.server]:
+            with tempfile.TemporaryDirectory() as directory:
+                port = loadtest.free_port()
+                # batch concurrency matches the individual calls so only the per-call overhead differs
+                config = loadtest.write_config(directory, f"http://127.0.0.1:{stub_port}", port, {"batch": {"concurrency": args.concurrency}})
+                service = loadtest.start(os.path.join(loadtest.PY_DIR, loadtest.SERVERS[name]), "--config", config)
+                try:
+                    loadtest.wait_for_port(port)
+                    result = asyncio.run(compare(port, args.source, args.coordinates, args.concurrency))
+                    print(json.dumps({"server": name, "source": args.source, "coordinates": args.coordinates, "concurrency": args.concurrency, "upstream_latency_ms": args.latency, **result}))
+                finally:
+                    service.terminate()
+                    service.wait()
+    finally:
+        stub.terminate()
+        stub.wait()
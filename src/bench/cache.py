@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import fixtures
+import weathergov
+import openweathermap
+
+"""
+Cost of Weather.get_forecast on each cache path, with upstream answered instantly from fixtures
+so only the service's own work is timed.
+
+    hit     fresh forecast in cache
+    stale   past ttl, served from cache while a background refresh is started
+    miss    new location, fetched (from the fixture), parsed, validated and cached
+
+weather.gov misses still share the parsed grid cell between nearby locations, as they do live.
+"""
+
+class Response:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = {}
+
+    def json(self):
+        return self.data
+
+def canned(source, payloads):
+    # answer every upstream url from fixtures instead of the network
+    def http_get(url):
+        if "/points/" in url:
+            latitude, longitude = url.rsplit("/", 1)[1].split(",")
+            return Response(fixtures.weathergov_points(source.api_base, latitude, longitude))
+        if "/gridpoints/" in url:
+            return Response(payloads["weathergov_gridpoint"])
+        return Response(payloads["openweathermap_onecall"])
+    source.http_get = http_get
+
+def coordinate(i):
+    return f"{20 + (i % 1000) * 0.01:.2f}", f"{-60 - (i // 1000) * 0.01:.2f}"
+
+def per_request(fn, number):
+    started = time.perf_counter()
+    for i in range(number):
+        fn(i)
+    return (time.perf_counter() - started) / number
+
+def run(source, number, config):
+    parameters = {"apikey": "bench"}
+    results = {}
+
+    source.cache.configure(config.get("cache", {}))
+    source.get_forecast(*coordinate(0), parameters)
+    results["hit"] = per_request(lambda i: source.get_forecast(*coordinate(0), parameters), number * 10)
+
+    # every cached forecast is stale from here on, refreshes run in the background
+    source.cache.configure({**config.get("cache", {}), "ttl": 0, "hard_ttl": 3600})
+    results["stale"] = per_request(lambda i: source.get_forecast(*coordinate(0), parameters), number * 10)
+
+    source.cache.configure(config.get("cache", {}))
+    results["miss"] = per_request(lambda i: source.get_forecast(*coordinate(i + 1), parameters), number)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the forecast cache hit, stale and miss paths.")
+    parser.add_argument("--number", type=int, default=500)
+    parser.add_argument("--fixtures", type=str, help="directory of recorded payloads, see fixtures.py")
+
+    args = parser.parse_args()
+
+    payloads = {name: fixtures.load(name, args.fixtures)[0] for name in fixtures.PATTERNS}
+    with tempfile.TemporaryDirectory() as directory:
+        config = {
+            "cache": {"max_entries": args.number * 2},
+            "weathergov": {"grid_index": {"path": os.path.join(directory, "grid-index.json")}},
+        }
+        for name, source in [("weathergov", weathergov.WeatherGov()), ("openweathermap", openweathermap.OpenWeatherMap())]:
+            source.configure(config)
+            canned(source, payloads)
+            results = run(source, args.number, config)
+            for path, seconds in results.items():
+                print(json.dumps({
+                    "source": name,
+                    "path": path,
+                    "us_per_request": round(seconds * 1e6, 2),
+                    "requests_per_second": round(1 / seconds, 1),
+                }))
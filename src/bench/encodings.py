@@ -0,0 +1,78 @@
+import io
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import fixtures
+import formats
+import weathergov
+import openweathermap
+from forecast import Forecast
+
+"""
+Size and consumer decode time of a forecast in each output format (see formats.py): bytes on the
+wire raw and gzipped, and how long a client takes to turn the body back into values per hour,
+json.loads against msgpack.unpackb, csv.reader and an Arrow IPC read. Formats whose package isn't
+installed are skipped.
+"""
+
+def decode_json(body):
+    return json.loads(body)
+
+def decode_msgpack(body):
+    return formats.msgpack.unpackb(body)
+
+def decode_csv(body):
+    return list(csv.reader(io.StringIO(body.decode())))
+
+def decode_arrow(body):
+    return formats.pyarrow.ipc.open_stream(body).read_all()
+
+DECODERS = {
+    formats.JSON: decode_json,
+    formats.MSGPACK: decode_msgpack,
+    formats.CSV: decode_csv,
+    formats.ARROW: decode_arrow,
+}
+
+def best_of(fn, data, repeat, number):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(data)
+        elapsed = (time.perf_counter() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark forecast size and decode time per output format.")
+    parser.add_argument("--fixtures", type=str, help="directory of recorded payloads, see fixtures.py")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=100)
+
+    args = parser.parse_args()
+
+    gridpoint = fixtures.load("weathergov_gridpoint", args.fixtures)[0]
+    onecall = fixtures.load("openweathermap_onecall", args.fixtures)[0]
+    forecasts = {
+        "weathergov": Forecast({"source": "weather.gov"}, {"success": "true"}, weathergov.WeatherGov().parse_gridpoint(gridpoint)),
+        "openweathermap": Forecast({"source": "openweathermap"}, {"success": "true"}, openweathermap.OpenWeatherMap().parse_onecall(onecall)),
+    }
+    for name, f in forecasts.items():
+        for fmt in formats.available():
+            body = f.encode(None, fmt)
+            print(json.dumps({
+                "source": name,
+                "format": fmt,
+                "hours": len(f.hourly),
+                "bytes": len(body),
+                "gzip_bytes": len(gzip.compress(body)),
+                "decode_ms": round(best_of(DECODERS[fmt], body, args.repeat, args.number) * 1000, 3),
+            }))
@@ -0,0 +1,169 @@
+import os
+import glob
+import json
+import random
+import argparse
+import datetime
+import urllib.request
+
+"""
+Upstream payloads for benchmarks, shaped like api.weather.gov and openweathermap responses.
+
+Generated deterministically so runs are comparable, or replayed from payloads recorded from the
+real upstreams into a directory:
+
+    python fixtures.py --record recorded --latitude 42.36 --longitude -71.06 --apikey KEY
+    python stubserver.py --fixtures recorded
+
+A directory holds any number of weathergov-gridpoint*.json and openweathermap-onecall*.json, the
+stub spreads requests over them. --generate writes the generated payloads in the same layout.
+"""
+
+# fixture name -> file name pattern in a fixtures directory
+PATTERNS = {
+    "weathergov_gridpoint": "weathergov-gridpoint*.json",
+    "openweathermap_onecall": "openweathermap-onecall*.json",
+}
+
+START = datetime.datetime(2024, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)
+
+WEATHERGOV_FIELDS = {
+    "temperature": "wmoUnit:degC",
+    "apparentTemperature": "wmoUnit:degC",
+    "dewpoint": "wmoUnit:degC",
+    "relativeHumidity": "wmoUnit:percent",
+    "skyCover": "wmoUnit:percent",
+    "windDirection": "wmoUnit:degree_(angle)",
+    "windSpeed": "wmoUnit:km_h-1",
+    "windGust": "wmoUnit:km_h-1",
+    "probabilityOfPrecipitation": "wmoUnit:percent",
+    "quantitativePrecipitation": "wmoUnit:mm",
+    "pressure": "wmoUnit:Hg",
+    "visibility": "wmoUnit:m",
+    "weather": None,
+    # not used by the service, present upstream
+    "hazards": None,
+    "snowfallAmount": "wmoUnit:mm",
+}
+
+def grid(latitude, longitude):
+    # spread points over grid cells the way upstream does, roughly 2.5km per cell
+    return int(float(latitude) * 40) % 1000, int(float(longitude) * 40) % 1000
+
+def weathergov_points(api_base, latitude, longitude):
+    x, y = grid(latitude, longitude)
+    return {
+        "properties": {
+            "gridId": "BOX",
+            "gridX": x,
+            "gridY": y,
+            "forecastGridData": f"{api_base}/gridpoints/BOX/{x},{y}",
+        }
+    }
+
+def weathergov_gridpoint(hours=7*24, seed=1):
+    r = random.Random(seed)
+    properties = {
+        "updateTime": START.isoformat(),
+    }
+    for field, uom in WEATHERGOV_FIELDS.items():
+        values = []
+        h = 0
+        while h < hours:
+            # upstream collapses runs of equal values into one interval
+            duration = min(r.choice([1, 1, 1, 2, 3, 6]), hours - h)
+            validTime = (START + datetime.timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+            if field == "weather":
+                value = [
+                    {"coverage": "chance", "weather": "rain_showers", "intensity": None},
+                    {"coverage": None, "weather": "snow", "intensity": "light"},
+                ] if r.random() < 0.5 else [{"coverage": None, "weather": None, "intensity": None}]
+            elif field == "pressure":
+                value = round(r.uniform(29.5, 30.5), 2)
+            elif field == "windGust" and r.random() < 0.1:
+                value = None
+            else:
+                value = round(r.uniform(0, 30), 2)
+            values.append({"validTime": f"{validTime}/PT{duration}H", "value": value})
+            h += duration
+        properties[field] = {"values": values}
+        if uom is not None:
+            properties[field]["uom"] = uom
+    return {"properties": properties}
+
+def openweathermap_onecall(hours=48, seed=1):
+    r = random.Random(seed)
+    hourly = []
+    for i in range(hours):
+        data = {
+            "dt": int(START.timestamp()) + i*3600,
+            "temp": round(r.uniform(-5, 30), 2),
+            "feels_like": round(r.uniform(-5, 30), 2),
+            "dew_point": round(r.uniform(-10, 20), 2),
+            "humidity": r.randint(10, 100),
+            "clouds": r.randint(0, 100),
+            "wind_deg": r.randint(0, 359),
+            "wind_speed": round(r.uniform(0, 15), 2),
+            "wind_gust": round(r.uniform(0, 25), 2),
+            "pop": round(r.random(), 2),
+            "pressure": r.randint(990, 1030),
+            "visibility": 10000,
+            "weather": [{"description": r.choice(["clear sky", "light rain", "overcast clouds"])}],
+        }
+        if i % 3 == 0:
+            data["rain"] = {"1h": round(r.uniform(0, 2), 2)}
+        hourly.append(data)
+    return {"hourly": hourly}
+
+def generated(name):
+    return {
+        "weathergov_gridpoint": weathergov_gridpoint,
+        "openweathermap_onecall": openweathermap_onecall,
+    }[name]()
+
+def load(name, directory=None):
+    # list of payloads for a fixture, the recorded ones in directory if it has any else the generated one
+    if directory is not None:
+        payloads = []
+        for filename in sorted(glob.glob(os.path.join(directory, PATTERNS[name]))):
+            with open(filename, 'r') as f:
+                payloads.append(json.load(f))
+        if len(payloads) > 0:
+            return payloads
+    return [generated(name)]
+
+def fetch_json(url):
+    # weather.gov refuses requests without a User-Agent
+    request = urllib.request.Request(url, headers={"User-Agent": "weather-service-bench", "Accept": "application/geo+json"})
+    with urllib.request.urlopen(request, timeout=30) as r:
+        return json.load(r)
+
+def write(directory, filename, data):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, filename), 'w') as f:
+        json.dump(data, f)
+    print(f"wrote {os.path.join(directory, filename)}")
+
+def record(directory, latitude, longitude, apikey=None):
+    points = fetch_json(f"https://api.weather.gov/points/{latitude},{longitude}")
+    write(directory, f"weathergov-gridpoint-{latitude},{longitude}.json", fetch_json(points["properties"]["forecastGridData"]))
+    if apikey is not None:
+        onecall = fetch_json(f"https://api.openweathermap.org/data/3.0/onecall?appid={apikey}&lat={latitude}&lon={longitude}&exclude=minutely,daily,current&units=metric")
+        write(directory, f"openweathermap-onecall-{latitude},{longitude}.json", onecall)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record upstream payloads for the benchmarks, or write the generated ones.")
+    parser.add_argument("--record", type=str, help="directory to record live upstream payloads into")
+    parser.add_argument("--generate", type=str, help="directory to write the generated payloads into")
+    parser.add_argument("--latitude", type=float, action="append", help="may be repeated, paired with --longitude")
+    parser.add_argument("--longitude", type=float, action="append")
+    parser.add_argument("--apikey", type=str, help="openweathermap apikey, without it only weather.gov is recorded")
+
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        write(args.generate, "weathergov-gridpoint-generated.json", weathergov_gridpoint())
+        write(args.generate, "openweathermap-onecall-generated.json", openweathermap_onecall())
+    if args.record is not None:
+        for latitude, longitude in zip(args.latitude or [42.36], args.longitude or [-71.06]):
+            record(args.record, latitude, longitude, args.apikey)
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import aiohttp
+import yaml
+
+"""
+Load test the Flask and ASGI servers against the stub upstream.
+
+Every request uses a new coordinate so it misses the cache and waits on the stub, which shows
+how many concurrent upstream waits each server can hold. With --distinct N requests cycle over
+N coordinates, so all but the first N are cache hits. Faults injected into the stub (see
+stubserver.py) show up as errors. Prints one json result per server.
+"""
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PY_DIR = os.path.join(BENCH_DIR, "..", "py")
+
+SERVERS = {
+    "flask": "server.py",
+    "asgi": "asgi.py",
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"nothing listening on port {port}")
+
+def write_config(directory, stub_base, port, extra={}):
+    config = {
+        "sources": ["openweathermap", "weathergov"],
+        "metrics": {"port": free_port()},
+        "service": {"host": "127.0.0.1", "port": port},
+        "http": {"pool_maxsize": 1000, "retries": 0},
+        "weathergov": {
+            "api_base": stub_base,
+            "grid_index": {"path": os.path.join(directory, "grid-index.json")},
+        },
+        "openweathermap": {"api_base": stub_base},
+    }
+    config.update(extra)
+    filename = os.path.join(directory, "config.yaml")
+    with open(filename, 'w') as f:
+        yaml.safe_dump(config, f)
+    return filename
+
+def start(script, *args):
+    return subprocess.Popen(
+        [sys.executable, script, *args],
+        cwd=os.path.dirname(script),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def coordinate(i, distinct=None):
+    # distinct grid cell per request so weather.gov misses every cache tier
+    if distinct is not None:
+        i = i % distinct
+    return f"{20 + (i % 1000) * 0.03:.2f}", f"{-60 - (i // 1000) * 0.03:.2f}"
+
+def add_stub_arguments(parser):
+    parser.add_argument("--latency", type=int, help="stub upstream latency in milliseconds", default=100)
+    parser.add_argument("--jitter", type=int, help="stub upstream latency varies by this either way", default=0)
+    parser.add_argument("--fixtures", type=str, help="directory of recorded payloads for the stub")
+    parser.add_argument("--error-rate", type=float, help="fraction of upstream forecast calls that fail", default=0)
+    parser.add_argument("--timeout-rate", type=float, help="fraction of upstream forecast calls that hang", default=0)
+
+def start_stub(args, port):
+    stub_args = ["--port", str(port), "--latency", str(args.latency), "--jitter", str(args.jitter)]
+    stub_args += ["--error-rate", str(args.error_rate), "--timeout-rate", str(args.timeout_rate)]
+    if args.fixtures is not None:
+        stub_args += ["--fixtures", os.path.abspath(args.fixtures)]
+    return start(os.path.join(BENCH_DIR, "stubserver.py"), *stub_args)
+
+async def run_load(port, source, requests, concurrency, parameters={}, distinct=None):
+    latencies = []
+    errors = 0
+    # answered 200 with the upstream failure in the status, i.e. injected stub errors
+    unsuccessful = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    params = {"source": source, **parameters}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def one(i):
+            nonlocal errors, unsuccessful
+            latitude, longitude = coordinate(i, distinct)
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.get(f"http://127.0.0.1:{port}/forecast/{latitude}/{longitude}", params=params) as r:
+                        body = await r.read()
+                        if r.status != 200:
+                            errors += 1
+                        elif b'"success": "false"' in body:
+                            unsuccessful += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "unsuccessful": unsuccessful,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the forecast servers against a stub upstream.")
+    parser.add_argument("--server", choices=list(SERVERS) + ["all"], default="all")
+    parser.add_argument("--source", type=str, default="weathergov")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--distinct", type=int, help="coordinates to cycle over, default a new one per request")
+    add_stub_arguments(parser)
+
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = start_stub(args, stub_port)
+    try:
+        wait_for_port(stub_port)
+        for name in SERVERS if args.server == "all" else [args.server]:
+            with tempfile.TemporaryDirectory() as directory:
+                port = free_port()
+                config = write_config(directory, f"http://127.0.0.1:{stub_port}", port)
+                service = start(os.path.join(PY_DIR, SERVERS[name]), "--config", config)
+                try:
+                    wait_for_port(port)
+                    result = asyncio.run(run_load(port, args.source, args.requests, args.concurrency, {"apikey": "bench"}, args.distinct))
+                    print(json.dumps({
+                        "server": name,
+                        "source": args.source,
+                        "distinct": args.distinct or args.requests,
+                        "upstream_latency_ms": args.latency,
+                        "upstream_error_rate": args.error_rate,
+                        **result,
+                    }))
+                finally:
+                    service.terminate()
+                    service.wait()
+    finally:
+        stub.terminate()
+        stub.wait()
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import fixtures
+import weathergov
+import openweathermap
+from forecast import Forecast
+
+"""
+Memory per cached location: the nested dict forecasts used to be cached as, against Forecast.
+
+Each location gets its own parsed copy, as if no two locations shared a weather.gov grid cell.
+"""
+
+class Response:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = {}
+
+    def json(self):
+        return self.data
+
+def fetch(source, data, i):
+    # drive the source's fetch_forecast with a canned response for every url it asks for
+    steps = source.fetch_forecast(f"{i / 100:.2f}", "0.00", {"apikey": "bench"})
+    try:
+        next(steps)
+        while True:
+            steps.send(Response(data))
+    except StopIteration as s:
+        return s.value
+
+def measure(build, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(kept)
+
+def dict_form(forecast):
+    # a fresh nested dict per forecast, the way they were held before
+    return json.loads(json.dumps(forecast.to_dict()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark memory per cached forecast.")
+    parser.add_argument("--locations", type=int, default=200)
+    parser.add_argument("--fixtures", type=str, help="directory of recorded payloads, see fixtures.py")
+
+    args = parser.parse_args()
+
+    gridpoint = fixtures.load("weathergov_gridpoint", args.fixtures)[0]
+    onecall = fixtures.load("openweathermap_onecall", args.fixtures)[0]
+
+    wg = weathergov.WeatherGov()
+    owm = openweathermap.OpenWeatherMap()
+    sources = {
+        # parse directly, the grid index and cell cache would otherwise share one parse
+        "weathergov": lambda i: Forecast({}, {"success": "true"}, wg.parse_gridpoint(gridpoint)),
+        "openweathermap": lambda i: fetch(owm, onecall, i),
+    }
+    for name, build in sources.items():
+        columnar = measure(build, args.locations)
+        nested = measure(lambda i: dict_form(build(i)), args.locations)
+        print(json.dumps({
+            "source": name,
+            "locations": args.locations,
+            "dict_bytes_per_location": int(nested),
+            "columnar_bytes_per_location": int(columnar),
+            "ratio": round(nested / columnar, 1),
+        }))
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import utility
+
+"""
+Micro-benchmark of the metric calls made on every forecast request.
+
+A cached /forecast does about four counter increments: cache state, success, the response code
+and, when coalesced, the coalesced counter. This times that set of calls three ways:
+    legacy      utility.inc as it was, hostname lookup and label sorting on every call
+    utility     utility.inc with labelled children cached
+    prebound    .inc() on handles resolved once, as Weather.counter does
+"""
+
+# utility.inc as it was before children were cached, kept as the baseline
+def legacy_inc(name, labelDict):
+    if "host" not in labelDict:
+        labelDict.update({"host": socket.gethostname().lower()})
+    counter = utility.getCounter(name, "", utility.sorted_keys(labelDict))
+    utility.debug("utility.inc({}, {})".format(name, labelDict))
+    if len(labelDict.keys()) > 0:
+        counter.labels(*utility.sorted_values(labelDict)).inc()
+    else:
+        counter.inc()
+
+CALLS = [
+    ("weatherService_bench_cache_hit_total", {"source": "weathergov"}),
+    ("weatherService_bench_success_total", {"source": "weathergov"}),
+    ("weatherService_bench_coalesced_total", {"source": "weathergov"}),
+    ("weatherService_bench_response", {"code": 200}),
+]
+
+def request_legacy():
+    for name, labels in CALLS:
+        # the callers built a new dict per call
+        legacy_inc(name, dict(labels))
+
+def request_utility():
+    for name, labels in CALLS:
+        utility.inc(name, labels)
+
+HANDLES = [utility.counter(name, labels) for name, labels in CALLS]
+
+def request_prebound():
+    for handle in HANDLES:
+        handle.inc()
+
+def best_of(fn, repeat, number):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark per-request metric overhead.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, fn in [("legacy", request_legacy), ("utility", request_utility), ("prebound", request_prebound)]:
+        results[name] = best_of(fn, args.repeat, args.number)
+        print(f"{name:>8}: {results[name]*1e6:.2f}us per request ({len(CALLS)} increments)")
+    print(json.dumps({k: round(v * 1e6, 3) for k, v in results.items()}))
@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import isodate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import fixtures
+import weather
+import weathergov
+import openweathermap
+
+"""
+Micro-benchmark of WeatherGov.parse_gridpoint against the per-hour parser it replaced.
+
+Runs over the generated 7 day gridpoint, or over gridpoint payloads saved from api.weather.gov
+given with --payload or recorded into --fixtures (see fixtures.py). Checks both parsers produce
+the same output before timing them. Also times OpenWeatherMap.parse_onecall, which has no
+baseline.
+"""
+
+# Weather.normalized_uom as it was, used by the baseline
+def legacy_uom(uom):
+    if uom == "C":
+        return "celsius"
+    elif uom == "m":
+        return "meters"
+    return uom
+
+# the per-hour parser as it was before the columnar one, kept as the baseline
+def legacy_parse_gridpoint(data):
+    hourly = {}
+
+    # walk the properties I care about
+    for key in data["properties"]:
+        if key not in [
+            "temperature",
+            "apparentTemperature",
+            "dewpoint",
+            "relativeHumidity",
+            "skyCover",
+            "windDirection",
+            "windSpeed",
+            "windGust",
+            "probabilityOfPrecipitation",
+            "quantitativePrecipitation",
+            "pressure",
+            "visibility",
+            "weather", # special handling
+        ]:
+            # it isn't one I care about
+            continue
+    
+        if "values" not in data["properties"][key]:
+            # there is no data, skip
+            continue
+
+        uom=""
+        if "uom" in data["properties"][key]:
+            uom=data["properties"][key]["uom"].split(":")[1]
+            if uom == "degree_(angle)":
+                uom="degrees"
+            elif uom == "km_h-1":
+                uom="kph"
+            elif uom == "degC":
+                uom="celsius"
+        
+        for v in data["properties"][key]["values"]:
+            # always has 'validTime' and 'value'
+            # data for value is usually float, but for key="weather" it is an object
+            # https://en.wikipedia.org/wiki/ISO_8601#Durations
+            _validTime, _duration=v["validTime"].split("/")
+            value=v["value"]
+
+            # convert pressure to millibars, it comes as Hg
+            if key == "pressure":
+                uom="millibars"
+                value=weather.convert_Hg_to_millibars(value)
+
+            # convert to date
+            validTime=datetime.datetime.strptime(_validTime, "%Y-%m-%dT%H:%M:%S%z")
+
+            # convert duration (hours)
+            dur=isodate.parse_duration(_duration)
+            duration_h=int(dur.days * 24 + dur.seconds / 3600)
+
+            for i in range(0, duration_h):
+                o_key=str(validTime + datetime.timedelta(hours=i))
+
+                if o_key not in hourly:
+                    # always set "dt"!
+                    dt=datetime.datetime.fromisoformat(o_key.replace("Z", "+00:00")).timestamp()
+                    hourly[o_key] = {
+                        "dt": dt,
+                    }
+
+                if key != "weather":
+                    hourly[o_key][key]={
+                        "value": value,
+                        "uom": legacy_uom(uom),
+                    }
+                else:
+                    w_value=""
+                    # value is an array in the case of "weather"
+                    for v in value:
+                        if w_value != "":
+                            w_value+="and "
+                        if "coverage" in v and v["coverage"] is not None:
+                            w_value+=v["coverage"]+" "
+                        if "intensity" in v and v["intensity"] is not None:
+                            w_value+=v["intensity"]+" "
+                        if "weather" in v and v["weather"] is not None:
+                            w_value+=v["weather"]+" "
+
+                    w_value = w_value.replace("_", " ")
+                    hourly[o_key][key]={
+                        "value": w_value.strip()
+                    }
+
+    return hourly
+
+def best_of(fn, data, repeat, number):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(data)
+        elapsed = (time.perf_counter() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the weather.gov gridpoint parser.")
+    parser.add_argument("--payload", type=str, action="append", help="gridpoint json saved from api.weather.gov, may be repeated")
+    parser.add_argument("--fixtures", type=str, help="directory of recorded payloads, see fixtures.py")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20)
+
+    args = parser.parse_args()
+
+    payloads = {"generated": fixtures.weathergov_gridpoint()}
+    if args.fixtures is not None:
+        for i, data in enumerate(fixtures.load("weathergov_gridpoint", args.fixtures)):
+            payloads[f"{args.fixtures}[{i}]"] = data
+    for filename in args.payload or []:
+        with open(filename, 'r') as f:
+            payloads[filename] = json.load(f)
+
+    w = weathergov.WeatherGov()
+    for name, data in payloads.items():
+        legacy = legacy_parse_gridpoint(data)
+        columnar = w.parse_gridpoint(data)
+        if json.loads(json.dumps(legacy)) != json.loads(json.dumps(columnar.to_dict())):
+            raise RuntimeError(f"{name}: parsers disagree")
+
+        legacy_seconds = best_of(legacy_parse_gridpoint, data, args.repeat, args.number)
+        columnar_seconds = best_of(w.parse_gridpoint, data, args.repeat, args.number)
+        print(json.dumps({
+            "payload": name,
+            "hours": len(columnar),
+            "legacy_ms": round(legacy_seconds * 1000, 3),
+            "columnar_ms": round(columnar_seconds * 1000, 3),
+            "speedup": round(legacy_seconds / columnar_seconds, 1),
+            "parses_per_second": round(1 / columnar_seconds, 1),
+        }))
+
+    owm = openweathermap.OpenWeatherMap()
+    for i, data in enumerate(fixtures.load("openweathermap_onecall", args.fixtures)):
+        seconds = best_of(owm.parse_onecall, data, args.repeat, args.number)
+        print(json.dumps({
+            "payload": f"openweathermap[{i}]",
+            "hours": len(data["hourly"]),
+            "columnar_ms": round(seconds * 1000, 3),
+            "parses_per_second": round(1 / seconds, 1),
+        }))
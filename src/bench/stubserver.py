@@ -0,0 +1,101 @@
+import json
+import zlib
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+import fixtures
+
+"""
+Stub upstream serving api.weather.gov and openweathermap shaped responses.
+
+Each response is delayed by --latency milliseconds (+/- --jitter) to stand in for a real upstream
+round trip. Payloads are the generated fixtures, or recorded ones from --fixtures (see
+fixtures.py), spread over by coordinate so a location always gets the same payload.
+
+Faults can be injected into the forecast calls (not /points, so the grid index still fills):
+
+    --error-rate     fraction answered with --error-status (default 503)
+    --timeout-rate   fraction that never answer within --timeout-seconds
+
+Point the service at it with the api_base settings in config.yaml, e.g.:
+
+    weathergov:
+      api_base: "http://127.0.0.1:9300"
+    openweathermap:
+      api_base: "http://127.0.0.1:9300"
+"""
+
+def create_app(api_base, latency=0, jitter=0, directory=None, error_rate=0, error_status=503, timeout_rate=0, timeout_seconds=60, seed=1):
+    # encode once, the stub should never be the bottleneck
+    gridpoint_bodies = [json.dumps(p).encode() for p in fixtures.load("weathergov_gridpoint", directory)]
+    onecall_bodies = [json.dumps(p).encode() for p in fixtures.load("openweathermap_onecall", directory)]
+    r = random.Random(seed)
+
+    async def delay():
+        if latency > 0 or jitter > 0:
+            await asyncio.sleep(max(0, latency + r.uniform(-jitter, jitter)) / 1000)
+
+    async def fault():
+        # None, or the response for an injected error
+        roll = r.random()
+        if roll < timeout_rate:
+            await asyncio.sleep(timeout_seconds)
+        elif roll < timeout_rate + error_rate:
+            return web.Response(status=error_status, text="injected error")
+        return None
+
+    def pick(payloads, key):
+        return payloads[zlib.crc32(key.encode()) % len(payloads)]
+
+    async def points(request):
+        await delay()
+        latitude, longitude = request.match_info["point"].split(",")
+        return web.json_response(fixtures.weathergov_points(api_base, latitude, longitude))
+
+    async def gridpoints(request):
+        await delay()
+        failed = await fault()
+        if failed is not None:
+            return failed
+        return web.Response(body=pick(gridpoint_bodies, request.match_info["grid"]), content_type="application/geo+json")
+
+    async def owm(request):
+        await delay()
+        failed = await fault()
+        if failed is not None:
+            return failed
+        key = f"{request.query.get('lat')},{request.query.get('lon')}"
+        return web.Response(body=pick(onecall_bodies, key), content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/points/{point}", points)
+    app.router.add_get("/gridpoints/{office}/{grid}", gridpoints)
+    app.router.add_get("/data/3.0/onecall", owm)
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stub upstream weather APIs for benchmarks.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9300)
+    parser.add_argument("--latency", type=int, help="milliseconds added to each response", default=100)
+    parser.add_argument("--jitter", type=int, help="milliseconds the latency varies by either way", default=0)
+    parser.add_argument("--fixtures", type=str, help="directory of recorded payloads, see fixtures.py")
+    parser.add_argument("--error-rate", type=float, help="fraction of forecast calls that fail", default=0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--timeout-rate", type=float, help="fraction of forecast calls that hang", default=0)
+    parser.add_argument("--timeout-seconds", type=float, default=60)
+
+    args = parser.parse_args()
+    app = create_app(
+        f"http://{args.host}:{args.port}",
+        args.latency,
+        args.jitter,
+        args.fixtures,
+        args.error_rate,
+        args.error_status,
+        args.timeout_rate,
+        args.timeout_seconds,
+    )
+    web.run_app(app, host=args.host, port=args.port, print=None)
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+"""
+Run the benchmarks and write their results to one json file, optionally compared against the
+results of an earlier run:
+
+    python suite.py --output before.json
+    ... change something ...
+    python suite.py --output after.json --compare before.json
+
+Everything runs offline against fixtures and the stub upstream (see stubserver.py), recorded
+payloads are used with --fixtures. A metric worse than the baseline by more than --threshold
+percent is a regression and the exit code is 1. Timings are only comparable on the same machine.
+Before anything runs the service is set up from the repo's config.yaml (server.py --check), the
+benchmarks all write their own config and would otherwise miss a config.yaml that fails to load.
+
+    parser      parse time per payload, both sources
+    normalize   openweathermap field mapping per hour
+    cache       Weather.get_forecast per cache path (hit, stale, miss)
+    validate    forecast validation
+    metrics     per-request metric overhead
+    memory      bytes per cached location
+    encodings   response size and client decode time per output format
+    loadtest    /forecast requests/sec, p50 and p99 for each server, cold (all misses) and warm
+"""
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PY_DIR = os.path.join(BENCH_DIR, "..", "py")
+
+LOWER = "lower"
+HIGHER = "higher"
+
+# name -> (script, arguments, fields identifying a result, {metric: which way is better})
+BENCHMARKS = {
+    "parser": ("parser.py", [], ["payload"], {"columnar_ms": LOWER}),
+    "normalize": ("normalize.py", [], ["source"], {"normalized_us_per_hour": LOWER, "normalized_parse_ms": LOWER}),
+    "cache": ("cache.py", [], ["source", "path"], {"us_per_request": LOWER}),
+    "validate": ("validate.py", [], [], {"compiled": LOWER, "forecast": LOWER, "memoized": LOWER}),
+    "metrics": ("metrics.py", [], [], {"utility": LOWER, "prebound": LOWER}),
+    "memory": ("memory.py", [], ["source"], {"columnar_bytes_per_location": LOWER}),
+    "encodings": ("encodings.py", [], ["source", "format"], {"bytes": LOWER, "gzip_bytes": LOWER, "decode_ms": LOWER}),
+    "loadtest": ("loadtest.py", [], ["server", "source", "distinct"], {
+        "requests_per_second": HIGHER,
+        "p50_ms": LOWER,
+        "p99_ms": LOWER,
+        "errors": LOWER,
+        "unsuccessful": LOWER,
+    }),
+}
+
+# scripts that take --fixtures
+FIXTURES = ["parser", "normalize", "cache", "memory", "encodings", "loadtest"]
+
+def json_lines(output):
+    # benchmarks print json results among human readable lines
+    results = []
+    for line in output.splitlines():
+        if line.startswith("{"):
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                pass
+    return results
+
+def run(name, arguments):
+    script = BENCHMARKS[name][0]
+    print(f"running {name}: {script} {' '.join(arguments)}", file=sys.stderr)
+    completed = subprocess.run(
+        [sys.executable, os.path.join(BENCH_DIR, script), *arguments],
+        cwd=BENCH_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"{name} failed with exit code {completed.returncode}")
+    return json_lines(completed.stdout)
+
+def check_config():
+    # the shipped config.yaml loads and sets up every source
+    completed = subprocess.run(
+        [sys.executable, os.path.join(PY_DIR, "server.py"), "--config", os.path.join(BENCH_DIR, "..", "..", "config.yaml"), "--check"],
+        cwd=PY_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    if completed.returncode != 0:
+        print(completed.stdout, file=sys.stderr)
+        raise RuntimeError("config.yaml failed to load")
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def flatten(report):
+    # "benchmark[identity].metric" -> (value, better)
+    metrics = {}
+    for name, results in report["results"].items():
+        if name not in BENCHMARKS:
+            continue
+        _, _, identity, compared = BENCHMARKS[name]
+        for result in results:
+            label = ",".join(f"{k}={result[k]}" for k in identity if k in result)
+            for metric, better in compared.items():
+                if metric in result:
+                    metrics[f"{name}[{label}].{metric}"] = (result[metric], better)
+    return metrics
+
+def compare(baseline, report, threshold):
+    # prints every metric in both reports, returns the names of the regressions
+    before = flatten(baseline)
+    after = flatten(report)
+    regressions = []
+    width = max([len(k) for k in after] + [0])
+    for key, (value, better) in after.items():
+        if key not in before:
+            print(f"{key:<{width}}  {value:>12}  (new)")
+            continue
+        old = before[key][0]
+        if old == 0:
+            change = 0 if value == 0 else float("inf")
+        else:
+            change = (value - old) / abs(old) * 100
+        worse = change > threshold if better == LOWER else change < -threshold
+        if worse:
+            regressions.append(key)
+        print(f"{key:<{width}}  {old:>12} -> {value:>12}  {change:+7.1f}%{'  REGRESSION' if worse else ''}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the benchmark suite and compare against a baseline.")
+    parser.add_argument("--output", type=str, help="write results json here, default stdout")
+    parser.add_argument("--compare", type=str, help="results json of an earlier run")
+    parser.add_argument("--threshold", type=float, help="percent worse that counts as a regression", default=10)
+    parser.add_argument("--only", type=str, action="append", choices=list(BENCHMARKS), help="may be repeated, default all")
+    parser.add_argument("--skip", type=str, action="append", choices=list(BENCHMARKS), default=[])
+    parser.add_argument("--fixtures", type=str, help="directory of recorded payloads, see fixtures.py")
+    parser.add_argument("--requests", type=int, help="requests per load test", default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=int, help="stub upstream latency in milliseconds", default=50)
+    parser.add_argument("--warm-locations", type=int, help="locations the warm load test cycles over", default=50)
+
+    args = parser.parse_args()
+
+    check_config()
+    report = {
+        "started": time.time(),
+        "commit": commit(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "results": {},
+    }
+    for name in args.only or BENCHMARKS:
+        if name in args.skip:
+            continue
+        arguments = list(BENCHMARKS[name][1])
+        if args.fixtures is not None and name in FIXTURES:
+            arguments += ["--fixtures", os.path.abspath(args.fixtures)]
+        if name == "loadtest":
+            arguments += ["--requests", str(args.requests), "--concurrency", str(args.concurrency), "--latency", str(args.latency)]
+            # cold: every request misses, warm: all but the first few are cache hits
+            report["results"][name] = run(name, arguments) + run(name, arguments + ["--distinct", str(args.warm_locations)])
+        else:
+            report["results"][name] = run(name, arguments)
+    report["seconds"] = round(time.time() - report["started"], 1)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold}%", file=sys.stderr)
+            sys.exit(1)
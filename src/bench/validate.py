@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+
+import fixtures
+import weathergov
+import validation
+from forecast import Forecast
+
+"""
+Micro-benchmark of forecast validation on a full-size (7 day, 13 field) weather.gov forecast.
+
+    legacy      the per-hour validator with list literals, as validate_output was
+    compiled    validation.Validator on the same nested dict
+    forecast    validation.Validator on the columnar Forecast
+    memoized    Weather.validate_output on a Forecast already validated, i.e. a cache hit
+
+A request used to validate twice, so legacy is also shown per request.
+"""
+
+# validate_output as it was before the compiled validator, kept as the baseline
+def legacy_validate_output(output):
+    is_valid = True
+    errors = []
+    if "metadata" not in output:
+        is_valid = False
+        errors.append("missing metadata")
+    if "data" not in output:
+        is_valid = False
+        errors.append("missing data")
+    if "status" not in output:
+        is_valid = False
+        errors.append("missing status")
+
+    for date in output["data"]:
+        for key in output["data"][date]:
+            if key not in [
+                "dt",
+                "temperature",
+                "apparentTemperature",
+                "dewpoint",
+                "relativeHumidity",
+                "skyCover",
+                "windDirection",
+                "windSpeed",
+                "windGust",
+                "probabilityOfPrecipitation",
+                "quantitativePrecipitation",
+                "pressure",
+                "visibility",
+                "weather",
+            ]:
+                is_valid = False
+                errors.append(f"unexpected key: data.DATE.{key}")
+                continue
+
+            if isinstance(output["data"][date][key], dict):
+                for key2 in output["data"][date][key]:
+                    if key2 not in [
+                        "value",
+                        "uom",
+                    ]:
+                        is_valid = False
+                        errors.append(f"unexpected key: data.DATE.{key}.{key2}")
+                        break
+
+        for key in [
+            "dt",
+        ]:
+            if key not in output["data"][date]:
+                is_valid = False
+                errors.append(f"missing required key: data.DATE.{key}")
+                continue
+
+    return is_valid, errors
+
+def best_of(fn, data, repeat, number):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(data)
+        elapsed = (time.perf_counter() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark forecast validation.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200)
+
+    args = parser.parse_args()
+
+    source = weathergov.WeatherGov()
+    forecast = Forecast({"source": "bench"}, {"success": "true"}, source.parse_gridpoint(fixtures.weathergov_gridpoint()))
+    output = forecast.to_dict()
+
+    # same verdict from every validator before timing them, and on a broken forecast the same errors
+    broken = json.loads(json.dumps(output))
+    first = next(iter(broken["data"].values()))
+    first["bogus"] = {"value": 1}
+    first["temperature"]["extra"] = 1
+    del first["dt"]
+    assert legacy_validate_output(output) == validation.validator.validate(output) == (True, [])
+    assert legacy_validate_output(broken) == validation.validator.validate(broken)
+    assert validation.validator.validate(forecast) == (True, [])
+
+    def memoized(f):
+        return source.validate_output(f)
+    memoized(forecast)
+
+    results = {
+        "legacy": best_of(legacy_validate_output, output, args.repeat, args.number),
+        "compiled": best_of(validation.validator.validate, output, args.repeat, args.number),
+        "forecast": best_of(validation.validator.validate_forecast, forecast, args.repeat, args.number * 100),
+        "memoized": best_of(memoized, forecast, args.repeat, args.number * 100),
+    }
+    print(f"{len(output['data'])} hours, {len(forecast.hourly.fields())} fields")
+    for name, elapsed in results.items():
+        print(f"{name:>9}: {elapsed*1e6:10.2f}us")
+    print(f"legacy per request (validated twice): {results['legacy']*2*1e6:.2f}us")
+    print(json.dumps({k: round(v * 1e6, 3) for k, v in results.items()}))
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import yaml
+import uvicorn
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import ImmutableMultiDict
+
+import server
+import utility
+import fanout
+import batch
+import responses
+import projection
+import prefetch
+import snapshot
+import ratelimit
+import circuitbreaker
+import stages
+import formats
+import subscribe
+
+"""
+ASGI entry point, the asyncio alternative to the Flask server in server.py.
+
+Serves the same routes with the same responses and metrics, but a forecast that has to go
+upstream awaits the response instead of holding a thread. Run with:
+
+    python asgi.py --config config.yaml
+
+or under any ASGI server, with the config file given by WEATHER_SERVICE_CONFIG:
+
+    WEATHER_SERVICE_CONFIG=config.yaml uvicorn asgi:app
+"""
+
+HELP = "see http://github.com/jewzaam/weather-service for help"
+
+async def respond(send, code, body, content_type="text/html; charset=utf-8", headers={}):
+    if isinstance(body, str):
+        body = body.encode()
+    headers = {"Content-Type": content_type, **headers, "Content-Length": str(len(body))}
+    await send({
+        "type": "http.response.start",
+        "status": code,
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def header(scope, name):
+    name = name.lower().encode()
+    for k, v in scope["headers"]:
+        if k == name:
+            return v.decode()
+    return None
+
+async def forecast(scope, send, latitude, longitude, args):
+    source = args.get('source')
+    code=200
+    profile = stages.profiler.begin(f"{scope['path']}?{scope['query_string'].decode()}")
+    try:
+        selected = projection.parse(args)
+        fmt = responses.negotiate_format(args.get("format"), header(scope, "Accept"))
+        requested_format = "format" in args
+        args = projection.upstream(args)
+        names = fanout.requested_sources(args, server.sources)
+        if names is not None:
+            if fmt != formats.JSON and requested_format:
+                raise ValueError("format is only supported for a single source")
+            if len([n for n in names if n not in server.sources]) > 0:
+                code=400
+                return await respond(send, code, "Invalid source")
+            forecast = await fanout.get_forecast_async(server.sources, names, latitude, longitude, args, selected)
+            with stages.timed("fanout", "serialize"):
+                body = json.dumps(forecast)
+            return await respond(send, code, body, "text/json")
+        if source not in server.sources:
+            code=400
+            return await respond(send, code, "Invalid source")
+        forecast = await server.sources[source].get_forecast_async(latitude, longitude, args)
+        if selected is not None:
+            forecast = forecast.project(selected)
+        code, headers, body = responses.forecast_response(
+            forecast,
+            header(scope, "If-None-Match"),
+            header(scope, "Accept-Encoding"),
+            server.sources[source].cache.ttl,
+            server.sources[source].get_source(),
+            fmt,
+        )
+        return await respond(send, code, body, headers=headers)
+    except ratelimit.RateLimited as rl:
+        code=429
+        return await respond(send, code, str(rl), headers={"Retry-After": ratelimit.retry_after_header(rl)})
+    except circuitbreaker.CircuitOpen as co:
+        code=503
+        return await respond(send, code, str(co), headers={"Retry-After": ratelimit.retry_after_header(co)})
+    except ValueError as ve:
+        code=400
+        return await respond(send, code, ve.args[0])
+    finally:
+        # same metric as server.forecast, source is not included on purpose
+        utility.inc("weatherService_forecast_response", {"code": code})
+        stages.profiler.end(profile)
+
+async def forecast_subscribe(scope, receive, send, latitude, longitude, args):
+    # same as server.forecast_subscribe, each subscriber is a coroutine waiting on its queue
+    source = args.get('source')
+    code=200
+    try:
+        selected = projection.parse(args)
+        if responses.negotiate_format(args.get("format"), None) != formats.JSON:
+            raise ValueError("format is not supported for subscriptions")
+        args = projection.upstream(args)
+        if source not in server.sources:
+            code=400
+            return await respond(send, code, "Invalid source")
+        topic = subscribe.hub.join(server.sources[source], latitude, longitude, args)
+        subscriber = subscribe.AsyncSubscriber(selected, asyncio.get_running_loop(), subscribe.hub.max_queue)
+        try:
+            forecast = await server.sources[source].get_forecast_async(latitude, longitude, args)
+            topic.add(subscriber, forecast)
+        except Exception as e:
+            subscribe.hub.leave(topic, subscriber)
+            raise e
+    except subscribe.Full as f:
+        code=503
+        return await respond(send, code, str(f))
+    except ratelimit.RateLimited as rl:
+        code=429
+        return await respond(send, code, str(rl), headers={"Retry-After": ratelimit.retry_after_header(rl)})
+    except circuitbreaker.CircuitOpen as co:
+        code=503
+        return await respond(send, code, str(co), headers={"Retry-After": ratelimit.retry_after_header(co)})
+    except ValueError as ve:
+        code=400
+        return await respond(send, code, ve.args[0])
+    finally:
+        utility.inc("weatherService_forecast_subscribe_response", {"code": code})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        subscriber.close()
+
+    watcher = asyncio.get_running_loop().create_task(disconnected())
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": code,
+            "headers": [
+                (b"content-type", subscribe.CONTENT_TYPE.encode()),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        while True:
+            data = await subscriber.next_async(subscribe.hub.heartbeat)
+            if data is None:
+                break
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    except OSError:
+        # client went away mid-send
+        pass
+    finally:
+        watcher.cancel()
+        subscribe.hub.leave(topic, subscriber)
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+async def forecast_batch(receive, send):
+    code=200
+    try:
+        coordinates, names, parameters = batch.parse_request(await read_body(receive), server.sources)
+    except ValueError as ve:
+        code=400
+        return await respond(send, code, ve.args[0])
+    finally:
+        utility.inc("weatherService_forecast_batch_response", {"code": code})
+
+    # streamed as each forecast completes
+    await send({
+        "type": "http.response.start",
+        "status": code,
+        "headers": [(b"content-type", b"application/x-ndjson")],
+    })
+    async for line in batch.run_async(server.sources, coordinates, names, parameters):
+        await send({"type": "http.response.body", "body": line.encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if not server.sources:
+                # not started from __main__, load config from the environment
+                with open(os.environ.get("WEATHER_SERVICE_CONFIG", "config.yaml"), 'r') as f:
+                    server.setup(yaml.safe_load(f))
+            snapshot.start()
+            prefetch.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            prefetch.stop()
+            snapshot.stop()
+            await server.httpclient.async_client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"].strip("/").split("/")
+    if path == [""]:
+        return await respond(send, 200, HELP)
+    if path == ["debug", "profile"] and stages.profiler.enabled:
+        return await respond(send, 200, json.dumps(stages.profiler.report()), "text/json")
+    if path == ["forecast", "batch"] and scope["method"] == "POST":
+        return await forecast_batch(receive, send)
+    if len(path) == 4 and path[0] == "forecast" and path[3] == "subscribe":
+        args = ImmutableMultiDict(parse_qsl(scope["query_string"].decode()))
+        return await forecast_subscribe(scope, receive, send, path[1], path[2], args)
+    if len(path) == 3 and path[0] == "forecast":
+        args = ImmutableMultiDict(parse_qsl(scope["query_string"].decode()))
+        return await forecast(scope, send, path[1], path[2], args)
+    return await respond(send, 404, "Not Found")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Service to get weather data from various sources (asyncio).")
+    parser.add_argument("--config", type=str, help="configuraiton file", default="config.yaml")
+    parser.add_argument("--check", action="store_true", help="load the config and set up the sources, then exit")
+
+    args = parser.parse_args()
+
+    # load config file
+    with open(args.config, 'r') as f:
+        server.setup(yaml.safe_load(f))
+
+    if args.check:
+        print(f"{args.config}: ok, sources: {', '.join(server.sources)}")
+        sys.exit(0)
+
+    # Start up the server to expose the metrics.
+    utility.metrics(server.config["metrics"]["port"])
+
+    # start http server to listen for requests
+    uvicorn.run(app, host=server.config["service"]["host"], port=server.config["service"]["port"], log_level="warning")
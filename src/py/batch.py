@@ -0,0 +1,138 @@
+import json
+import asyncio
+import concurrent.futures
+from werkzeug.datastructures import ImmutableMultiDict
+
+import utility
+import weather
+
+"""
+Forecasts for many coordinates in one request.
+
+Request body:
+    {
+        "coordinates": [[42.36, -71.06], {"latitude": 40.71, "longitude": -74.01}, ...],
+        "sources": ["weathergov", "openweathermap"],
+        "parameters": {"apikey": "..."}
+    }
+
+Coordinates are deduplicated after rounding, each (coordinate, source) is resolved through the
+same caches as /forecast with at most `concurrency` in flight, and results are streamed back as
+newline delimited json in the order they finish:
+    {"coordinates": ["42.36", "-71.06"], "requested": [[42.3601, -71.0589]], "source": "weathergov", "forecast": {...}}
+    {"coordinates": ["40.71", "-74.01"], "requested": [[40.71, -74.01]], "source": "openweathermap", "error": "..."}
+
+Metrics:
+    weatherService_batch_coordinates
+    weatherService_batch_deduplicated
+"""
+
+DEFAULT_CONCURRENCY=16
+DEFAULT_MAX_COORDINATES=1000
+
+concurrency = DEFAULT_CONCURRENCY
+max_coordinates = DEFAULT_MAX_COORDINATES
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_CONCURRENCY, thread_name_prefix="batch")
+
+def configure(config):
+    global concurrency, max_coordinates, executor
+    concurrency = config.get("concurrency", DEFAULT_CONCURRENCY)
+    max_coordinates = config.get("max_coordinates", DEFAULT_MAX_COORDINATES)
+    if executor._max_workers != concurrency:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+
+def parse_request(body, sources):
+    # returns ({normalized coordinates: [requested coordinates]}, [source names], parameters)
+    # raises ValueError for anything the caller got wrong
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise ValueError("body must be json")
+    if not isinstance(request, dict):
+        raise ValueError("body must be a json object")
+
+    names = request.get("sources", [])
+    if not isinstance(names, list) or len(names) == 0:
+        raise ValueError("missing sources")
+    for name in names:
+        if name not in sources:
+            raise ValueError("Invalid source")
+
+    requested = request.get("coordinates", [])
+    if not isinstance(requested, list) or len(requested) == 0:
+        raise ValueError("missing coordinates")
+    if len(requested) > max_coordinates:
+        raise ValueError(f"too many coordinates, max is {max_coordinates}")
+
+    coordinates = {}
+    for c in requested:
+        try:
+            if isinstance(c, dict):
+                latitude, longitude = float(c["latitude"]), float(c["longitude"])
+            else:
+                latitude, longitude = float(c[0]), float(c[1])
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise ValueError(f"invalid coordinates: {c}")
+        # same rounding as the forecast cache, so nearby coordinates are fetched once
+        key = tuple(weather.normalize_coordinates(latitude, longitude))
+        coordinates.setdefault(key, []).append([latitude, longitude])
+
+    utility.add("weatherService_batch_coordinates", len(requested), {})
+    utility.add("weatherService_batch_deduplicated", len(requested) - len(coordinates), {})
+
+    parameters = request.get("parameters", {})
+    if not isinstance(parameters, dict):
+        raise ValueError("parameters must be a json object")
+
+    return coordinates, names, parameters
+
+def source_parameters(name, parameters):
+    # the same shape of arguments /forecast passes to the source
+    return ImmutableMultiDict({**parameters, "source": name})
+
+def result_line(coordinates, requested, name, forecast=None, error=None):
+    line = {
+        "coordinates": list(coordinates),
+        "requested": requested,
+        "source": name,
+    }
+    if error is None:
+        line["forecast"] = forecast.to_dict()
+    else:
+        line["error"] = str(error)
+    return json.dumps(line) + "\n"
+
+def run(sources, coordinates, names, parameters):
+    # generator of ndjson lines, one per (coordinate, source), in the order they complete
+    futures = {}
+    for c, requested in coordinates.items():
+        for name in names:
+            future = executor.submit(sources[name].get_forecast, c[0], c[1], source_parameters(name, parameters))
+            futures[future] = (c, requested, name)
+
+    for future in concurrent.futures.as_completed(futures):
+        c, requested, name = futures[future]
+        try:
+            yield result_line(c, requested, name, forecast=future.result())
+        except Exception as e:
+            yield result_line(c, requested, name, error=e)
+
+async def run_async(sources, coordinates, names, parameters):
+    # same as run on the event loop, the semaphore bounds upstream calls in flight
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(c, requested, name):
+        async with semaphore:
+            try:
+                forecast = await sources[name].get_forecast_async(c[0], c[1], source_parameters(name, parameters))
+                return result_line(c, requested, name, forecast=forecast)
+            except Exception as e:
+                return result_line(c, requested, name, error=e)
+
+    tasks = [
+        one(c, requested, name)
+        for c, requested in coordinates.items()
+        for name in names
+    ]
+    for task in asyncio.as_completed(tasks):
+        yield await task
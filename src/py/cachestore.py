@@ -0,0 +1,92 @@
+import os
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+
+"""
+Cache store shared by every worker process on a host, backed by SQLite in WAL mode.
+
+Workers read and fill the same file, so a forecast fetched by one worker is served by all of them.
+Readers never block on the writer in WAL mode and rows are small (see forecast.dumps), so a
+lookup costs tens of microseconds.
+
+The locks table stops two workers fetching the same key at once: a worker that misses takes the
+key's lock before going upstream, any other worker waits for the row to show up instead. A lock
+expires on its own so a worker that dies holding one doesn't stall the others for long.
+
+Keys are stored hashed so parameters in the key (i.e. apikey) are not written to disk.
+"""
+
+DEFAULT_PATH="weather-service-cache.sqlite"
+DEFAULT_LOCK_TTL=15 # seconds, longest a fetch is expected to take
+
+def hashed_key(key):
+    # a cache key as stored on disk, see also forecastcache.ForecastCache.save
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+class SqliteStore:
+    def __init__(self, path=DEFAULT_PATH, lock_ttl=DEFAULT_LOCK_TTL):
+        self.path = path
+        self.lock_ttl = lock_ttl
+        # identifies this process (and this store) as a lock owner
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.local = threading.local()
+        with self.__connection() as c:
+            c.execute("CREATE TABLE IF NOT EXISTS forecasts (key TEXT PRIMARY KEY, fetched REAL, expires REAL, value BLOB)")
+            c.execute("CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+
+    def __connection(self):
+        # one connection per thread, sqlite connections can't be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # durability of the last few writes doesn't matter for a cache
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def key(self, key):
+        return hashed_key(key)
+
+    def get(self, key, newer_than=0):
+        # returns (fetched, value bytes), None if absent or not fetched after newer_than
+        row = self.__connection().execute("SELECT fetched, value FROM forecasts WHERE key=? AND fetched>?", (key, newer_than)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def put(self, key, fetched, expires, value):
+        # never replaces a newer row, another worker may have written one since this was fetched
+        self.__connection().execute(
+            "INSERT INTO forecasts VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET fetched=excluded.fetched, expires=excluded.expires, value=excluded.value "
+            "WHERE excluded.fetched > forecasts.fetched",
+            (key, fetched, expires, value),
+        )
+
+    def lock(self, key):
+        # True if this worker now holds the lock for key
+        now = time.time()
+        c = self.__connection()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("DELETE FROM locks WHERE key=? AND expires<?", (key, now))
+            acquired = c.execute("INSERT OR IGNORE INTO locks VALUES (?, ?, ?)", (key, self.owner, now + self.lock_ttl)).rowcount == 1
+            c.execute("COMMIT")
+            return acquired
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+    def unlock(self, key):
+        self.__connection().execute("DELETE FROM locks WHERE key=? AND owner=?", (key, self.owner))
+
+    def prune(self):
+        # drop rows that can never be served again and locks left by dead workers
+        now = time.time()
+        c = self.__connection()
+        c.execute("DELETE FROM forecasts WHERE expires<?", (now,))
+        c.execute("DELETE FROM locks WHERE expires<?", (now,))
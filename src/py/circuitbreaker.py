@@ -0,0 +1,110 @@
+import time
+from threading import Lock
+
+import utility
+
+"""
+Circuit breaker per source, so a source that is down fails fast instead of tying up workers.
+
+    closed      upstream calls go through, consecutive failures are counted
+    open        after `failures` consecutive failures (errors, timeouts, 5xx and 429 answers)
+                calls are rejected with CircuitOpen for open_seconds, the cache serves the last
+                good forecast if it has one
+    half-open   after open_seconds up to half_open_probes calls go through, a success closes the
+                circuit and a failure opens it again
+
+    circuitbreaker:
+      failures: 5
+      open_seconds: 30
+      half_open_probes: 1
+      weathergov:          # optional per source overrides
+        open_seconds: 60
+
+Metrics:
+    weatherService_circuit_state{source}            0 closed, 1 half-open, 2 open
+    weatherService_circuit_opened_total{source}
+    weatherService_circuit_rejected_total{source}
+"""
+
+DEFAULT_FAILURES=5
+DEFAULT_OPEN_SECONDS=30
+DEFAULT_HALF_OPEN_PROBES=1
+
+CLOSED = "closed"
+HALF_OPEN = "half-open"
+OPEN = "open"
+
+STATE_VALUES = {
+    CLOSED: 0,
+    HALF_OPEN: 1,
+    OPEN: 2,
+}
+
+class CircuitOpen(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        # seconds until the circuit lets a probe through
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    def __init__(self, source, config={}):
+        self.source = source
+        self.failures = config.get("failures", DEFAULT_FAILURES)
+        self.open_seconds = config.get("open_seconds", DEFAULT_OPEN_SECONDS)
+        self.half_open_probes = config.get("half_open_probes", DEFAULT_HALF_OPEN_PROBES)
+        self.mutex = Lock()
+        self.state = CLOSED
+        self.consecutive = 0
+        self.opened = 0
+        self.probes = 0
+        self.gauge = utility.gauge("weatherService_circuit_state", {"source": source})
+        self.gauge.set(STATE_VALUES[CLOSED])
+
+    def __set_state(self, state):
+        # called holding the mutex
+        self.state = state
+        self.gauge.set(STATE_VALUES[state])
+
+    def allow(self):
+        # before a call, raises CircuitOpen if the call must not go upstream
+        with self.mutex:
+            if self.state == CLOSED:
+                return
+            now = time.time()
+            if self.state == OPEN and now >= self.opened + self.open_seconds:
+                self.__set_state(HALF_OPEN)
+                self.probes = 0
+            if self.state == HALF_OPEN and self.probes < self.half_open_probes:
+                self.probes += 1
+                return
+            retry_after = max(0, self.opened + self.open_seconds - now)
+        utility.inc("weatherService_circuit_rejected_total", {"source": self.source})
+        raise CircuitOpen(f"circuit open: {self.source}", retry_after)
+
+    def success(self):
+        with self.mutex:
+            self.consecutive = 0
+            if self.state != CLOSED:
+                print(f"Circuit closed for {self.source}")
+                self.__set_state(CLOSED)
+
+    def failure(self):
+        with self.mutex:
+            self.consecutive += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive >= self.failures):
+                print(f"Circuit opened for {self.source} after {self.consecutive} consecutive failures")
+                self.opened = time.time()
+                self.__set_state(OPEN)
+                utility.inc("weatherService_circuit_opened_total", {"source": self.source})
+
+    def release(self):
+        # the call was allowed but never reached upstream (i.e. rate limited), neither outcome counts
+        with self.mutex:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+def breaker(source, config, name):
+    # the CircuitBreaker for source from the circuitbreaker section of the service config
+    settings = {k: v for k, v in config.items() if not isinstance(v, dict)}
+    settings.update(config.get(name) or {})
+    return CircuitBreaker(source, settings)
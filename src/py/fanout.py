@@ -0,0 +1,148 @@
+import asyncio
+import datetime
+import contextvars
+import concurrent.futures
+
+import utility
+from forecast import Forecast
+
+"""
+Fetch a forecast from several sources in parallel and merge them by hour.
+
+Each source gets the same deadline, a source that errors or misses the deadline is reported in
+status and the rest are returned. A source past the deadline keeps running in the background and
+fills the cache for the next request.
+
+Merged output:
+    {
+        "metadata": {"coordinates": [...], "sources": {"<source>": <source metadata>}},
+        "data": {"<date>": {"dt": ..., "<source>": {"<field>": {"value": ..., "uom": ...}}}},
+        "status": {"success": "true", "requested": ..., "responded": ..., "sources": {"<source>": <source status>}}
+    }
+
+Metrics:
+    weatherService_fanout_source_timeout_total{source}
+    weatherService_fanout_source_error_total{source}
+"""
+
+DEFAULT_DEADLINE=5 # seconds
+DEFAULT_WORKERS=16
+
+# "all" or a comma separated list in the source parameter asks for a merged forecast
+ALL="all"
+
+deadline = DEFAULT_DEADLINE
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_WORKERS, thread_name_prefix="fanout")
+
+def configure(config):
+    global deadline, executor
+    deadline = config.get("deadline", DEFAULT_DEADLINE)
+    workers = config.get("workers", DEFAULT_WORKERS)
+    if executor._max_workers != workers:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+
+def requested_sources(args, sources):
+    # returns the list of source names if this is a fan-out request, else None
+    requested = []
+    for value in args.getlist("source"):
+        requested.extend([s.strip() for s in value.split(",") if s.strip() != ""])
+    if ALL not in requested and len(requested) < 2:
+        return None
+    names = []
+    for name in requested:
+        names.extend(sources.keys() if name == ALL else [name])
+    # keep order, drop duplicates
+    return list(dict.fromkeys(names))
+
+def failed_status(source, error):
+    utility.inc(f"weatherService_fanout_source_{error}_total", {"source": source})
+    return {
+        "success": "false",
+        "error": error,
+    }
+
+def merge(latitude, longitude, results, requested, selected=None):
+    # results is {source name: forecast or status of a failure}, selected an optional projection
+    output = {
+        "metadata": {
+            "coordinates": [latitude, longitude],
+            "sources": {},
+        },
+        "data": {},
+        "status": {
+            "success": "false",
+            "requested": str(requested),
+            "sources": {},
+        },
+    }
+
+    for source, forecast in results.items():
+        if not isinstance(forecast, Forecast):
+            output["status"]["sources"][source] = forecast
+            continue
+
+        output["metadata"]["sources"][source] = forecast.metadata
+        output["status"]["sources"][source] = forecast.status
+        if forecast.is_success():
+            output["status"]["success"] = "true"
+
+        if selected is None:
+            rows = forecast.hourly.rows()
+        else:
+            rows = forecast.hourly.rows(selected.fields, selected.start, selected.end)
+        for date, hour in rows:
+            if date not in output["data"]:
+                output["data"][date] = {
+                    "dt": hour["dt"],
+                }
+            # every field except dt goes under the source, side by side with the other sources
+            output["data"][date][source] = {k: v for k, v in hour.items() if k != "dt"}
+
+    # sources return hours in their own order, present one timeline
+    output["data"] = dict(sorted(output["data"].items(), key=lambda item: item[1]["dt"]))
+    output["status"]["responded"] = str(datetime.datetime.now())
+    return output
+
+def get_forecast(sources, names, latitude, longitude, parameters, selected=None):
+    requested = datetime.datetime.now()
+    futures = {
+        # each in a copy of this context so the stages of a profiled request follow it into the pool
+        name: executor.submit(contextvars.copy_context().run, sources[name].get_forecast, latitude, longitude, parameters)
+        for name in names
+    }
+    # one deadline for all sources, total time is that of the slowest source up to the deadline
+    concurrent.futures.wait(futures.values(), timeout=deadline)
+
+    results = {}
+    for name, future in futures.items():
+        if not future.done():
+            results[name] = failed_status(name, "timeout")
+        elif future.exception() is not None:
+            results[name] = failed_status(name, "error")
+            results[name]["message"] = str(future.exception())
+        else:
+            results[name] = future.result()
+    return merge(latitude, longitude, results, requested, selected)
+
+async def get_forecast_async(sources, names, latitude, longitude, parameters, selected=None):
+    requested = datetime.datetime.now()
+    tasks = {
+        name: asyncio.ensure_future(sources[name].get_forecast_async(latitude, longitude, parameters))
+        for name in names
+    }
+    for task in tasks.values():
+        # a task past the deadline finishes unobserved, retrieve its exception so it isn't logged as lost
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    await asyncio.wait(tasks.values(), timeout=deadline)
+
+    results = {}
+    for name, task in tasks.items():
+        if not task.done():
+            # left running so the result still lands in the cache
+            results[name] = failed_status(name, "timeout")
+        elif task.exception() is not None:
+            results[name] = failed_status(name, "error")
+            results[name]["message"] = str(task.exception())
+        else:
+            results[name] = task.result()
+    return merge(latitude, longitude, results, requested, selected)
@@ -0,0 +1,365 @@
+import json
+import gzip
+import time
+import struct
+import hashlib
+import datetime
+import brotli
+from array import array
+
+import formats
+
+"""
+Compact in-memory forecast.
+
+Hourly data is held as one column per field, indexed by hour, with the unit stored once per
+field. Numeric columns are backed by array('d') so an hour costs 8 bytes per field instead of a
+dict, a float and a repeated uom string. The nested dict (and json) shape is only built when a
+forecast is serialized:
+
+    {
+        "metadata": {...},
+        "data": {"<date>": {"dt": ..., "<field>": {"value": ..., "uom": ...}}},
+        "status": {...}
+    }
+
+A forecast never changes once built, so the serialized bytes (and each compressed variant, in
+each output format, see formats.py) are kept with it the first time they are asked for and every
+later response reuses them. A View is a
+projection of a forecast (see projection.py) that reads the forecast's columns in place and keeps
+its own bytes the same way.
+
+dumps()/loads() turn a forecast into compact bytes and back for caches shared between processes
+or kept across restarts: a json header (metadata, status, units and the layout of each column)
+followed by the raw column arrays, no serialized bodies. Nothing in it is executed on load, bytes
+that don't parse raise ValueError.
+"""
+
+# Content-Encoding values a forecast can be served with, None is identity
+ENCODINGS = ["br", "gzip"]
+
+# marks an hour with no value for a field while building columns
+MISSING = object()
+
+# bumped when the dumps() layout changes, older bytes are not loaded
+DUMP_VERSION = 2
+# starts every dumps(), the header length follows it
+DUMP_MAGIC = b"WSFC"
+HEADER = struct.Struct("<4sBI")
+
+# projections kept per forecast, the oldest is dropped past this
+MAX_VIEWS = 32
+
+# Column.present states
+ABSENT = 0
+VALUE = 1
+NULL = 2
+
+# value types a Column stores in an array('d'), and the types of the gaps (MISSING and None)
+NUMERIC = frozenset((int, float))
+GAPS = frozenset((type(MISSING), type(None)))
+
+class Column:
+    __slots__ = ("values", "present", "integral")
+
+    def __init__(self, values):
+        # values is a list indexed by hour, MISSING where the field isn't set for that hour
+        # the set of types decides the layout, a column with no gaps is copied without a python loop
+        kinds = set(map(type, values))
+        gaps = not kinds.isdisjoint(GAPS)
+        numeric = kinds - GAPS <= NUMERIC
+        self.integral = numeric and float not in kinds
+        if gaps:
+            self.present = bytearray(ABSENT if v is MISSING else NULL if v is None else VALUE for v in values)
+        else:
+            self.present = bytearray((VALUE,)) * len(values)
+        if numeric:
+            if gaps:
+                self.values = array('d', (0.0 if v is MISSING or v is None else v for v in values))
+            else:
+                self.values = array('d', values)
+        else:
+            # strings (weather description) stay a list, repeated values are the same object
+            self.values = [None if v is MISSING else v for v in values]
+
+    def __len__(self):
+        return len(self.present)
+
+    def get(self, i):
+        # returns the value for hour i, MISSING if not set
+        state = self.present[i]
+        if state == ABSENT:
+            return MISSING
+        if state == NULL:
+            return None
+        if self.integral:
+            return int(self.values[i])
+        return self.values[i]
+
+    def take(self, hours):
+        # values at the given hour indexes, None where not set
+        values = self.values
+        present = self.present
+        if len(hours) == len(present) and present.count(VALUE) == len(present):
+            # every hour, all set: copied without a python loop
+            values = values.tolist() if isinstance(values, array) else list(values)
+            return list(map(int, values)) if self.integral else values
+        if self.integral:
+            return [int(values[i]) if present[i] == VALUE else None for i in hours]
+        return [values[i] if present[i] == VALUE else None for i in hours]
+
+    def nbytes(self):
+        if isinstance(self.values, array):
+            size = self.values.buffer_info()[1] * self.values.itemsize
+        else:
+            size = 8 * len(self.values)
+        return size + len(self.present)
+
+class Hourly:
+    __slots__ = ("dt", "columns", "units", "tz")
+
+    def __init__(self, dt, columns, units, tz=datetime.timezone.utc):
+        # dt: Column of epoch seconds per hour, an hour without dt is not output
+        # columns: {field: Column}, units: {field: uom or None if the field has no uom}
+        self.dt = dt
+        self.columns = columns
+        self.units = units
+        self.tz = tz
+
+    def __len__(self):
+        return len(self.dt)
+
+    def date(self, i):
+        # the key for an hour, same format the sources have always used
+        return str(datetime.datetime.fromtimestamp(self.dt.values[i], self.tz))
+
+    def fields(self):
+        return list(self.columns.keys())
+
+    def rows(self, fields=None, start=None, end=None):
+        # yields (date, row) with row in the output shape, built fresh on each call
+        # fields limits the columns output, start/end (epoch seconds) the hours: start <= dt < end
+        columns = [
+            (field, column, self.units.get(field)) for field, column in self.columns.items()
+            if fields is None or field in fields
+        ]
+        for i in range(len(self.dt)):
+            dt = self.dt.get(i)
+            if dt is MISSING:
+                continue
+            if (start is not None and dt < start) or (end is not None and dt >= end):
+                continue
+            row = {"dt": dt}
+            for field, column, uom in columns:
+                value = column.get(i)
+                if value is MISSING:
+                    continue
+                if uom is None:
+                    row[field] = {"value": value}
+                else:
+                    row[field] = {"value": value, "uom": uom}
+            yield self.date(i), row
+
+    def to_dict(self, fields=None, start=None, end=None):
+        return dict(self.rows(fields, start, end))
+
+    def table(self, fields=None, start=None, end=None):
+        # (hours, columns) for columnar output, the same hours and fields as rows(): hours are the
+        # indexes output, columns [(field, Column, uom)]
+        hours = []
+        for i in range(len(self.dt)):
+            dt = self.dt.get(i)
+            if dt is MISSING:
+                continue
+            if (start is not None and dt < start) or (end is not None and dt >= end):
+                continue
+            hours.append(i)
+        columns = [
+            (field, column, self.units.get(field)) for field, column in self.columns.items()
+            if fields is None or field in fields
+        ]
+        return hours, columns
+
+    def nbytes(self):
+        return self.dt.nbytes() + sum(c.nbytes() for c in self.columns.values())
+
+EMPTY = Hourly(Column([]), {}, {})
+
+class Encoded:
+    # serialized bytes and ETag per output format and content encoding, built on first use
+    __slots__ = ("encoded", "digests")
+
+    def __init__(self):
+        # (format, content encoding) -> serialized bytes, filled on first use
+        self.encoded = {}
+        # format -> sha1 of its uncompressed bytes
+        self.digests = {}
+
+    def encode(self, content_encoding=None, fmt=formats.JSON):
+        key = (fmt, content_encoding)
+        body = self.encoded.get(key)
+        if body is not None:
+            return body
+        if content_encoding is None:
+            if fmt == formats.JSON:
+                body = json.dumps(self.to_dict()).encode()
+            else:
+                body = formats.encode(fmt, self)
+        elif content_encoding == "gzip":
+            body = gzip.compress(self.encode(None, fmt), compresslevel=6)
+        elif content_encoding == "br":
+            body = brotli.compress(self.encode(None, fmt), quality=5)
+        else:
+            raise ValueError(f"unsupported content encoding: {content_encoding}")
+        self.encoded[key] = body
+        return body
+
+    def etag(self, content_encoding=None, fmt=formats.JSON):
+        # strong validator, each format and encoding is a different representation so gets its own tag
+        digest = self.digests.get(fmt)
+        if digest is None:
+            digest = hashlib.sha1(self.encode(None, fmt)).hexdigest()
+            self.digests[fmt] = digest
+        if content_encoding is None:
+            return f'"{digest}"'
+        return f'"{digest}-{content_encoding}"'
+
+    def nbytes(self):
+        # list() so a response encoding on another thread doesn't change the dict mid-sum
+        return sum(len(b) for b in list(self.encoded.values()))
+
+class Forecast(Encoded):
+    __slots__ = ("metadata", "status", "hourly", "created", "views", "validation")
+
+    def __init__(self, metadata, status, hourly=EMPTY):
+        super().__init__()
+        self.metadata = metadata
+        self.status = status
+        self.hourly = hourly
+        self.created = time.time()
+        # projection key -> View
+        self.views = {}
+        # (is_valid, errors) once validated, see Weather.validate_output
+        self.validation = None
+
+    def project(self, projection):
+        # the forecast limited to projection, kept so repeated projections reuse their bytes
+        view = self.views.get(projection.key)
+        if view is None:
+            view = View(self, projection)
+            if len(self.views) >= MAX_VIEWS:
+                self.views.pop(next(iter(self.views)), None)
+            self.views[projection.key] = view
+        return view
+
+    def is_success(self):
+        return self.status["success"] == "true"
+
+    def selection(self):
+        # (metadata, status, hourly, fields, start, end) as output, see formats.table
+        return self.metadata, self.status, self.hourly, None, None, None
+
+    def nbytes(self):
+        return self.hourly.nbytes() + super().nbytes() + sum(v.nbytes() for v in list(self.views.values()))
+
+    def to_dict(self):
+        return {
+            "metadata": self.metadata,
+            "data": self.hourly.to_dict(),
+            "status": self.status,
+        }
+
+class View(Encoded):
+    # a projection of a forecast, shares its metadata, status and columns
+    __slots__ = ("forecast", "projection")
+
+    def __init__(self, forecast, projection):
+        super().__init__()
+        self.forecast = forecast
+        self.projection = projection
+
+    @property
+    def created(self):
+        return self.forecast.created
+
+    def is_success(self):
+        return self.forecast.is_success()
+
+    def selection(self):
+        p = self.projection
+        return self.forecast.metadata, self.forecast.status, self.forecast.hourly, p.fields, p.start, p.end
+
+    def to_dict(self):
+        p = self.projection
+        return {
+            "metadata": self.forecast.metadata,
+            "data": self.forecast.hourly.to_dict(p.fields, p.start, p.end),
+            "status": self.forecast.status,
+        }
+
+def dump_column(column, blobs):
+    # layout of column for the dumps() header, its arrays are appended to blobs
+    state = {"hours": len(column.present), "integral": column.integral}
+    blobs.append(bytes(column.present))
+    if isinstance(column.values, array):
+        blobs.append(column.values.tobytes())
+    else:
+        # strings (or None) per hour
+        state["strings"] = column.values
+    return state
+
+def load_column(state, data, offset):
+    # (Column, offset past its arrays) from the bytes dump_column appended at offset
+    hours = state["hours"]
+    column = Column.__new__(Column)
+    column.present = bytearray(data[offset:offset + hours])
+    offset += hours
+    if "strings" in state:
+        column.values = list(state["strings"])
+    else:
+        size = hours * 8
+        column.values = array('d')
+        column.values.frombytes(data[offset:offset + size])
+        offset += size
+    if len(column.present) != hours or len(column.values) != hours:
+        raise ValueError("truncated forecast dump")
+    column.integral = bool(state["integral"])
+    return column, offset
+
+def dumps(forecast):
+    hourly = forecast.hourly
+    blobs = []
+    dt = dump_column(hourly.dt, blobs)
+    columns = [[field, dump_column(column, blobs)] for field, column in hourly.columns.items()]
+    header = json.dumps({
+        "metadata": forecast.metadata,
+        "status": forecast.status,
+        "created": forecast.created,
+        "units": hourly.units,
+        # only the utc offset of the timezone is kept, it is all that is used for dates
+        "offset": hourly.tz.utcoffset(None).total_seconds() if hourly.tz is not None else None,
+        "dt": dt,
+        "columns": columns,
+    }).encode()
+    return HEADER.pack(DUMP_MAGIC, DUMP_VERSION, len(header)) + header + b"".join(blobs)
+
+def loads(data):
+    # raises ValueError for bytes that aren't a dump of this version
+    if len(data) < HEADER.size:
+        raise ValueError("not a forecast dump")
+    magic, version, length = HEADER.unpack_from(data)
+    if magic != DUMP_MAGIC:
+        raise ValueError("not a forecast dump")
+    if version != DUMP_VERSION:
+        raise ValueError(f"unsupported forecast dump version: {version}")
+    offset = HEADER.size + length
+    state = json.loads(data[HEADER.size:offset])
+    dt, offset = load_column(state["dt"], data, offset)
+    columns = {}
+    for field, c in state["columns"]:
+        columns[field], offset = load_column(c, data, offset)
+    offset_seconds = state["offset"]
+    tz = datetime.timezone(datetime.timedelta(seconds=offset_seconds)) if offset_seconds is not None else None
+    forecast = Forecast(state["metadata"], state["status"], Hourly(dt, columns, state["units"], tz))
+    forecast.created = state["created"]
+    return forecast
@@ -0,0 +1,520 @@
+import os
+import time
+import struct
+import tempfile
+import asyncio
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import utility
+import cachestore
+
+"""
+Forecast cache with stale-while-revalidate.
+
+Each entry has three windows, measured from when it was fetched:
+    ttl             fresh, served as-is
+    hard_ttl        stale, served immediately while a background refresh fetches a new value
+    stale_if_error  past hard_ttl the entry is only served if fetching a new value fails
+
+get() (or get_async() on the asyncio path) returns the value and how it was served:
+"hit", "stale", "miss" or "error" (stale served because the fetch failed).
+
+The cache is bounded by max_entries and max_bytes, the least recently used entries are evicted
+first. An entry's size is measured when it is set and again when it is served, so bytes a value
+gains after it is cached (i.e. a forecast's serialized bodies) are counted.
+
+With backend: sqlite the in-memory entries are a tier in front of a store shared by all workers on
+the host (see cachestore.py). A worker that isn't fresh in memory checks the store for a newer
+entry before going upstream, and takes the key's lock before fetching, so one worker fetches
+while the rest wait for its result ("shared"). Stale refreshes are claimed the same way. Entries
+keep the time they were fetched so every worker expires them at the same time. The store is
+queried on the event loop on the asyncio path, lookups are by primary key on a local file.
+
+Listeners added with listen() are called with (key, value) every time an entry is set, on
+whichever thread set it, so subscribers (see subscribe.py) hear about a refreshed forecast
+without polling. They must be quick and never raise.
+
+save() writes the usable entries to a snapshot file and restore() reads one back at startup, see
+snapshot.py. Restored forecasts stay encoded until first asked for and keep the time they were
+fetched, so a forecast that aged past ttl while the service was down is served stale and
+refreshed. Keys are stored hashed, the snapshot has no apikeys in it. The file is a header then
+one record per entry (hashed key, time fetched, forecast.dumps bytes), nothing in it is executed
+when read. Each save writes a temp file of its own and renames it over path, so workers saving
+to the same path never write into each other's file, the last rename wins.
+
+Metrics:
+    weatherService_forecast_cache_entries
+    weatherService_forecast_cache_bytes
+    weatherService_forecast_cache_eviction_total{reason}
+    weatherService_forecast_cache_restored_total
+    weatherService_first_cached_response_seconds
+"""
+
+DEFAULT_TTL=30 # seconds
+DEFAULT_HARD_TTL=300 # seconds
+DEFAULT_STALE_IF_ERROR=3600 # seconds
+DEFAULT_REFRESH_WORKERS=4
+DEFAULT_MAX_ENTRIES=10000
+DEFAULT_MAX_BYTES=256 * 1024 * 1024
+DEFAULT_BACKEND="memory"
+DEFAULT_LOCK_WAIT=10 # seconds to wait on another worker's fetch before fetching anyway
+LOCK_POLL=0.05 # seconds
+
+# bumped when the snapshot layout changes, older snapshots are ignored
+SNAPSHOT_VERSION=2
+SNAPSHOT_MAGIC=b"WSCS"
+SNAPSHOT_HEADER=struct.Struct("<4sB")
+# hashed key (sha1 hex), fetched, length of the value that follows
+SNAPSHOT_RECORD=struct.Struct("<40sdI")
+
+class Entry:
+    def __init__(self, value, fetched, ttl, hard_ttl, stale_if_error):
+        self.value = value
+        self.fetched = fetched
+        self.soft_expires = fetched + ttl
+        self.hard_expires = fetched + hard_ttl
+        self.error_expires = self.hard_expires + stale_if_error
+        self.refreshing = False
+        self.size = 0
+
+class ForecastCache:
+    def __init__(self, ttl=DEFAULT_TTL, hard_ttl=DEFAULT_HARD_TTL, stale_if_error=DEFAULT_STALE_IF_ERROR, refresh_workers=DEFAULT_REFRESH_WORKERS, usable=None, size=None, dumps=None, loads=None):
+        # least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.mutex = Lock()
+        self.last_prune = time.time()
+        # a value that isn't usable (i.e. upstream failure) never replaces a usable stale value
+        self.usable = usable if usable is not None else lambda value: True
+        # bytes held by a value, counted against max_bytes
+        self.size = size if size is not None else lambda value: 0
+        # value to bytes and back, needed for a shared store
+        self.dumps = dumps
+        self.loads = loads
+        self.store = None
+        self.lock_wait = DEFAULT_LOCK_WAIT
+        # hashed key -> (fetched, dumped value) read from a snapshot and not yet asked for
+        self.restored = {}
+        # for time to first cached response since start
+        self.started = time.time()
+        self.first_cached = None
+        self.executor = None
+        self.tasks = set()
+        # called with (key, value) on every set
+        self.listeners = []
+        self.configure({
+            "ttl": ttl,
+            "hard_ttl": hard_ttl,
+            "stale_if_error": stale_if_error,
+            "refresh_workers": refresh_workers,
+        })
+
+    def configure(self, config):
+        self.ttl = config.get("ttl", DEFAULT_TTL)
+        # hard_ttl below ttl would mean never serving stale, which is the same as hard_ttl == ttl
+        self.hard_ttl = max(config.get("hard_ttl", DEFAULT_HARD_TTL), self.ttl)
+        self.stale_if_error = config.get("stale_if_error", DEFAULT_STALE_IF_ERROR)
+        self.max_entries = config.get("max_entries", DEFAULT_MAX_ENTRIES)
+        self.max_bytes = config.get("max_bytes", DEFAULT_MAX_BYTES)
+        workers = config.get("refresh_workers", DEFAULT_REFRESH_WORKERS)
+        if self.executor is None or self.executor._max_workers != workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="forecast-refresh")
+        backend = config.get("backend", DEFAULT_BACKEND)
+        if backend == "sqlite":
+            c = config.get("sqlite") or {}
+            path = c.get("path", cachestore.DEFAULT_PATH)
+            lock_ttl = c.get("lock_ttl", cachestore.DEFAULT_LOCK_TTL)
+            # configured once per source with the same settings, they all share one store
+            if self.store is None or self.store.path != path or self.store.lock_ttl != lock_ttl:
+                self.store = cachestore.SqliteStore(path=path, lock_ttl=lock_ttl)
+            self.lock_wait = c.get("lock_wait", DEFAULT_LOCK_WAIT)
+        elif backend == "memory":
+            self.store = None
+        else:
+            raise ValueError(f"unknown cache backend: {backend}")
+        with self.mutex:
+            self.__evict()
+
+    def __lookup(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and now < entry.soft_expires:
+            self.__touch(key, entry)
+            return entry, "hit"
+        if entry is None and self.restored:
+            entry = self.__restore_entry(key)
+            if entry is not None and now < entry.soft_expires:
+                return entry, "hit"
+        if self.store is not None:
+            # another worker may have fetched it since
+            entry = self.__newer_shared(key, entry) or entry
+            if entry is not None and now < entry.soft_expires:
+                return entry, "hit"
+        if entry is not None and now < entry.hard_expires:
+            self.__touch(key, entry)
+            return entry, "stale"
+        return entry, "miss"
+
+    def __touch(self, key, entry):
+        # mark most recently used and re-measure, the value may have grown since it was set
+        size = self.size(entry.value)
+        with self.mutex:
+            if self.entries.get(key) is not entry:
+                # replaced or evicted since it was looked up
+                return
+            self.entries.move_to_end(key)
+            if size != entry.size:
+                self.bytes += size - entry.size
+                entry.size = size
+                self.__evict()
+
+    def __evict(self):
+        # called holding the mutex, always keeps the most recently used entry
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry.size
+            utility.inc("weatherService_forecast_cache_eviction_total", {"reason": "size"})
+        self.__update_metrics()
+
+    def __update_metrics(self):
+        utility.set("weatherService_forecast_cache_entries", len(self.entries), {})
+        utility.set("weatherService_forecast_cache_bytes", self.bytes, {})
+
+    def __on_error(self, key, entry, e):
+        if entry is not None and time.time() < entry.error_expires and self.usable(entry.value):
+            print(f"Serving stale forecast for {key[:3]} after error: {e}")
+            return entry.value, "error"
+        raise e
+
+    def __on_value(self, key, entry, value):
+        if not self.usable(value) and entry is not None and time.time() < entry.error_expires and self.usable(entry.value):
+            return entry.value, "error"
+        self.set(key, value)
+        return value, "miss"
+
+    def __restore_entry(self, key):
+        record = self.restored.pop(cachestore.hashed_key(key), None)
+        if record is None:
+            return None
+        fetched, data = record
+        try:
+            value = self.loads(data)
+        except Exception as e:
+            print(f"Restoring cached forecast failed for {key[:3]}: {e}")
+            return None
+        utility.inc("weatherService_forecast_cache_restored_total", {})
+        return self.set(key, value, fetched, share=False)
+
+    def save(self, path):
+        # writes every usable entry (and restored ones not asked for yet) to path, returns the count
+        now = time.time()
+        with self.mutex:
+            entries = list(self.entries.items())
+        records = dict(self.restored)
+        for key, entry in entries:
+            if now < entry.error_expires and self.usable(entry.value):
+                records[cachestore.hashed_key(key)] = (entry.fetched, self.dumps(entry.value))
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp", delete=False) as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+            for k, (fetched, data) in records.items():
+                f.write(SNAPSHOT_RECORD.pack(k.encode(), fetched, len(data)))
+                f.write(data)
+        try:
+            os.replace(f.name, path)
+        except Exception as e:
+            os.unlink(f.name)
+            raise e
+        return len(records)
+
+    def restore(self, path):
+        # reads a snapshot written by save(), values are decoded when first asked for. returns the count
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < SNAPSHOT_HEADER.size or data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            print(f"Ignoring cache snapshot {path}, not a snapshot")
+            return 0
+        _, version = SNAPSHOT_HEADER.unpack_from(data)
+        if version != SNAPSHOT_VERSION:
+            print(f"Ignoring cache snapshot {path} with version {version}")
+            return 0
+        records = {}
+        offset = SNAPSHOT_HEADER.size
+        while offset < len(data):
+            if offset + SNAPSHOT_RECORD.size > len(data):
+                raise ValueError(f"truncated cache snapshot {path}")
+            k, fetched, length = SNAPSHOT_RECORD.unpack_from(data, offset)
+            offset += SNAPSHOT_RECORD.size
+            if offset + length > len(data):
+                raise ValueError(f"truncated cache snapshot {path}")
+            records[k.decode()] = (fetched, data[offset:offset + length])
+            offset += length
+        # anything past stale_if_error can never be served
+        oldest = time.time() - self.hard_ttl - self.stale_if_error
+        self.restored = {k: r for k, r in records.items() if r[0] > oldest}
+        return len(self.restored)
+
+    def __cached(self, state):
+        # first response not waiting on upstream since start, how long a restart is slow for
+        if self.first_cached is None and state != "miss" and state != "error":
+            self.first_cached = time.time() - self.started
+            utility.set("weatherService_first_cached_response_seconds", self.first_cached, {})
+
+    def __newer_shared(self, key, entry):
+        # the store's entry, now also in memory, if another worker put one fetched after entry
+        try:
+            row = self.store.get(self.store.key(key), entry.fetched if entry is not None else 0)
+            if row is None:
+                return None
+            fetched, data = row
+            value = self.loads(data)
+        except Exception as e:
+            print(f"Shared cache read failed for {key[:3]}: {e}")
+            return None
+        if time.time() >= fetched + self.hard_ttl:
+            return None
+        return self.set(key, value, fetched, share=False)
+
+    def __share(self, key, entry):
+        try:
+            self.store.put(self.store.key(key), entry.fetched, entry.error_expires, self.dumps(entry.value))
+        except Exception as e:
+            print(f"Shared cache write failed for {key[:3]}: {e}")
+
+    def __lock(self, skey):
+        try:
+            return self.store.lock(skey)
+        except Exception as e:
+            # no coordination without the store, fetch as if the lock was taken
+            print(f"Shared cache lock failed: {e}")
+            return True
+
+    def __unlock(self, skey):
+        try:
+            self.store.unlock(skey)
+        except Exception as e:
+            print(f"Shared cache unlock failed: {e}")
+
+    def __claim(self, key, entry):
+        # before a refresh: returns (refresh, store key with the lock held or None)
+        # refresh is False when another worker already refreshed it or is refreshing it now
+        if self.store is None:
+            return True, None
+        if self.__newer_shared(key, entry) is not None:
+            return False, None
+        skey = self.store.key(key)
+        if not self.__lock(skey):
+            return False, None
+        return True, skey
+
+    def __load(self, key, entry, loader):
+        try:
+            value = loader()
+        except Exception as e:
+            return self.__on_error(key, entry, e)
+        return self.__on_value(key, entry, value)
+
+    async def __load_async(self, key, entry, loader):
+        try:
+            value = await loader()
+        except Exception as e:
+            return self.__on_error(key, entry, e)
+        return self.__on_value(key, entry, value)
+
+    def __fetch(self, key, entry, loader):
+        # a miss: load it, unless another worker is already loading it, then wait for theirs
+        if self.store is None:
+            return self.__load(key, entry, loader)
+        skey = self.store.key(key)
+        deadline = time.time() + self.lock_wait
+        locked = self.__lock(skey)
+        while not locked and time.time() < deadline:
+            time.sleep(LOCK_POLL)
+            shared = self.__newer_shared(key, entry)
+            if shared is not None:
+                return shared.value, "shared"
+            locked = self.__lock(skey)
+        try:
+            if locked:
+                # put by another worker between the lookup and taking the lock
+                shared = self.__newer_shared(key, entry)
+                if shared is not None:
+                    return shared.value, "shared"
+            # past the deadline the holder is assumed stuck and this worker fetches too
+            return self.__load(key, entry, loader)
+        finally:
+            if locked:
+                self.__unlock(skey)
+
+    async def __fetch_async(self, key, entry, loader):
+        if self.store is None:
+            return await self.__load_async(key, entry, loader)
+        skey = self.store.key(key)
+        deadline = time.time() + self.lock_wait
+        locked = self.__lock(skey)
+        while not locked and time.time() < deadline:
+            await asyncio.sleep(LOCK_POLL)
+            shared = self.__newer_shared(key, entry)
+            if shared is not None:
+                return shared.value, "shared"
+            locked = self.__lock(skey)
+        try:
+            if locked:
+                shared = self.__newer_shared(key, entry)
+                if shared is not None:
+                    return shared.value, "shared"
+            return await self.__load_async(key, entry, loader)
+        finally:
+            if locked:
+                self.__unlock(skey)
+
+    def get(self, key, loader, refresher=None):
+        # refresher, if given, loads for background refreshes instead of loader
+        entry, state = self.__lookup(key)
+        if state == "hit":
+            self.__cached(state)
+            return entry.value, state
+        if state == "stale":
+            self.__cached(state)
+            self.__refresh_background(key, entry, refresher or loader)
+            return entry.value, state
+        value, state = self.__fetch(key, entry, loader)
+        self.__cached(state)
+        return value, state
+
+    async def get_async(self, key, loader, refresher=None):
+        # same as get, loader is a coroutine function and refreshes run as tasks on the running loop
+        entry, state = self.__lookup(key)
+        if state == "hit":
+            self.__cached(state)
+            return entry.value, state
+        if state == "stale":
+            self.__cached(state)
+            if self.__start_refresh(entry):
+                task = asyncio.get_running_loop().create_task(self.__refresh_async(key, entry, refresher or loader))
+                # the loop only keeps a weak reference to tasks
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            return entry.value, state
+        value, state = await self.__fetch_async(key, entry, loader)
+        self.__cached(state)
+        return value, state
+
+    def refresh(self, key, loader):
+        # load now regardless of freshness, returns (value, error): what the cache holds afterwards
+        # and the loader's error if it failed. a failed refresh keeps serving the cached entry
+        entry = self.entries.get(key)
+        skey = None
+        try:
+            refresh, skey = self.__claim(key, entry)
+            if not refresh:
+                entry = self.entries.get(key, entry)
+                if entry is None:
+                    # another worker is fetching it and there is nothing to return yet, wait for it
+                    return self.__fetch(key, entry, loader)[0], None
+                return entry.value, None
+            value = loader()
+        except Exception as e:
+            print(f"Refresh failed for {key[:3]}: {e}")
+            entry = self.entries.get(key, entry)
+            return (entry.value if entry is not None else None), e
+        finally:
+            if skey is not None:
+                self.__unlock(skey)
+        if entry is None:
+            self.set(key, value)
+            return value, None
+        self.__refreshed(key, entry, value)
+        return self.entries.get(key, entry).value, None
+
+    def listen(self, listener):
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def unlisten(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def set(self, key, value, fetched=None, share=True):
+        # share=False for an entry that came from the shared store
+        if fetched is None:
+            fetched = time.time()
+        entry = Entry(value, fetched, self.ttl, self.hard_ttl, self.stale_if_error)
+        entry.size = self.size(value)
+        with self.mutex:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self.entries[key] = entry
+            self.bytes += entry.size
+            self.__evict()
+        if share and self.store is not None and self.usable(value):
+            self.__share(key, entry)
+        for listener in self.listeners:
+            listener(key, value)
+        self.__prune()
+        return entry
+
+    def __start_refresh(self, entry):
+        # only one refresh per entry at a time
+        with self.mutex:
+            if entry.refreshing:
+                return False
+            entry.refreshing = True
+            return True
+
+    def __refresh_background(self, key, entry, loader):
+        if self.__start_refresh(entry):
+            self.executor.submit(self.__refresh, key, entry, loader)
+
+    def __refreshed(self, key, entry, value):
+        if self.usable(value) or not self.usable(entry.value):
+            self.set(key, value)
+
+    def __refresh(self, key, entry, loader):
+        skey = None
+        try:
+            refresh, skey = self.__claim(key, entry)
+            if refresh:
+                self.__refreshed(key, entry, loader())
+        except Exception as e:
+            # keep serving what we have, the next request past hard_ttl will try again
+            print(f"Background refresh failed for {key[:3]}: {e}")
+        finally:
+            if skey is not None:
+                self.__unlock(skey)
+            entry.refreshing = False
+
+    async def __refresh_async(self, key, entry, loader):
+        skey = None
+        try:
+            refresh, skey = self.__claim(key, entry)
+            if refresh:
+                self.__refreshed(key, entry, await loader())
+        except Exception as e:
+            print(f"Background refresh failed for {key[:3]}: {e}")
+        finally:
+            if skey is not None:
+                self.__unlock(skey)
+            entry.refreshing = False
+
+    def __prune(self):
+        # drop entries that can never be served again, no more than once per ttl
+        now = time.time()
+        if now - self.last_prune < self.ttl:
+            return
+        with self.mutex:
+            self.last_prune = now
+            for k in [k for k, v in self.entries.items() if v.error_expires < now]:
+                self.bytes -= self.entries.pop(k).size
+                utility.inc("weatherService_forecast_cache_eviction_total", {"reason": "expired"})
+            self.__update_metrics()
+        if self.store is not None:
+            try:
+                self.store.prune()
+            except Exception as e:
+                print(f"Shared cache prune failed: {e}")
@@ -0,0 +1,129 @@
+import io
+import csv
+import json
+
+try:
+    import msgpack
+except ImportError:
+    # optional, the format isn't offered without it
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+"""
+Output formats of a forecast besides json, for bulk consumers. Picked with format= or the Accept
+header (see responses.negotiate_format), json stays the default.
+
+    json        the nested shape, {"data": {"<date>": {"<field>": {"value": ..., "uom": ...}}}}
+    msgpack     columnar: {"metadata", "status", "units": {field: uom}, "data": {column: [...]}}
+    csv         one row per hour: date,dt,<field>...   (units only in the other formats)
+    arrow       Arrow IPC stream, one row per hour. metadata and status are json in the schema
+                metadata, each field's unit is in its field metadata as "uom"
+
+The columnar formats have a date and a dt column then one column per field, null where the field
+has no value for the hour. They are encoded straight from the forecast's columns, the same way
+json is, and kept with the forecast as bytes (see forecast.Encoded).
+
+msgpack and arrow need the msgpack and pyarrow packages (in requirements.txt). A process without
+them still serves json and csv, and says so at startup (see missing()).
+"""
+
+JSON = "json"
+MSGPACK = "msgpack"
+CSV = "csv"
+ARROW = "arrow"
+
+CONTENT_TYPES = {
+    JSON: "text/json",
+    MSGPACK: "application/msgpack",
+    CSV: "text/csv",
+    ARROW: "application/vnd.apache.arrow.stream",
+}
+
+# Accept media types -> format
+MEDIA_TYPES = {
+    "text/json": JSON,
+    "application/json": JSON,
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    "text/csv": CSV,
+    "application/vnd.apache.arrow.stream": ARROW,
+}
+
+def available():
+    # formats this process can encode
+    names = [JSON, CSV]
+    if msgpack is not None:
+        names.append(MSGPACK)
+    if pyarrow is not None:
+        names.append(ARROW)
+    return names
+
+def missing():
+    # formats this process can't encode for want of their package
+    return [name for name in [MSGPACK, ARROW] if name not in available()]
+
+def table(encoded):
+    # (metadata, status, units, data) of a Forecast or View, data is {column: [value per hour]}
+    metadata, status, hourly, fields, start, end = encoded.selection()
+    hours, columns = hourly.table(fields, start, end)
+    data = {
+        "date": [hourly.date(i) for i in hours],
+        "dt": hourly.dt.take(hours),
+    }
+    for field, column, _ in columns:
+        data[field] = column.take(hours)
+    units = {field: uom for field, _, uom in columns}
+    return metadata, status, units, data
+
+def encode_msgpack(encoded):
+    metadata, status, units, data = table(encoded)
+    return msgpack.packb({
+        "metadata": metadata,
+        "status": status,
+        "units": units,
+        "data": data,
+    })
+
+def encode_csv(encoded):
+    _, _, _, data = table(encoded)
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(data.keys())
+    writer.writerows(zip(*data.values()))
+    return out.getvalue().encode()
+
+def encode_arrow(encoded):
+    metadata, status, units, data = table(encoded)
+    arrays = []
+    fields = []
+    for name, values in data.items():
+        array = pyarrow.array(values)
+        uom = units.get(name)
+        fields.append(pyarrow.field(name, array.type, metadata={"uom": uom} if uom is not None else None))
+        arrays.append(array)
+    schema = pyarrow.schema(fields, metadata={
+        "metadata": json.dumps(metadata),
+        "status": json.dumps(status),
+    })
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+    return sink.getvalue().to_pybytes()
+
+ENCODERS = {
+    MSGPACK: encode_msgpack,
+    CSV: encode_csv,
+    ARROW: encode_arrow,
+}
+
+def encode(name, encoded):
+    # bytes of a Forecast or View in a format other than json
+    if name not in available() or name not in ENCODERS:
+        raise ValueError(f"unsupported format: {name}")
+    return ENCODERS[name](encoded)
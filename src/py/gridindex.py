@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import atexit
+import tempfile
+from threading import Lock, Timer
+
+import utility
+
+"""
+Persistent index of weather.gov point (lat,lon at 0.01 degree) to grid (office, gridX, gridY).
+
+The mapping is stored as json on disk:
+    {
+        "<latitude>,<longitude>": {
+            "office": "BOX",
+            "gridX": 71,
+            "gridY": 90,
+            "forecastGridData": "https://api.weather.gov/gridpoints/BOX/71,90",
+            "updated": 1700000000.0
+        }
+    }
+
+A seed file in the same format can be provided to pre-populate the index.
+
+New entries are written save_delay seconds after the first one since the last save, on a timer
+thread, so a burst of new points is one write and put() never blocks on the disk (it is called on
+the event loop on the asyncio path). The file is replaced through a temp file of its own, and
+entries other workers saved in the meantime are merged in rather than overwritten.
+
+Metrics:
+    weatherService_grid_index_hit_total
+    weatherService_grid_index_miss_total
+    weatherService_grid_index_size
+"""
+
+DEFAULT_TTL=30*24*60*60 # 30 days
+DEFAULT_SAVE_DELAY=5 # seconds
+
+class GridIndex:
+    def __init__(self, path=None, ttl=DEFAULT_TTL, seed=None, save_delay=DEFAULT_SAVE_DELAY):
+        self.path = path
+        self.ttl = ttl
+        self.seed = seed
+        self.save_delay = save_delay
+        self.entries = {}
+        self.loaded = False
+        self.mutex = Lock()
+        # a save is scheduled for entries not yet on disk
+        self.dirty = False
+        # unsaved entries are written on shutdown
+        atexit.register(self.flush)
+
+    def key(self, latitude, longitude):
+        return f"{latitude},{longitude}"
+
+    def __read(self, filename):
+        if filename is None or not os.path.exists(filename):
+            return {}
+        try:
+            with open(filename, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            # a corrupt index is not fatal, it will be rebuilt from upstream
+            print(f"Unable to read grid index {filename}: {e}")
+            return {}
+
+    def load(self):
+        # read from disk, done on first use if not called before
+        if self.loaded:
+            return
+        with self.mutex:
+            if self.loaded:
+                return
+            now = time.time()
+            # seed first so anything persisted takes precedence
+            for source in [self.seed, self.path]:
+                for k, v in self.__read(source).items():
+                    if "updated" not in v:
+                        # seeded data may not have a timestamp, treat as fresh
+                        v["updated"] = now
+                    self.entries[k] = v
+            self.loaded = True
+            utility.set("weatherService_grid_index_size", len(self.entries), {})
+
+    def save(self):
+        if self.path is None:
+            return
+        # keep what other workers saved since this one loaded, the newer entry wins
+        saved = self.__read(self.path)
+        with self.mutex:
+            for k, v in saved.items():
+                entry = self.entries.get(k)
+                if entry is None or entry["updated"] < v.get("updated", 0):
+                    self.entries[k] = v
+            data = json.dumps(self.entries)
+        # write to a temp file of our own and rename so a crash or another writer never leaves a
+        # partial index
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix=f"{os.path.basename(self.path)}.", suffix=".tmp", delete=False) as f:
+            f.write(data)
+        try:
+            os.replace(f.name, self.path)
+        except Exception as e:
+            os.unlink(f.name)
+            raise e
+
+    def flush(self):
+        # save now if there is anything unsaved
+        with self.mutex:
+            if not self.dirty:
+                return
+            self.dirty = False
+        try:
+            self.save()
+        except Exception as e:
+            # failing to persist is not fatal, the index is still good in memory
+            print(f"Unable to save grid index {self.path}: {e}")
+
+    def __schedule_save(self):
+        if self.path is None:
+            return
+        with self.mutex:
+            if self.dirty:
+                # the scheduled save will include it
+                return
+            self.dirty = True
+        timer = Timer(self.save_delay, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def get(self, latitude, longitude):
+        self.load()
+        entry = self.entries.get(self.key(latitude, longitude))
+        if entry is None or entry["updated"] + self.ttl < time.time():
+            utility.inc("weatherService_grid_index_miss_total", {})
+            return None
+        utility.inc("weatherService_grid_index_hit_total", {})
+        return entry
+
+    def put(self, latitude, longitude, office, gridX, gridY, forecastGridData):
+        self.load()
+        entry = {
+            "office": office,
+            "gridX": gridX,
+            "gridY": gridY,
+            "forecastGridData": forecastGridData,
+            "updated": time.time(),
+        }
+        with self.mutex:
+            self.entries[self.key(latitude, longitude)] = entry
+            utility.set("weatherService_grid_index_size", len(self.entries), {})
+        self.__schedule_save()
+        return entry
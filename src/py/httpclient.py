@@ -0,0 +1,231 @@
+import json
+import asyncio
+import aiohttp
+import requests
+from collections import OrderedDict
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import utility
+
+"""
+HTTP client shared by all sources.
+
+One keep-alive session with a connection pool per upstream host, timeouts on every call,
+retry with backoff on 429/5xx, gzip negotiation and conditional requests: the ETag and
+Last-Modified of a response are remembered per url and sent back as If-None-Match and
+If-Modified-Since, a 304 returns the remembered response. Remembered responses are bounded by
+count and by bytes of body, they are held outside the forecast cache's max_bytes.
+
+A Retry-After from upstream is honored up to retry_after_max seconds, a longer one is not waited
+out in full: the circuit breaker and rate limiter fail fast rather than holding a worker.
+
+HttpClient is the blocking client used by the Flask server, AsyncHttpClient is the same
+for the asyncio path (see asgi.py). Both return responses with status_code, headers,
+content and json().
+
+Metrics:
+    weatherService_http_request_total{host,code}
+    weatherService_http_not_modified_total{host}
+"""
+
+DEFAULT_CONNECT_TIMEOUT=3.05 # seconds
+DEFAULT_READ_TIMEOUT=10 # seconds
+DEFAULT_POOL_HOSTS=10
+DEFAULT_POOL_MAXSIZE=10
+DEFAULT_RETRIES=2
+DEFAULT_BACKOFF_FACTOR=0.5
+DEFAULT_CONDITIONAL_CACHE_SIZE=1000
+DEFAULT_CONDITIONAL_CACHE_BYTES=32*1024*1024
+DEFAULT_RETRY_AFTER_MAX=10 # seconds
+DEFAULT_USER_AGENT="weather-service (https://github.com/jewzaam/weather-service)"
+RETRY_STATUS=[429, 500, 502, 503, 504]
+
+class HttpClient:
+    def __init__(self, config={}):
+        self.mutex = Lock()
+        # url -> last 200 response that had a validator (ETag or Last-Modified)
+        self.validated = OrderedDict()
+        # bytes of body held in validated
+        self.validated_bytes = 0
+        self.configure(config)
+
+    def configure(self, config):
+        self.timeout = (
+            config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+            config.get("read_timeout", DEFAULT_READ_TIMEOUT),
+        )
+        self.conditional_cache_size = config.get("conditional_cache_size", DEFAULT_CONDITIONAL_CACHE_SIZE)
+        self.conditional_cache_bytes = config.get("conditional_cache_bytes", DEFAULT_CONDITIONAL_CACHE_BYTES)
+
+        retry = Retry(
+            total=config.get("retries", DEFAULT_RETRIES),
+            backoff_factor=config.get("backoff_factor", DEFAULT_BACKOFF_FACTOR),
+            status_forcelist=RETRY_STATUS,
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
+            retry_after_max=config.get("retry_after_max", DEFAULT_RETRY_AFTER_MAX),
+            # hand back the last response, callers already handle non-200
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=config.get("pool_hosts", DEFAULT_POOL_HOSTS),
+            pool_maxsize=config.get("pool_maxsize", DEFAULT_POOL_MAXSIZE),
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            # api.weather.gov requires a User-Agent identifying the application
+            "User-Agent": config.get("user_agent", DEFAULT_USER_AGENT),
+            "Accept-Encoding": "gzip, deflate",
+        })
+        self.session = session
+
+    def conditional_headers(self, url):
+        headers = {}
+        previous = self.validated.get(url)
+        if previous is not None:
+            if "ETag" in previous.headers:
+                headers["If-None-Match"] = previous.headers["ETag"]
+            if "Last-Modified" in previous.headers:
+                headers["If-Modified-Since"] = previous.headers["Last-Modified"]
+        return headers
+
+    def handle_response(self, url, response):
+        host = requests.utils.urlparse(url).hostname
+        utility.inc("weatherService_http_request_total", {"host": host, "code": response.status_code})
+
+        previous = self.__touch(url) if response.status_code == 304 else None
+        if previous is not None:
+            utility.inc("weatherService_http_not_modified_total", {"host": host})
+            # freshness comes from the 304, the body from what we already have
+            for h in ["Date", "Expires", "Cache-Control"]:
+                if h in response.headers:
+                    previous.headers[h] = response.headers[h]
+            return previous
+
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            self.remember(url, response)
+
+        return response
+
+    def __touch(self, url):
+        # the remembered response for a 304, which makes it the most recently used
+        with self.mutex:
+            previous = self.validated.get(url)
+            if previous is not None:
+                self.validated.move_to_end(url)
+            return previous
+
+    def remember(self, url, response):
+        # keeps status, headers and body only, not the whole requests.Response
+        kept = Response(response.status_code, response.headers, response.content)
+        with self.mutex:
+            previous = self.validated.pop(url, None)
+            if previous is not None:
+                self.validated_bytes -= len(previous.content)
+            self.validated[url] = kept
+            self.validated_bytes += len(kept.content)
+            while self.validated and (len(self.validated) > self.conditional_cache_size or self.validated_bytes > self.conditional_cache_bytes):
+                _, evicted = self.validated.popitem(last=False)
+                self.validated_bytes -= len(evicted.content)
+
+    def get(self, url):
+        response = self.session.get(url, headers=self.conditional_headers(url), timeout=self.timeout)
+        response = self.handle_response(url, response)
+        if response.status_code == 304:
+            # what was validated against got evicted before the 304 came back, ask for the body
+            response = self.handle_response(url, self.session.get(url, timeout=self.timeout))
+        return response
+
+class Response:
+    # what the async client hands back, same attributes the sources use on a requests.Response
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncHttpClient(HttpClient):
+    def configure(self, config):
+        self.config = config
+        self.timeout = (
+            config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+            config.get("read_timeout", DEFAULT_READ_TIMEOUT),
+        )
+        self.conditional_cache_size = config.get("conditional_cache_size", DEFAULT_CONDITIONAL_CACHE_SIZE)
+        self.conditional_cache_bytes = config.get("conditional_cache_bytes", DEFAULT_CONDITIONAL_CACHE_BYTES)
+        self.retry_after_max = config.get("retry_after_max", DEFAULT_RETRY_AFTER_MAX)
+        self.retries = config.get("retries", DEFAULT_RETRIES)
+        self.backoff_factor = config.get("backoff_factor", DEFAULT_BACKOFF_FACTOR)
+        # an aiohttp session belongs to the event loop it was created on, create it on first use
+        self.session = None
+
+    def __get_session(self):
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.config.get("async_pool_maxsize", 0),
+                keepalive_timeout=30,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+                headers={
+                    "User-Agent": self.config.get("user_agent", DEFAULT_USER_AGENT),
+                    "Accept-Encoding": "gzip, deflate",
+                },
+            )
+            self.session_loop = loop
+        return self.session
+
+    async def get(self, url):
+        session = self.__get_session()
+        attempt = 0
+        conditional = True
+        while True:
+            try:
+                async with session.get(url, headers=self.conditional_headers(url) if conditional else {}) as r:
+                    response = Response(r.status, r.headers, await r.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise e
+                response = None
+
+            if response is not None and (response.status_code not in RETRY_STATUS or attempt >= self.retries):
+                response = self.handle_response(url, response)
+                if response.status_code != 304 or not conditional:
+                    return response
+                # what was validated against got evicted before the 304 came back, ask for the body
+                conditional = False
+                continue
+
+            # same backoff as urllib3's Retry, honoring Retry-After up to retry_after_max
+            delay = self.backoff_factor * (2 ** attempt) if attempt > 0 else 0
+            if response is not None and response.headers.get("Retry-After", "").isdigit():
+                delay = min(int(response.headers["Retry-After"]), self.retry_after_max)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+client = HttpClient()
+async_client = AsyncHttpClient()
+
+def configure(config):
+    client.configure(config)
+    async_client.configure(config)
+
+def get(url):
+    return client.get(url)
+
+async def get_async(url):
+    return await async_client.get(url)
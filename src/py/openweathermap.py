@@ -1,22 +1,94 @@
-import requests
 import datetime
 
 import weather
+import ratelimit
+import circuitbreaker
+import stages
+from forecast import Forecast, Hourly, Column, MISSING
+
+API_BASE="https://api.openweathermap.org"
+
+def describe(conditions):
+    # weather is a list of conditions, each with a description, nearly always just one
+    if len(conditions) == 1:
+        return conditions[0].get("description", "")
+    return " ".join([c["description"] for c in conditions if "description" in c])
+
+# onecall hourly record keys to output fields, weather is a description with no unit
+MAPPINGS = [
+    weather.Mapping("temperature", "temp", "celsius"),
+    weather.Mapping("apparentTemperature", "feels_like", "celsius"),
+    weather.Mapping("dewpoint", "dew_point", "celsius"),
+    weather.Mapping("relativeHumidity", "humidity", "percent"),
+    weather.Mapping("skyCover", "clouds", "percent"),
+    weather.Mapping("windDirection", "wind_deg", "degrees"),
+    weather.Mapping("windSpeed", "wind_speed", "kph"),
+    weather.Mapping("windGust", "wind_gust", "kph"),
+    weather.Mapping("probabilityOfPrecipitation", "pop", "percent", upstream_uom="fraction"),
+    # rain wins when both are present
+    weather.Mapping("quantitativePrecipitation", ("snow", "1h"), "mm"),
+    weather.Mapping("quantitativePrecipitation", ("rain", "1h"), "mm"),
+    weather.Mapping("pressure", "pressure", "millibars"),
+    weather.Mapping("visibility", "visibility", "meters"),
+    weather.Mapping("weather", "weather", convert=describe),
+]
+
+NORMALIZER = weather.Normalizer(MAPPINGS)
+
+def column(hourly, mapping):
+    # the mapping's value for each hour, MISSING where the hour doesn't have it (i.e. no rain)
+    _, convert = NORMALIZER.converter(mapping.target)
+    key = mapping.source[0]
+    values = [data.get(key) for data in hourly]
+    for k in mapping.source[1:]:
+        values = [None if v is None else v.get(k) for v in values]
+    if convert is None:
+        return [MISSING if v is None else v for v in values]
+    return [MISSING if v is None else convert(v) for v in values]
+
+def columns(hourly):
+    # {field: column} for the onecall hourly records
+    columns = {}
+    for mapping in MAPPINGS:
+        values = column(hourly, mapping)
+        previous = columns.get(mapping.target)
+        if previous is not None:
+            # a later mapping of the same field wins where it has a value
+            values = [p if v is MISSING else v for p, v in zip(previous, values)]
+        columns[mapping.target] = values
+    return columns
 
 class OpenWeatherMap(weather.Weather):
     def __init__(self):
         self.set_source("openweathermap.org")
+        self.api_base = API_BASE
+
+    def configure(self, config):
+        super().configure(config)
+        # a section left with only comments under it loads as None
+        section = config.get("openweathermap") or {}
+        self.api_base = section.get("api_base") or API_BASE
+        self.limiter = ratelimit.limiter(self.get_source(), config.get("ratelimit") or {}, "openweathermap")
+        self.breaker = circuitbreaker.breaker(self.get_source(), config.get("circuitbreaker") or {}, "openweathermap")
 
     def get_required_paramters(self):
         return [
             "apikey",
         ]
 
-    def get_forecast_implementation(self, latitude, longitude, parameters):
+    def get_key_parameters(self):
+        return [
+            "apikey",
+        ]
+
+    def url_stage(self, url):
+        return "onecall"
+
+    def fetch_forecast(self, latitude, longitude, parameters):
         # already have validated in parent class that required params are included, blindly use them
         apikey = parameters["apikey"]
 
-        request_url_onecall = f"https://api.openweathermap.org/data/3.0/onecall?appid={apikey}&lat={latitude}&lon={longitude}&exclude=minutely,daily,current&units=metric"
+        request_url_onecall = f"{self.api_base}/data/3.0/onecall?appid={apikey}&lat={latitude}&lon={longitude}&exclude=minutely,daily,current&units=metric"
 
         output = {
             "metadata": {
@@ -26,7 +98,6 @@ class OpenWeatherMap(weather.Weather):
                 ],
                 "coordinates": [latitude, longitude],
             },
-            "data": {},
             "status": {
                 "success": "true",
                 "requested": str(datetime.datetime.now()),
@@ -34,127 +105,28 @@ class OpenWeatherMap(weather.Weather):
         }
 
         # get the data
-        response = requests.get(request_url_onecall)
+        response = yield request_url_onecall
 
         if response.status_code != 200:
             output["status"]["success"] = "false"
             output["status"]["http_response_code"] = response.status_code
             output["status"]["http_request_url"] = request_url_onecall
             output["status"]["responded"] = str(datetime.datetime.now())
-            return output
+            return Forecast(output["metadata"], output["status"])
         else:
-            hourly = response.json()["hourly"]
-
-            for data in hourly:
-                # output for each timestamp will include the following
-                #   temperature
-                #   apparentTemperature
-                #   dewpoint
-                #   relativeHumidity
-                #   skyCover
-                #   windDirection
-                #   windSpeed
-                #   windGust
-                #   probabilityOfPrecipitation
-                #   quantitativePrecipitation
-                #   pressure
-                #   visibility
-                #   weather
-
-                # the key for output is the date
-                validTime=datetime.datetime.fromtimestamp(data["dt"], datetime.timezone.utc)
-
-                # and that date as the key in object must be consistent
-                o_key=self.output_date(validTime, 0)
-                output["data"][o_key] = {
-                    "dt": data["dt"],
-                }
-
-                if "temp" in data and data["temp"] is not None:
-                    output["data"][o_key]["temperature"] = {
-                        "value": data["temp"],
-                        "uom": "celsius",
-                    }
-
-                if "feels_like" in data and data["feels_like"] is not None:
-                    output["data"][o_key]["apparentTemperature"] = {
-                        "value": data["feels_like"],
-                        "uom": "celsius",
-                    }
-
-                if "dew_point" in data and data["dew_point"] is not None:
-                    output["data"][o_key]["dewpoint"] = {
-                        "value": data["dew_point"],
-                        "uom": "celsius",
-                    }
-
-                if "humidity" in data and data["humidity"] is not None:
-                    output["data"][o_key]["relativeHumidity"] = {
-                        "value": data["humidity"],
-                        "uom": "percent",
-                    }
-
-                if "clouds" in data and data["clouds"] is not None:
-                    output["data"][o_key]["skyCover"] = {
-                        "value": data["clouds"],
-                        "uom": "percent",
-                    }
-
-                if "wind_deg" in data and data["wind_deg"] is not None:
-                    output["data"][o_key]["windDirection"] = {
-                        "value": data["wind_deg"],
-                        "uom": "degrees",
-                    }
-
-                if "wind_speed" in data and data["wind_speed"] is not None:
-                    output["data"][o_key]["windSpeed"] = {
-                        "value": data["wind_speed"],
-                        "uom": "kph",
-                    }
-
-                if "wind_gust" in data and data["wind_gust"] is not None:
-                    output["data"][o_key]["windGust"] = {
-                        "value": data["wind_gust"],
-                        "uom": "kph",
-                    }
-
-                if "pop" in data and data["pop"] is not None:
-                    output["data"][o_key]["probabilityOfPrecipitation"] = {
-                        "value": data["pop"] * 100,
-                        "uom": "percent",
-                    }
-
-                if "snow" in data and data["snow"] is not None:
-                    output["data"][o_key]["quantitativePrecipitation"] = {
-                        "value": data["snow"]["1h"],
-                        "uom": "mm",
-                    }
-                if "rain" in data and data["rain"] is not None:
-                    output["data"][o_key]["quantitativePrecipitation"] = {
-                        "value": data["rain"]["1h"],
-                        "uom": "mm",
-                    }
-
-                if "pressure" in data and data["pressure"] is not None:
-                    output["data"][o_key]["pressure"] = {
-                        "value": data["pressure"],
-                        "uom": "millibars",
-                    }
-
-                if "visibility" in data and data["visibility"] is not None:
-                    output["data"][o_key]["visibility"] = {
-                        "value": data["visibility"],
-                        "uom": "meters",
-                    }
-
-                if "weather" in data and data["weather"] is not None:
-                    w_value = ""
-                    for w in data["weather"]:
-                        if "description" in w:
-                            w_value+=w["description"] + " "
-                    output["data"][o_key]["weather"] = {
-                        "value": w_value.strip(),
-                    }
-
+            with stages.timed(self.get_source(), "parse"):
+                hourly = self.parse_onecall(response.json())
             output["status"]["responded"] = str(datetime.datetime.now())
-            return output
\ No newline at end of file
+            return Forecast(output["metadata"], output["status"], hourly)
+
+    def parse_onecall(self, onecall):
+        # onecall response to an Hourly
+        hourly = onecall["hourly"]
+
+        # the key for output is the date, built from dt when serialized
+        dt = [data["dt"] for data in hourly]
+        fields = columns(hourly)
+
+        # a field upstream never sent isn't output at all
+        fields = {field: Column(values) for field, values in fields.items() if values.count(MISSING) < len(values)}
+        return Hourly(Column(dt), fields, NORMALIZER.units)
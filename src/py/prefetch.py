@@ -0,0 +1,292 @@
+import time
+import heapq
+import random
+import itertools
+from collections import deque
+from threading import Thread, Condition
+from concurrent.futures import ThreadPoolExecutor
+
+import utility
+import weather
+
+"""
+Keep the cache warm for hot locations so no request has to wait on upstream.
+
+Locations come from the prefetch section of the config and, optionally, are learned from the
+locations requested most over a recent window, and from forecasts with subscribers (see
+subscribe.py), which are kept refreshed until the last subscriber leaves. Each (location, source) is refreshed every
+interval (spread by +/- jitter), with at most concurrency refreshes in flight. A refresh that
+fails backs off exponentially up to max_backoff before trying again.
+
+    prefetch:
+      interval: 30
+      jitter: 0.1
+      concurrency: 4
+      backoff: 30
+      max_backoff: 600
+      locations:
+        - latitude: 42.36
+          longitude: -71.06
+          sources: [weathergov]   # default: all sources
+          parameters: {}          # i.e. apikey for openweathermap
+          interval: 60            # default: prefetch.interval
+      learn:
+        top: 300                  # most requested locations kept warm
+        min_requests: 5           # requests within window to count as hot
+        window: 3600
+        update_interval: 60
+
+Metrics:
+    weatherService_prefetch_success_total{source}
+    weatherService_prefetch_error_total{source}
+    weatherService_prefetch_targets{origin}
+"""
+
+DEFAULT_INTERVAL=30 # seconds
+DEFAULT_JITTER=0.1 # fraction of the interval
+DEFAULT_CONCURRENCY=4
+DEFAULT_BACKOFF=30 # seconds
+DEFAULT_MAX_BACKOFF=600 # seconds
+DEFAULT_LEARN_TOP=300
+DEFAULT_LEARN_MIN_REQUESTS=5
+DEFAULT_LEARN_WINDOW=3600 # seconds
+DEFAULT_LEARN_UPDATE_INTERVAL=60 # seconds
+
+class Target:
+    def __init__(self, source, latitude, longitude, parameters, interval, origin):
+        self.source = source
+        self.latitude = latitude
+        self.longitude = longitude
+        self.parameters = parameters
+        self.interval = interval
+        # "configured" or "learned"
+        self.origin = origin
+        self.failures = 0
+        self.removed = False
+
+class HotSet:
+    # request counts per cache key over a sliding window of buckets
+    def __init__(self, config):
+        self.top = config.get("top", DEFAULT_LEARN_TOP)
+        self.min_requests = config.get("min_requests", DEFAULT_LEARN_MIN_REQUESTS)
+        self.window = config.get("window", DEFAULT_LEARN_WINDOW)
+        self.update_interval = config.get("update_interval", DEFAULT_LEARN_UPDATE_INTERVAL)
+        # a bucket per update_interval, the oldest drops out as a new one starts
+        self.buckets = deque([{}], maxlen=max(1, int(self.window // self.update_interval)))
+        # bounds memory if someone walks random coordinates
+        self.max_keys = 10 * self.top
+
+    def record(self, source, key):
+        # on the request path, a lost count under a race doesn't matter
+        counts = self.buckets[-1]
+        entry = (source, key)
+        count = counts.get(entry)
+        if count is not None:
+            counts[entry] = count + 1
+        elif len(counts) < self.max_keys:
+            counts[entry] = 1
+
+    def rotate(self):
+        # returns [(source, key)] of the hottest entries over the window and starts a new bucket
+        totals = {}
+        for counts in list(self.buckets):
+            for entry, count in list(counts.items()):
+                totals[entry] = totals.get(entry, 0) + count
+        self.buckets.append({})
+        hot = [e for e, c in totals.items() if c >= self.min_requests]
+        hot.sort(key=lambda e: totals[e], reverse=True)
+        return hot[:self.top]
+
+class Prefetcher:
+    def __init__(self, config, sources):
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.jitter = config.get("jitter", DEFAULT_JITTER)
+        self.concurrency = config.get("concurrency", DEFAULT_CONCURRENCY)
+        self.backoff = config.get("backoff", DEFAULT_BACKOFF)
+        self.max_backoff = config.get("max_backoff", DEFAULT_MAX_BACKOFF)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="prefetch")
+        self.condition = Condition()
+        # (due, sequence, target), sequence breaks ties so targets are never compared
+        self.queue = []
+        self.sequence = itertools.count()
+        self.inflight = 0
+        self.running = False
+        self.thread = None
+        # (source, cache key) of configured targets, never learned again
+        self.configured = set()
+        # (source, cache key) -> learned Target
+        self.learned = {}
+        # (source, cache key) -> subscribed Target
+        self.subscribed = {}
+        self.hot = None
+        self.next_learn = None
+
+        for location in config.get("locations", []):
+            names = location.get("sources", list(sources.keys()))
+            for name in names:
+                if name not in sources:
+                    print(f"Prefetch skipping unknown source: {name}")
+                    continue
+                target = Target(
+                    sources[name],
+                    location["latitude"],
+                    location["longitude"],
+                    location.get("parameters", {}),
+                    location.get("interval", self.interval),
+                    "configured",
+                )
+                self.configured.add((target.source, target.source.cache_key(target.latitude, target.longitude, target.parameters)))
+                self.add(target)
+        utility.set("weatherService_prefetch_targets", len(self.configured), {"origin": "configured"})
+
+        if "learn" in config:
+            self.hot = HotSet(config.get("learn") or {})
+            self.next_learn = time.time() + self.hot.update_interval
+
+    def is_empty(self):
+        return len(self.queue) == 0 and self.hot is None
+
+    def spread(self, seconds):
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def add(self, target, delay=None):
+        # first refresh lands within the jitter of now so a fresh start warms up quickly
+        if delay is None:
+            delay = random.uniform(0, self.jitter * target.interval)
+        with self.condition:
+            heapq.heappush(self.queue, (time.time() + delay, next(self.sequence), target))
+            self.condition.notify()
+
+    def watch(self, source, key, interval):
+        # keeps a forecast with subscribers refreshed, returns the Target for unwatch or None if a
+        # configured target already refreshes it. the subscriber was just served the forecast so
+        # the first refresh is an interval away
+        entry = (source, key)
+        if entry in self.configured:
+            return None
+        _, latitude, longitude, keyed = key
+        target = Target(source, latitude, longitude, dict(keyed), interval, "subscribed")
+        with self.condition:
+            self.subscribed[entry] = target
+        # a learned target for the same forecast stops once it is no longer requested
+        self.add(target, self.spread(interval))
+        utility.set("weatherService_prefetch_targets", len(self.subscribed), {"origin": "subscribed"})
+        self.start()
+        return target
+
+    def unwatch(self, target):
+        # stops after its refresh in flight (if any)
+        if target is None:
+            return
+        target.removed = True
+        entry = (target.source, target.source.cache_key(target.latitude, target.longitude, target.parameters))
+        with self.condition:
+            if self.subscribed.get(entry) is target:
+                del self.subscribed[entry]
+        utility.set("weatherService_prefetch_targets", len(self.subscribed), {"origin": "subscribed"})
+
+    def start(self):
+        if self.running or self.is_empty():
+            return
+        self.running = True
+        if self.hot is not None:
+            weather.Weather.hot = self.hot
+        self.thread = Thread(target=self.__run, name="prefetch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        weather.Weather.hot = None
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    now = time.time()
+                    wake = self.next_learn if self.next_learn is not None else now + 3600
+                    if self.queue and self.inflight < self.concurrency:
+                        if self.queue[0][0] <= now:
+                            break
+                        wake = min(wake, self.queue[0][0])
+                    if self.next_learn is not None and now >= self.next_learn:
+                        break
+                    self.condition.wait(max(0, wake - now))
+                if not self.running:
+                    return
+                target = None
+                if self.queue and self.inflight < self.concurrency and self.queue[0][0] <= time.time():
+                    _, _, target = heapq.heappop(self.queue)
+                    if target.removed:
+                        continue
+                    self.inflight += 1
+
+            if target is not None:
+                self.executor.submit(self.__refresh, target)
+            if self.next_learn is not None and time.time() >= self.next_learn:
+                self.__learn()
+
+    def __refresh(self, target):
+        source = target.source
+        try:
+            forecast = source.refresh(target.latitude, target.longitude, target.parameters)
+            if not forecast.is_success():
+                raise Exception(forecast.status.get("error", "unsuccessful forecast"))
+            target.failures = 0
+            delay = self.spread(target.interval)
+            source.counter("weatherService_prefetch_success_total").inc()
+        except Exception as e:
+            target.failures += 1
+            delay = self.spread(min(self.max_backoff, self.backoff * 2 ** (target.failures - 1)))
+            source.counter("weatherService_prefetch_error_total").inc()
+            print(f"Prefetch failed for {source.get_source()} {target.latitude},{target.longitude} ({target.failures} in a row): {e}")
+        finally:
+            with self.condition:
+                self.inflight -= 1
+                self.condition.notify()
+        if not target.removed:
+            self.add(target, delay)
+
+    def __learn(self):
+        self.next_learn = time.time() + self.hot.update_interval
+        hot = self.hot.rotate()
+        current = set(hot)
+        for entry in list(self.learned.keys()):
+            if entry not in current:
+                # cooled off, stops after its refresh in flight (if any)
+                self.learned.pop(entry).removed = True
+        for entry in hot:
+            if entry in self.learned or entry in self.configured or entry in self.subscribed:
+                continue
+            source, key = entry
+            _, latitude, longitude, keyed = key
+            target = Target(source, latitude, longitude, dict(keyed), self.interval, "learned")
+            self.learned[entry] = target
+            self.add(target)
+        utility.set("weatherService_prefetch_targets", len(self.learned), {"origin": "learned"})
+
+prefetcher = None
+
+def configure(config, sources):
+    global prefetcher
+    if prefetcher is not None:
+        prefetcher.stop()
+    prefetcher = Prefetcher(config, sources)
+
+def start():
+    if prefetcher is not None:
+        prefetcher.start()
+
+def watch(source, key, interval):
+    if prefetcher is None:
+        return None
+    return prefetcher.watch(source, key, interval)
+
+def unwatch(target):
+    if prefetcher is not None:
+        prefetcher.unwatch(target)
+
+def stop():
+    if prefetcher is not None:
+        prefetcher.stop()
@@ -0,0 +1,90 @@
+import time
+import datetime
+from werkzeug.datastructures import ImmutableMultiDict
+
+"""
+Limit a /forecast response to some fields and a window of hours.
+
+    /forecast/<lat>/<lon>?source=weathergov&fields=temperature,skyCover&hours=6
+    /forecast/<lat>/<lon>?source=weathergov&start=2024-05-01T12:00:00Z&hours=24
+
+    fields  comma separated (or repeated) field names, dt is always included
+    start   first hour, ISO 8601 or epoch seconds, rounded down to the hour.
+            defaults to the current hour when hours is given
+    hours   number of hours from start
+
+These parameters never reach the source, so every projection of a location shares one cached
+fetch. The projection is applied when the cached forecast is serialized, see forecast.View.
+format (see formats.py) only shapes the response too, it is kept from the source the same way.
+"""
+
+PARAMETERS = ["fields", "start", "hours"]
+# every parameter that only shapes the response
+RESPONSE_PARAMETERS = PARAMETERS + ["format"]
+
+HOUR = 3600
+
+class Projection:
+    __slots__ = ("fields", "start", "end", "key")
+
+    def __init__(self, fields=None, start=None, end=None):
+        # fields: tuple of names or None for all, start/end: epoch seconds or None for unbounded
+        self.fields = fields
+        self.start = start
+        self.end = end
+        self.key = (fields, start, end)
+
+def floor_hour(timestamp):
+    return int(timestamp // HOUR * HOUR)
+
+def parse_start(value):
+    try:
+        return floor_hour(float(value))
+    except ValueError:
+        pass
+    try:
+        start = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError("start must be ISO 8601 or epoch seconds")
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=datetime.timezone.utc)
+    return floor_hour(start.timestamp())
+
+def parse(args):
+    # returns a Projection, or None if the whole forecast is asked for. raises ValueError
+    if not any(p in args for p in PARAMETERS):
+        return None
+
+    fields = None
+    if "fields" in args:
+        names = []
+        for value in args.getlist("fields"):
+            names.extend([f.strip() for f in value.split(",") if f.strip() != ""])
+        if len(names) == 0:
+            raise ValueError("fields must name at least one field")
+        # keep order, drop duplicates
+        fields = tuple(dict.fromkeys(names))
+
+    start = None
+    if "start" in args:
+        start = parse_start(args["start"])
+
+    end = None
+    if "hours" in args:
+        try:
+            hours = int(args["hours"])
+        except ValueError:
+            raise ValueError("hours must be an integer")
+        if hours < 1:
+            raise ValueError("hours must be at least 1")
+        if start is None:
+            start = floor_hour(time.time())
+        end = start + hours * HOUR
+
+    return Projection(fields, start, end)
+
+def upstream(args):
+    # the request arguments without the projection, what the source and its cache key see
+    if not any(p in args for p in RESPONSE_PARAMETERS):
+        return args
+    return ImmutableMultiDict([(k, v) for k, v in args.items(multi=True) if k not in RESPONSE_PARAMETERS])
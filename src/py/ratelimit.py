@@ -0,0 +1,143 @@
+import math
+import time
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+
+import utility
+
+"""
+Token bucket rate limiting of upstream calls, per source or per API key.
+
+Every upstream http call takes a token. A source configured with per: key gets a budget for each
+set of key parameters (i.e. each openweathermap apikey), per: source shares one budget. daily
+adds a second bucket refilling at daily/86400 per second for an upstream quota.
+
+Background calls (prefetch and stale refreshes) yield to requests: they only take a token while
+more than prefetch_reserve (fraction of the bucket) would be left. A call that can't get a token
+is not queued, it raises RateLimited right away and the caller gets the stale forecast if there
+is one, else a 429.
+
+    ratelimit:
+      prefetch_reserve: 0.5
+      openweathermap:
+        per: key
+        rate: 1       # tokens per second
+        burst: 20
+        daily: 1000
+      weathergov:
+        per: source
+        rate: 5
+        burst: 20
+
+Metrics:
+    weatherService_ratelimit_tokens{source,bucket,limit}
+    weatherService_ratelimit_limited_total{source,priority}
+"""
+
+USER = "user"
+BACKGROUND = "background"
+
+DEFAULT_PREFETCH_RESERVE=0.5
+# per key buckets kept, least recently used are dropped (and start full again if seen later)
+MAX_BUCKETS=1000
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        # seconds until a token is expected to be available
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, needed):
+        # seconds until tokens reaches needed
+        if self.tokens >= needed or self.rate <= 0:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+class Limiter:
+    def __init__(self, source, config, reserve=DEFAULT_PREFETCH_RESERVE):
+        self.source = source
+        self.per = config.get("per", "source")
+        self.limits = []
+        if "rate" in config:
+            self.limits.append(("rate", config["rate"], config.get("burst", max(1, config["rate"]))))
+        if "daily" in config:
+            self.limits.append(("daily", config["daily"] / 86400, config["daily"]))
+        self.reserve = reserve
+        # bucket name -> {limit: TokenBucket}
+        self.buckets = OrderedDict()
+        self.gauges = {}
+        self.mutex = Lock()
+
+    def bucket_name(self, parameters):
+        # never the apikey itself, the name ends up in metrics
+        if self.per != "key" or len(parameters) == 0:
+            return "source"
+        return hashlib.sha1(repr(sorted(parameters.items())).encode()).hexdigest()[:8]
+
+    def __buckets(self, name):
+        buckets = self.buckets.get(name)
+        if buckets is None:
+            buckets = {limit: TokenBucket(rate, burst) for limit, rate, burst in self.limits}
+            self.buckets[name] = buckets
+            while len(self.buckets) > MAX_BUCKETS:
+                dropped, _ = self.buckets.popitem(last=False)
+                for limit, _, _ in self.limits:
+                    self.gauges.pop((dropped, limit), None)
+                    utility.removeGauge("weatherService_ratelimit_tokens", {"source": self.source, "bucket": dropped, "limit": limit})
+        else:
+            self.buckets.move_to_end(name)
+        return buckets
+
+    def acquire(self, parameters, priority=USER):
+        # takes a token from every bucket for parameters or raises RateLimited
+        if len(self.limits) == 0:
+            return
+        name = self.bucket_name(parameters)
+        now = time.monotonic()
+        with self.mutex:
+            buckets = self.__buckets(name)
+            needed = {}
+            for limit, bucket in buckets.items():
+                bucket.refill(now)
+                reserve = self.reserve * bucket.burst if priority == BACKGROUND else 0
+                needed[limit] = reserve + 1
+            allowed = all(bucket.tokens >= needed[limit] for limit, bucket in buckets.items())
+            if allowed:
+                for bucket in buckets.values():
+                    bucket.tokens -= 1
+            retry_after = max(bucket.wait(needed[limit]) for limit, bucket in buckets.items())
+            for limit, bucket in buckets.items():
+                self.__gauge(name, limit).set(bucket.tokens)
+        if not allowed:
+            utility.inc("weatherService_ratelimit_limited_total", {"source": self.source, "priority": priority})
+            raise RateLimited(f"rate limited: {self.source}", retry_after)
+
+    def __gauge(self, name, limit):
+        gauge = self.gauges.get((name, limit))
+        if gauge is None:
+            gauge = utility.gauge("weatherService_ratelimit_tokens", {"source": self.source, "bucket": name, "limit": limit})
+            self.gauges[(name, limit)] = gauge
+        return gauge
+
+def limiter(source, config, name):
+    # the Limiter for source from the ratelimit section of the service config, None if not limited
+    section = config.get(name)
+    if section is None:
+        return None
+    return Limiter(source, section, config.get("prefetch_reserve", DEFAULT_PREFETCH_RESERVE))
+
+def retry_after_header(e):
+    # for any error with a retry_after in seconds
+    return str(max(1, math.ceil(e.retry_after)))
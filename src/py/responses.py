@@ -0,0 +1,93 @@
+import time
+
+import stages
+import formats
+import forecast
+
+"""
+Build the http response for a forecast, shared by the Flask and ASGI servers.
+
+Bodies come pre-serialized from the forecast (see forecast.Forecast.encode), in the format asked
+for with format= or Accept (see formats.py), compressed when the client accepts it, with a strong
+ETag so a poller sending If-None-Match gets a 304 and no body.
+"""
+
+def qualities(header):
+    # {name: q} of an Accept style header, in header order
+    accepted = {}
+    for part in (header or "").split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip().lower()
+        if name == "":
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+def negotiate_format(requested, accept):
+    # format= wins and must be one we have, else the most preferred format in Accept. json when
+    # Accept names none we have, as before there was a choice
+    if requested is not None:
+        if requested not in formats.available():
+            raise ValueError(f"unsupported format: {requested}, one of: {', '.join(formats.available())}")
+        return requested
+    accepted = qualities(accept)
+    available = formats.available()
+    for media_type in sorted(accepted, key=lambda m: accepted[m], reverse=True):
+        fmt = formats.MEDIA_TYPES.get(media_type)
+        if accepted[media_type] > 0 and fmt in available:
+            return fmt
+    return formats.JSON
+
+def negotiate_encoding(accept_encoding):
+    # first supported encoding the client accepts (q=0 means not acceptable), None for identity
+    accepted = qualities(accept_encoding)
+    for encoding in forecast.ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def etag_matches(if_none_match, etags):
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        # If-None-Match uses weak comparison
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in etags:
+            return True
+    return False
+
+def forecast_response(f, if_none_match, accept_encoding, ttl, source, fmt=formats.JSON):
+    # returns (code, headers, body), encoding time is the "serialize" stage of source
+    encoding = negotiate_encoding(accept_encoding)
+    # the tag hashes the uncompressed bytes, so on a first response it is where they get built
+    started = time.perf_counter()
+    etag = f.etag(encoding, fmt)
+    headers = {
+        "Content-Type": formats.CONTENT_TYPES[fmt],
+        "ETag": etag,
+        # fresh for what is left of its time in the cache
+        "Cache-Control": f"max-age={max(0, int(f.created + ttl - time.time()))}",
+        "Vary": "Accept-Encoding, Accept",
+    }
+    # a tag for any encoding of this forecast in this format means the client has it
+    etags = [f.etag(None, fmt)] + [f.etag(e, fmt) for e in forecast.ENCODINGS]
+    if etag_matches(if_none_match, etags):
+        stages.observe(source, "serialize", time.perf_counter() - started)
+        return 304, headers, b""
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    body = f.encode(encoding, fmt)
+    stages.observe(source, "serialize", time.perf_counter() - started)
+    return 200, headers, body
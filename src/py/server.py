@@ -1,10 +1,24 @@
+import sys
 import argparse
 import json
 import yaml
 import httpimport
 
+import weather
 import openweathermap
 import weathergov
+import httpclient
+import fanout
+import batch
+import responses
+import projection
+import prefetch
+import snapshot
+import ratelimit
+import circuitbreaker
+import stages
+import formats
+import subscribe
 
 from flask import Flask
 from flask import request
@@ -27,12 +41,47 @@ def help():
 def forecast(latitude, longitude):
     source = request.args.get('source')
     code=200
+    profile = stages.profiler.begin(request.full_path)
     try:
+        # fields/start/hours/format only shape the response, the source never sees them
+        selected = projection.parse(request.args)
+        fmt = responses.negotiate_format(request.args.get("format"), request.headers.get("Accept"))
+        args = projection.upstream(request.args)
+        names = fanout.requested_sources(args, sources)
+        if names is not None:
+            if fmt != formats.JSON and "format" in request.args:
+                raise ValueError("format is only supported for a single source")
+            if len([n for n in names if n not in sources]) > 0:
+                code=400
+                return "Invalid source", code
+            forecast = fanout.get_forecast(sources, names, latitude, longitude, args, selected)
+            with stages.timed("fanout", "serialize"):
+                body = json.dumps(forecast)
+            return Response(body, mimetype='text/json'), code
         if source not in sources:
             code=400
             return "Invalid source", code
-        forecast = sources[source].get_forecast(latitude, longitude, request.args)
-        return Response(json.dumps(forecast), mimetype='text/json'), code
+        forecast = sources[source].get_forecast(latitude, longitude, args)
+        if selected is not None:
+            forecast = forecast.project(selected)
+        # cached bytes, compressed if accepted, 304 if the client already has this forecast
+        code, headers, body = responses.forecast_response(
+            forecast,
+            request.headers.get("If-None-Match"),
+            request.headers.get("Accept-Encoding"),
+            sources[source].cache.ttl,
+            sources[source].get_source(),
+            fmt,
+        )
+        return Response(body, headers=headers), code
+    except ratelimit.RateLimited as rl:
+        # nothing cached to fall back on, fail fast instead of queueing for the upstream budget
+        code=429
+        return Response(str(rl), headers={"Retry-After": ratelimit.retry_after_header(rl)}), code
+    except circuitbreaker.CircuitOpen as co:
+        # source is down and nothing cached to fall back on
+        code=503
+        return Response(str(co), headers={"Retry-After": ratelimit.retry_after_header(co)}), code
     except ValueError as ve:
         code=400
         return ve.args[0], code
@@ -40,16 +89,79 @@ def forecast(latitude, longitude):
         # note including "source" could explode metrics if some bad actor tries a lot of random strings
         # therefore source is not included on this metric
         utility.inc("weatherService_forecast_response", {"code": code})
+        stages.profiler.end(profile)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Service to get weather data from various sources.")
-    parser.add_argument("--config", type=str, help="configuraiton file", default="config.yaml")
+@app.route("/forecast/<latitude>/<longitude>/subscribe")
+def forecast_subscribe(latitude, longitude):
+    # server-sent events: the forecast now, then the hours that change as it is refreshed
+    source = request.args.get('source')
+    code=200
+    try:
+        selected = projection.parse(request.args)
+        if responses.negotiate_format(request.args.get("format"), None) != formats.JSON:
+            raise ValueError("format is not supported for subscriptions")
+        args = projection.upstream(request.args)
+        if source not in sources:
+            code=400
+            return "Invalid source", code
+        topic = subscribe.hub.join(sources[source], latitude, longitude, args)
+        subscriber = subscribe.Subscriber(selected, subscribe.hub.max_queue)
+        try:
+            forecast = sources[source].get_forecast(latitude, longitude, args)
+            topic.add(subscriber, forecast)
+        except Exception as e:
+            subscribe.hub.leave(topic, subscriber)
+            raise e
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(subscribe.stream(topic, subscriber), mimetype=subscribe.CONTENT_TYPE, headers=headers), code
+    except subscribe.Full as f:
+        code=503
+        return str(f), code
+    except ratelimit.RateLimited as rl:
+        code=429
+        return Response(str(rl), headers={"Retry-After": ratelimit.retry_after_header(rl)}), code
+    except circuitbreaker.CircuitOpen as co:
+        code=503
+        return Response(str(co), headers={"Retry-After": ratelimit.retry_after_header(co)}), code
+    except ValueError as ve:
+        code=400
+        return ve.args[0], code
+    finally:
+        utility.inc("weatherService_forecast_subscribe_response", {"code": code})
 
-    args = parser.parse_args()
+@app.route("/debug/profile")
+def debug_profile():
+    # slowest sampled requests and where their time went, only with profiling enabled
+    if not stages.profiler.enabled:
+        return "Not Found", 404
+    return Response(json.dumps(stages.profiler.report()), mimetype='text/json'), 200
 
-    # load config file
-    with open(args.config, 'r') as f:
-        config = yaml.safe_load(f)
+@app.route("/forecast/batch", methods=["POST"])
+def forecast_batch():
+    code=200
+    try:
+        coordinates, names, parameters = batch.parse_request(request.get_data(), sources)
+        # streamed as each forecast completes
+        return Response(batch.run(sources, coordinates, names, parameters), mimetype='application/x-ndjson'), code
+    except ValueError as ve:
+        code=400
+        return ve.args[0], code
+    finally:
+        utility.inc("weatherService_forecast_batch_response", {"code": code})
+
+def setup(loaded_config):
+    global config
+    config = loaded_config
+
+    # shared upstream http client
+    # sections may be absent or, with only comments under them, None
+    httpclient.configure(config.get("http") or {})
+    fanout.configure(config.get("fanout") or {})
+    batch.configure(config.get("batch") or {})
+    stages.configure(config.get("profiling") or {})
+
+    for name in formats.missing():
+        print(f"WARNING: format={name} is unavailable, its package is not installed (see requirements.txt)")
 
     # setup sources
     for source in config["sources"]:
@@ -57,10 +169,38 @@ if __name__ == '__main__':
             sources[source] = openweathermap.OpenWeatherMap()
         elif source == "weathergov":
             sources[source] = weathergov.WeatherGov()
+        if source in sources:
+            sources[source].configure(config)
+
+    # warm restart from the last snapshot of the cache
+    snapshot.configure((config.get("cache") or {}).get("snapshot") or {}, weather.Weather.cache)
+
+    # keeps hot locations warm in the background, started once the server is about to serve
+    prefetch.configure(config.get("prefetch") or {}, sources)
+
+    # forecasts with subscribers are kept refreshed by prefetch
+    subscribe.configure(config.get("subscribe") or {})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Service to get weather data from various sources.")
+    parser.add_argument("--config", type=str, help="configuraiton file", default="config.yaml")
+    parser.add_argument("--check", action="store_true", help="load the config and set up the sources, then exit")
+
+    args = parser.parse_args()
+
+    # load config file
+    with open(args.config, 'r') as f:
+        setup(yaml.safe_load(f))
+
+    if args.check:
+        print(f"{args.config}: ok, sources: {', '.join(sources)}")
+        sys.exit(0)
 
     # Start up the server to expose the metrics.
     utility.metrics(config["metrics"]["port"])
 
+    snapshot.start()
+    prefetch.start()
+
     # start http server to listen for requests
     app.run(host=config["service"]["host"], port=config["service"]["port"])
-
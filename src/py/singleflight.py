@@ -0,0 +1,75 @@
+import asyncio
+from threading import Event, Lock
+
+"""
+Coalesce concurrent calls for the same key into a single call.
+
+The first caller for a key runs the function, every caller that arrives while it is
+in flight waits for and shares its result (or exception).
+"""
+
+class Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.mutex = Lock()
+
+    def do(self, key, fn, *args):
+        # returns (result, shared) where shared is True if the result came from another caller
+        with self.mutex:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args)
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise e
+        finally:
+            # remove before waking waiters so anyone arriving later starts a new call
+            with self.mutex:
+                del self.calls[key]
+            call.done.set()
+
+class AsyncSingleFlight:
+    # same as SingleFlight for coroutines, callers must all be on the same event loop
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn, *args):
+        future = self.calls.get(key)
+        if future is not None:
+            # shield so a cancelled waiter doesn't cancel the call for everyone else
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await fn(*args)
+            future.set_result(result)
+            return result, False
+        except Exception as e:
+            future.set_exception(e)
+            # the leader re-raises, mark retrieved so an unwaited future doesn't log
+            future.exception()
+            raise e
+        finally:
+            del self.calls[key]
+            if not future.done():
+                # the leader was cancelled, waiters see the cancellation
+                future.cancel()
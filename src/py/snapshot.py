@@ -0,0 +1,96 @@
+import sys
+import time
+import atexit
+import signal
+from threading import Thread, Event
+
+import utility
+
+"""
+Warm restarts: the forecast cache is written to a snapshot file every interval and on shutdown,
+and read back at startup so the first requests after a deploy are served from cache instead of
+all going upstream at once. See ForecastCache.save/restore.
+
+    cache:
+      snapshot:
+        path: "weather-service-cache.snapshot"
+        interval: 300
+
+Metrics:
+    weatherService_cache_snapshot_entries
+    weatherService_cache_snapshot_seconds
+"""
+
+DEFAULT_INTERVAL=300 # seconds
+
+class Snapshotter:
+    def __init__(self, config, cache):
+        self.path = config.get("path")
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.cache = cache
+        self.stopped = Event()
+        self.thread = None
+        self.saved = False
+
+    def restore(self):
+        if self.path is None:
+            return
+        try:
+            count = self.cache.restore(self.path)
+            print(f"Restored {count} cached forecasts from {self.path}")
+        except Exception as e:
+            # a bad snapshot only costs the warm start
+            print(f"Restoring cache snapshot {self.path} failed: {e}")
+
+    def save(self):
+        if self.path is None:
+            return
+        started = time.time()
+        try:
+            count = self.cache.save(self.path)
+        except Exception as e:
+            print(f"Saving cache snapshot {self.path} failed: {e}")
+            return
+        utility.set("weatherService_cache_snapshot_entries", count, {})
+        utility.set("weatherService_cache_snapshot_seconds", time.time() - started, {})
+
+    def start(self):
+        if self.path is None or self.thread is not None:
+            return
+        self.thread = Thread(target=self.__run, name="cache-snapshot", daemon=True)
+        self.thread.start()
+        # on a normal exit, and on SIGTERM when nothing else handles it
+        atexit.register(self.stop)
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            try:
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            except ValueError:
+                # not the main thread, the server running us handles signals
+                pass
+
+    def stop(self):
+        # final snapshot, once
+        self.stopped.set()
+        if not self.saved and self.thread is not None:
+            self.saved = True
+            self.save()
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.save()
+
+snapshotter = None
+
+def configure(config, cache):
+    # restores right away, the snapshot is only decoded per forecast as it is asked for
+    global snapshotter
+    snapshotter = Snapshotter(config, cache)
+    snapshotter.restore()
+
+def start():
+    if snapshotter is not None:
+        snapshotter.start()
+
+def stop():
+    if snapshotter is not None:
+        snapshotter.stop()
@@ -0,0 +1,124 @@
+import time
+import heapq
+import random
+import itertools
+import contextvars
+from threading import Lock
+
+import utility
+
+"""
+Latency of each stage of the forecast pipeline, and an opt-in profiler of the slowest requests.
+
+    points      weather.gov /points call
+    gridpoint   weather.gov gridpoint call
+    onecall     openweathermap onecall call
+    parse       upstream response to a Forecast
+    upstream    the whole fetch from upstream, includes the calls and parse
+    validate    validate_output
+    coalesced   waiting on another request's fetch of the same forecast
+    serialize   forecast to response body, close to 0 once the body is cached
+
+Every stage is a histogram per source. With profiling enabled, a sample of /forecast requests
+record the stages they went through and the slowest N are kept for GET /debug/profile:
+
+    profiling:
+      enabled: true
+      sample_rate: 0.1
+      slowest: 20
+
+Stages of a request are found through a context variable, so they follow the request through
+threads it waits on (fan-out) and on the event loop, not into background refreshes.
+
+Metrics:
+    weatherService_stage_seconds{source,stage}
+"""
+
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+DEFAULT_SAMPLE_RATE=1.0
+DEFAULT_SLOWEST=20
+
+# Profile of the request running in this context, None if it isn't profiled
+current = contextvars.ContextVar("weatherService_profile", default=None)
+
+class Profile:
+    __slots__ = ("request", "started", "elapsed", "stages", "token")
+
+    def __init__(self, request):
+        self.request = request
+        self.started = time.time()
+        self.elapsed = None
+        # (source, stage, seconds) in the order they finished
+        self.stages = []
+        self.token = None
+
+    def to_dict(self):
+        return {
+            "request": self.request,
+            "started": self.started,
+            "seconds": self.elapsed,
+            "stages": [{"source": source, "stage": stage, "seconds": seconds} for source, stage, seconds in self.stages],
+        }
+
+class Profiler:
+    def __init__(self, config):
+        self.enabled = config.get("enabled", False)
+        self.sample_rate = config.get("sample_rate", DEFAULT_SAMPLE_RATE)
+        self.size = config.get("slowest", DEFAULT_SLOWEST)
+        # min-heap of (seconds, sequence, profile), the fastest of the slowest is dropped first
+        self.slowest = []
+        self.sequence = itertools.count()
+        self.mutex = Lock()
+
+    def begin(self, request):
+        # returns the Profile for this request, None if it isn't sampled
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        profile = Profile(request)
+        profile.token = current.set(profile)
+        return profile
+
+    def end(self, profile):
+        if profile is None:
+            return
+        current.reset(profile.token)
+        profile.elapsed = time.time() - profile.started
+        item = (profile.elapsed, next(self.sequence), profile)
+        with self.mutex:
+            if len(self.slowest) < self.size:
+                heapq.heappush(self.slowest, item)
+            elif profile.elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def report(self):
+        with self.mutex:
+            items = sorted(self.slowest, reverse=True)
+        return [profile.to_dict() for _, _, profile in items]
+
+profiler = Profiler({})
+
+def configure(config):
+    global profiler
+    profiler = Profiler(config)
+
+def observe(source, stage, seconds):
+    utility.histogram("weatherService_stage_seconds", {"source": source, "stage": stage}, BUCKETS).observe(seconds)
+    profile = current.get()
+    # background work started by the request (i.e. a stale refresh task) can outlive it
+    if profile is not None and profile.elapsed is None:
+        profile.stages.append((source, stage, seconds))
+
+class timed:
+    # with stages.timed(source, stage): ...
+    def __init__(self, source, stage):
+        self.source = source
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.source, self.stage, time.perf_counter() - self.started)
+        return False
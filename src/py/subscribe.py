@@ -0,0 +1,289 @@
+import json
+import asyncio
+from collections import deque
+from threading import Lock, Condition
+
+import utility
+import prefetch
+import weather
+
+"""
+Push forecast updates to subscribers instead of having them poll /forecast.
+
+    GET /forecast/<lat>/<lon>/subscribe?source=weathergov[&fields=...&start=...&hours=...]
+
+answers with a Server-Sent Events stream. The first event is the current forecast, the same json
+/forecast returns (projection included). After that, each time the cached forecast is replaced
+an update event carries only the hours that changed:
+
+    event: forecast
+    data: {"metadata": {...}, "data": {"<date>": {...}, ...}, "status": {...}}
+
+    event: update
+    data: {"metadata": {...}, "data": {"<date>": {...}}, "removed": ["<date>", ...], "status": {...}}
+
+A refresh that changes no hour sends nothing. A comment line is sent every heartbeat seconds so
+idle connections aren't closed by proxies.
+
+Subscribers to the same forecast (cache key) share a Topic. While it has subscribers the forecast
+is refreshed every interval by prefetch, one upstream fetch whatever the number of subscribers,
+and the cache tells the topic when it is replaced (ForecastCache.listen). The changed hours are
+worked out and serialized once per refresh for each projection, subscribers only get the bytes
+queued. A subscriber more than max_queue events behind is disconnected rather than buffered for,
+EventSource clients reconnect and start over from the current forecast.
+
+    subscribe:
+      interval: 30
+      heartbeat: 15
+      max_queue: 16
+      max_subscribers: 1000
+
+Metrics:
+    weatherService_subscribers
+    weatherService_subscribe_topics
+    weatherService_subscribe_events_total{event}
+    weatherService_subscribe_dropped_total
+    weatherService_forecast_subscribe_response{code}
+"""
+
+DEFAULT_INTERVAL=30 # seconds
+DEFAULT_HEARTBEAT=15 # seconds
+DEFAULT_MAX_QUEUE=16
+DEFAULT_MAX_SUBSCRIBERS=1000
+
+CONTENT_TYPE = "text/event-stream"
+HEARTBEAT = b": heartbeat\n\n"
+
+class Full(Exception):
+    pass
+
+def event(name, data):
+    # one SSE event, data is a json body which never has a newline in it
+    return b"event: " + name.encode() + b"\ndata: " + data + b"\n\n"
+
+def selection(projection):
+    if projection is None:
+        return None, None, None
+    return projection.fields, projection.start, projection.end
+
+def changes(previous, forecast, projection):
+    # update event bytes for the hours of forecast that differ from previous, None if none do
+    fields, start, end = selection(projection)
+    before = dict(previous.hourly.rows(fields, start, end)) if previous is not None else {}
+    changed = {}
+    for date, row in forecast.hourly.rows(fields, start, end):
+        if before.pop(date, None) != row:
+            changed[date] = row
+    if not changed and not before:
+        return None
+    return event("update", json.dumps({
+        "metadata": forecast.metadata,
+        "data": changed,
+        "removed": list(before),
+        "status": forecast.status,
+    }).encode())
+
+def newer(forecast, than):
+    # whether forecast should replace than as a topic's latest, a failure never replaces a success
+    if than is None:
+        return True
+    if forecast is than or forecast.created < than.created:
+        return False
+    return forecast.is_success() or not than.is_success()
+
+class Subscriber:
+    # events queued for one connection, read by the thread serving it
+    def __init__(self, projection, max_queue=DEFAULT_MAX_QUEUE):
+        self.projection = projection
+        self.max_queue = max_queue
+        self.events = deque()
+        self.closed = False
+        self.condition = Condition()
+
+    def deliver(self, data):
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.events) >= self.max_queue:
+                # too far behind, the client reconnects and starts from the current forecast
+                self.closed = True
+                self.events.clear()
+                utility.inc("weatherService_subscribe_dropped_total", {})
+            else:
+                self.events.append(data)
+            self.condition.notify()
+        self.wake()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.wake()
+
+    def wake(self):
+        pass
+
+    def take(self):
+        # called holding the condition: next event, None once closed, b"" if there is none yet
+        if self.closed:
+            return None
+        if self.events:
+            return self.events.popleft()
+        return b""
+
+    def next(self, timeout):
+        # next event, a heartbeat if none came within timeout, None once closed
+        with self.condition:
+            if not self.events and not self.closed:
+                self.condition.wait(timeout)
+            data = self.take()
+        return HEARTBEAT if data == b"" else data
+
+class AsyncSubscriber(Subscriber):
+    # same, read by a coroutine on loop. events are delivered from any thread
+    def __init__(self, projection, loop, max_queue=DEFAULT_MAX_QUEUE):
+        super().__init__(projection, max_queue)
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def wake(self):
+        try:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:
+            # loop closed, nobody is reading
+            pass
+
+    async def next_async(self, timeout):
+        with self.condition:
+            data = self.take()
+            if data == b"":
+                # cleared holding the condition so a delivery from here on sets it again
+                self.ready.clear()
+        if data == b"":
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return HEARTBEAT
+            with self.condition:
+                data = self.take()
+        return HEARTBEAT if data == b"" else data
+
+class Topic:
+    # subscribers to one forecast and the latest of it they were sent
+    def __init__(self, key):
+        self.key = key
+        self.forecast = None
+        self.subscribers = set()
+        # joined, including those still getting their first forecast
+        self.members = 0
+        # prefetch.Target refreshing the forecast, None if prefetch already did
+        self.target = None
+        self.mutex = Lock()
+
+    def add(self, subscriber, forecast):
+        # queues the current forecast for subscriber, which gets every update from then on
+        with self.mutex:
+            if newer(forecast, self.forecast):
+                self.forecast = forecast
+            current = self.forecast
+            if subscriber.projection is not None:
+                current = current.project(subscriber.projection)
+            subscriber.deliver(event("forecast", current.encode()))
+            self.subscribers.add(subscriber)
+        utility.inc("weatherService_subscribe_events_total", {"event": "forecast"})
+
+    def remove(self, subscriber):
+        with self.mutex:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, forecast):
+        if not forecast.is_success():
+            # subscribers keep the last good forecast, as the cache does
+            return
+        with self.mutex:
+            previous = self.forecast
+            if not newer(forecast, previous):
+                return
+            self.forecast = forecast
+            # projection key -> update, worked out once for all subscribers with that projection
+            updates = {}
+            sent = 0
+            for subscriber in self.subscribers:
+                p = subscriber.projection
+                k = p.key if p is not None else None
+                if k not in updates:
+                    updates[k] = changes(previous, forecast, p)
+                if updates[k] is not None:
+                    subscriber.deliver(updates[k])
+                    sent += 1
+        if sent > 0:
+            utility.counter("weatherService_subscribe_events_total", {"event": "update"}).inc(sent)
+
+class Hub:
+    def __init__(self, config):
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.heartbeat = config.get("heartbeat", DEFAULT_HEARTBEAT)
+        self.max_queue = config.get("max_queue", DEFAULT_MAX_QUEUE)
+        self.max_subscribers = config.get("max_subscribers", DEFAULT_MAX_SUBSCRIBERS)
+        # cache key -> Topic
+        self.topics = {}
+        self.members = 0
+        self.mutex = Lock()
+
+    def join(self, source, latitude, longitude, parameters):
+        # the Topic for a forecast, joined before the forecast is fetched so no refresh is missed
+        key = source.cache_key(latitude, longitude, parameters)
+        with self.mutex:
+            if self.members >= self.max_subscribers:
+                raise Full(f"too many subscribers: {self.max_subscribers}")
+            topic = self.topics.get(key)
+            if topic is None:
+                topic = Topic(key)
+                topic.target = prefetch.watch(source, key, self.interval)
+                self.topics[key] = topic
+            topic.members += 1
+            self.members += 1
+            self.__update_metrics()
+        return topic
+
+    def leave(self, topic, subscriber=None):
+        if subscriber is not None:
+            subscriber.close()
+            topic.remove(subscriber)
+        with self.mutex:
+            topic.members -= 1
+            self.members -= 1
+            if topic.members == 0 and self.topics.get(topic.key) is topic:
+                del self.topics[topic.key]
+                prefetch.unwatch(topic.target)
+            self.__update_metrics()
+
+    def changed(self, key, value):
+        # ForecastCache listener, on every set so the common case is a dict miss
+        topic = self.topics.get(key)
+        if topic is not None:
+            topic.publish(value)
+
+    def __update_metrics(self):
+        utility.set("weatherService_subscribers", self.members, {})
+        utility.set("weatherService_subscribe_topics", len(self.topics), {})
+
+hub = None
+
+def configure(config):
+    global hub
+    if hub is not None:
+        weather.Weather.cache.unlisten(hub.changed)
+    hub = Hub(config)
+    weather.Weather.cache.listen(hub.changed)
+
+def stream(topic, subscriber):
+    # SSE bytes for a Flask response, leaves the topic when the client goes away
+    try:
+        while True:
+            data = subscriber.next(hub.heartbeat)
+            if data is None:
+                return
+            yield data
+    finally:
+        hub.leave(topic, subscriber)
@@ -10,10 +10,18 @@ mutex = Lock()
 
 gauges = {}
 counters = {}
+histograms = {}
+# labelled children by (name, label items as passed in), so a hot path resolves its child once
+gaugeChildren = {}
+counterChildren = {}
+histogramChildren = {}
 filesWatched = []
 
 DEBUG = False
 
+# resolved once, it doesn't change while running
+HOST = socket.gethostname().lower()
+
 def sorted_keys(data):
     if data is None or len(data.keys()) == 0:
         return None
@@ -41,10 +49,9 @@ def enrichLabels(labelDict):
         return labelDict
     if "host" in labelDict:
         return labelDict
-    host=socket.gethostname().lower()
     labelDict.update(
         {
-            "host": host,
+            "host": HOST,
         }
     )
 
@@ -125,48 +132,92 @@ def getCounter(name, description, labelDict):
                 counters[name] = counter
     return counter
 
+def getHistogram(name, description, labelDict, buckets):
+    if name in histograms:
+        histogram = histograms[name]
+    else:
+        with mutex:
+            if name in histograms:
+                histogram = histograms[name]
+            else:
+                print("Creating Histogram: {}".format(name))
+                histogram = prometheus_client.Histogram(name, description, labelDict, buckets=buckets)
+                histograms[name] = histogram
+    return histogram
+
+def childKey(name, labelDict):
+    # label values in the order given, a different order only costs another cache entry
+    return (name, tuple(labelDict.items()))
+
+def gauge(name, labelDict):
+    # pre-bound labelled gauge, call .set()/.inc() on it directly
+    key = childKey(name, labelDict)
+    child = gaugeChildren.get(key)
+    if child is None:
+        labels = dict(labelDict)
+        enrichLabels(labels)
+        child = getGauge(name, "", sorted_keys(labels)).labels(*sorted_values(labels))
+        gaugeChildren[key] = child
+    return child
+
+def counter(name, labelDict):
+    # pre-bound labelled counter, call .inc() on it directly
+    key = childKey(name, labelDict)
+    child = counterChildren.get(key)
+    if child is None:
+        labels = dict(labelDict)
+        enrichLabels(labels)
+        child = getCounter(name, "", sorted_keys(labels)).labels(*sorted_values(labels))
+        counterChildren[key] = child
+    return child
+
+def histogram(name, labelDict, buckets=prometheus_client.Histogram.DEFAULT_BUCKETS):
+    # pre-bound labelled histogram, call .observe() on it directly. buckets are fixed by the first call
+    key = childKey(name, labelDict)
+    child = histogramChildren.get(key)
+    if child is None:
+        labels = dict(labelDict)
+        enrichLabels(labels)
+        child = getHistogram(name, "", sorted_keys(labels), buckets).labels(*sorted_values(labels))
+        histogramChildren[key] = child
+    return child
+
+def observe(name, value, labelDict):
+    if DEBUG:
+        debug("utility.observe({}, {}, {})".format(name, value, labelDict))
+    histogram(name, labelDict).observe(value)
+
+def removeGauge(name, labelDict):
+    gaugeChildren.pop(childKey(name, labelDict), None)
+    labels = dict(labelDict)
+    enrichLabels(labels)
+    getGauge(name, "", sorted_keys(labels)).remove(*sorted_values(labels))
+
 def set(name, value, labelDict):
-    enrichLabels(labelDict)
-    gauge = getGauge(name, "", sorted_keys(labelDict))
-    debug("utility.set({}, {}, {})".format(name, value, labelDict))
-    if len(labelDict.keys()) > 0:
-        if value is not None:
-            gauge.labels(*sorted_values(labelDict)).set(value)
-        else:
-            gauge.remove(*sorted_values(labelDict))
+    if DEBUG:
+        debug("utility.set({}, {}, {})".format(name, value, labelDict))
+    if value is not None:
+        gauge(name, labelDict).set(value)
     else:
-        # cannot clear value if there is no label, just let the error propogate up
-        gauge.set(value)
+        removeGauge(name, labelDict)
 
 def add(name, value, labelDict):
-    enrichLabels(labelDict)
-    gauge = getGauge(name, "", sorted_keys(labelDict))
-    debug("utility.add({}, {}, {})".format(name, value, labelDict))
-    if len(labelDict.keys()) > 0:
-        if value is not None:
-            gauge.labels(*sorted_values(labelDict)).inc(value)
-        else:
-            gauge.remove(*sorted_values(labelDict))
+    if DEBUG:
+        debug("utility.add({}, {}, {})".format(name, value, labelDict))
+    if value is not None:
+        gauge(name, labelDict).inc(value)
     else:
-        gauge.inc(value)
+        removeGauge(name, labelDict)
 
 def inc(name, labelDict):
-    enrichLabels(labelDict)
-    counter = getCounter(name, "", sorted_keys(labelDict))
-    debug("utility.inc({}, {})".format(name, labelDict))
-    if len(labelDict.keys()) > 0:
-        counter.labels(*sorted_values(labelDict)).inc()
-    else:
-        counter.inc()
+    if DEBUG:
+        debug("utility.inc({}, {})".format(name, labelDict))
+    counter(name, labelDict).inc()
 
 def dec(name, labelDict):
-    enrichLabels(labelDict)
-    counter = getCounter(name, "", sorted_keys(labelDict))
-    debug("utility.dec({}, {})".format(name, labelDict))
-    if len(labelDict.keys()) > 0:
-        counter.labels(*sorted_values(labelDict)).dec()
-    else:
-        counter.dec()
+    if DEBUG:
+        debug("utility.dec({}, {})".format(name, labelDict))
+    counter(name, labelDict).dec()
 
 def metrics(port):
     prometheus_client.start_http_server(port)
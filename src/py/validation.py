@@ -0,0 +1,93 @@
+from forecast import Forecast
+
+"""
+Forecast output validation, built once from a declared schema.
+
+The schema lists the top level sections, the fields an hour may have, the fields it must have and
+the attributes a field may hold. Validator turns the lists into sets so each hour is checked in a
+single pass of set lookups. A Forecast is checked without building its hours: every hour has dt
+and a field only ever holds value/uom, so only the set of columns needs checking.
+
+Validation returns (is_valid, errors).
+"""
+
+SCHEMA = {
+    "sections": [
+        "metadata",
+        "data",
+        "status",
+    ],
+    "fields": [
+        "dt",
+        "temperature",
+        "apparentTemperature",
+        "dewpoint",
+        "relativeHumidity",
+        "skyCover",
+        "windDirection",
+        "windSpeed",
+        "windGust",
+        "probabilityOfPrecipitation",
+        "quantitativePrecipitation",
+        "pressure",
+        "visibility",
+        "weather",
+    ],
+    "required": [
+        "dt",
+    ],
+    "attributes": [
+        "value",
+        "uom",
+    ],
+}
+
+class Validator:
+    def __init__(self, schema):
+        self.sections = list(schema["sections"])
+        self.fields = frozenset(schema["fields"])
+        self.required = list(schema["required"])
+        self.attributes = frozenset(schema["attributes"])
+
+    def validate(self, output):
+        if isinstance(output, Forecast):
+            return self.validate_forecast(output)
+
+        errors = []
+        for section in self.sections:
+            if section not in output:
+                errors.append(f"missing {section}")
+
+        fields = self.fields
+        attributes = self.attributes
+        for hour in output.get("data", {}).values():
+            for key, value in hour.items():
+                if key not in fields:
+                    errors.append(f"unexpected key: data.DATE.{key}")
+                    continue
+                if isinstance(value, dict) and not value.keys() <= attributes:
+                    # first unexpected attribute only
+                    for key2 in value:
+                        if key2 not in attributes:
+                            errors.append(f"unexpected key: data.DATE.{key}.{key2}")
+                            break
+            for key in self.required:
+                if key not in hour:
+                    errors.append(f"missing required key: data.DATE.{key}")
+
+        return len(errors) == 0, errors
+
+    def validate_forecast(self, forecast):
+        errors = []
+        for section in self.sections:
+            if section == "data":
+                continue
+            if getattr(forecast, section) is None:
+                errors.append(f"missing {section}")
+        if len(forecast.hourly) > 0:
+            for key in forecast.hourly.fields():
+                if key not in self.fields:
+                    errors.append(f"unexpected key: data.DATE.{key}")
+        return len(errors) == 0, errors
+
+validator = Validator(SCHEMA)
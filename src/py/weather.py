@@ -1,10 +1,16 @@
 import json
+import time
 import httpimport
-import datetime
-
-from expiring_lru_cache import lru_cache
 
 import utility
+import singleflight
+import forecastcache
+import httpclient
+import validation
+import ratelimit
+import stages
+import forecast
+from forecast import Forecast, MISSING
 
 """
 Metrics:
@@ -14,22 +20,157 @@ Metrics:
     weatherService_get_forecast_implementation_success_total{source}
     weatherService_get_forecast_implementation_invalid_total{source}
     weatherService_get_forecast_implementation_error_total{source}
+    weatherService_get_forecast_coalesced_total{source}
+    weatherService_forecast_cache_hit_total{source}
+    weatherService_forecast_cache_stale_total{source}
+    weatherService_forecast_cache_miss_total{source}
+    weatherService_forecast_cache_error_total{source}
+    weatherService_forecast_cache_shared_total{source}
+
+Stages timed here (see stages.py): upstream, validate, coalesced and one per upstream url (url_stage)
 """
 
-class Weather:
-    source = ""
+# upstream unit names (wmoUnit: prefix dropped) to the names output, others are output as sent
+UNIT_NAMES = {
+    "degC": "celsius",
+    "C": "celsius",
+    "degF": "fahrenheit",
+    "F": "fahrenheit",
+    "degree_(angle)": "degrees",
+    "km_h-1": "kph",
+    "m": "meters",
+}
+
+def convert_F_to_C(temp_F):
+    return (temp_F-32)/1.8
+
+def convert_Hg_to_millibars(pressure_Hg):
+    return pressure_Hg * 33.864
+
+def convert_fraction_to_percent(fraction):
+    return fraction * 100
+
+# (upstream unit, output unit) -> conversion of a value
+CONVERSIONS = {
+    ("fahrenheit", "celsius"): convert_F_to_C,
+    ("Hg", "millibars"): convert_Hg_to_millibars,
+    ("fraction", "percent"): convert_fraction_to_percent,
+}
+
+def unit_name(uom):
+    # "wmoUnit:degC" -> "celsius"
+    if uom is None:
+        return None
+    uom = uom.split(":")[-1]
+    return UNIT_NAMES.get(uom, uom)
+
+class Mapping:
+    # one output field of a source: the key in an upstream record it is read from (a tuple of keys
+    # for nested dicts), the unit it is output in, the unit upstream sends it in, and a conversion
+    # applied after any unit conversion (i.e. conditions to a description). None is never converted.
+    # an upstream_uom given here is what upstream sends whatever unit it declares, else the
+    # declared unit (if any) decides the conversion
+    __slots__ = ("target", "source", "uom", "upstream_uom", "fixed", "convert")
+
+    def __init__(self, target, source=None, uom=None, upstream_uom=None, convert=None):
+        self.target = target
+        if source is None:
+            source = target
+        self.source = (source,) if isinstance(source, str) else tuple(source)
+        self.uom = uom
+        self.upstream_uom = upstream_uom if upstream_uom is not None else uom
+        self.fixed = upstream_uom is not None
+        self.convert = convert
+
+class Normalizer:
+    # a source's table of Mappings, with the converter for each (field, upstream unit) resolved
+    # once for the source's parser to run
+    def __init__(self, mappings):
+        self.mappings = list(mappings)
+        # output fields in table order, a field mapped from more than one key takes the last present
+        self.fields = list(dict.fromkeys(m.target for m in self.mappings))
+        self.units = {m.target: m.uom for m in self.mappings}
+        self.by_target = {m.target: m for m in self.mappings}
+        # (target, upstream unit) -> (output unit, converter or None)
+        self.converters = {}
+
+    def converter(self, target, upstream_uom=None):
+        # (output unit, function of an upstream value or None) for target, given the unit upstream
+        # says it sent (i.e. "wmoUnit:degF"), else the unit the mapping declares
+        key = (target, upstream_uom)
+        converter = self.converters.get(key)
+        if converter is None:
+            converter = self.__converter(self.by_target[target], upstream_uom)
+            self.converters[key] = converter
+        return converter
+
+    def __converter(self, mapping, upstream_uom):
+        if upstream_uom is None or mapping.fixed:
+            upstream = mapping.upstream_uom
+        else:
+            upstream = unit_name(upstream_uom)
+        uom = mapping.uom
+        steps = []
+        if uom is not None and upstream is not None and upstream != uom:
+            conversion = CONVERSIONS.get((upstream, uom))
+            if conversion is None:
+                # no known conversion, output the value as sent rather than mislabel it
+                uom = upstream
+            else:
+                steps.append(conversion)
+        if mapping.convert is not None:
+            steps.append(mapping.convert)
+        if len(steps) == 0:
+            return uom, None
+        if len(steps) == 1:
+            return uom, steps[0]
+        first, second = steps
+        return uom, lambda value: second(first(value))
 
-    def output_date(self, date, offset_hours):
-        return str(date + datetime.timedelta(hours=offset_hours))
+def normalize_coordinates(latitude, longitude):
+    # coordinates are rounded to 0.01 degree (~1km) for caching, shared with batch deduplication
+    return [
+        "{:.2f}".format(latitude),
+        "{:.2f}".format(longitude),
+    ]
 
-    def convert_F_to_C(self, temp_F):
-        return (temp_F-32)/1.8
+class Weather:
+    source = ""
+    config = {}
+    # shared by all sources, the key includes the source
+    flights = singleflight.SingleFlight()
+    async_flights = singleflight.AsyncSingleFlight()
+    # shared by all sources, the key includes the source. failed fetches never replace a good forecast
+    cache = forecastcache.ForecastCache(
+        usable=lambda forecast: forecast.is_success(),
+        size=lambda forecast: forecast.nbytes(),
+        dumps=forecast.dumps,
+        loads=forecast.loads,
+    )
+    # prefetch.HotSet counting requests per cache key when prefetch is learning, else None
+    hot = None
+    # ratelimit.Limiter for upstream calls, set by the source's configure if it is limited
+    limiter = None
+    # circuitbreaker.CircuitBreaker for upstream calls, set by the source's configure
+    breaker = None
 
-    def convert_Hg_to_millibars(self, pressure_Hg):
-        return pressure_Hg * 33.864
+    def configure(self, config):
+        # full service config, each source picks out what it needs
+        self.config = config
+        self.cache.configure(config.get("cache") or {})
 
     def set_source(self, source):
         self.source = source
+        # metric handles labelled with this source, resolved on first use
+        self.handles = {}
+
+    def counter(self, name):
+        # pre-bound counter for this source so a request only pays for the increment
+        handle = self.handles.get(name)
+        if handle is None:
+            handle = utility.counter(name, {"source": self.get_source()})
+            self.handles[name] = handle
+        return handle
 
     def get_source(self):
         return self.source
@@ -37,110 +178,226 @@ class Weather:
     def get_required_paramters(self):
         return []
 
+    def get_key_parameters(self):
+        # the request parameters that change what upstream returns, all others are ignored by
+        # the source and left out of the cache key so they don't fragment the cache
+        return []
+
+    def http_get(self, url):
+        # all upstream calls go through the shared, pooled client
+        return httpclient.get(url)
+
+    async def http_get_async(self, url):
+        return await httpclient.get_async(url)
+
     def __normalize_coordinates(self, latitude, longitude):
-        return [
-            "{:.2f}".format(latitude),
-            "{:.2f}".format(longitude),
-        ]
+        return normalize_coordinates(latitude, longitude)
     
-    def normalized_uom(self, uom):
-        if uom == "C":
-            return "celsius"
-        elif uom == "m":
-            return "meters"
-        return uom
-
-    def get_forecast(self, latitude, longitude, parameters={}):
+    def __check_parameters(self, parameters):
         for p in self.get_required_paramters():
             if p not in parameters.keys():
                 raise ValueError(f"missing parameter: {p}")
 
-        try:
-            coordinates=self.__normalize_coordinates(float(latitude), float(longitude))
-            forecast = self.__get_forecast_cached(coordinates[0], coordinates[1], parameters)
+    def __record_forecast(self, forecast, prefix):
+        with stages.timed(self.get_source(), "validate"):
             is_valid, _ = self.validate_output(forecast)
-            utility.inc("weatherService_get_forecast_success_total", {"source": self.get_source()})
-            if not is_valid:
-                utility.inc("weatherService_get_forecast_invalid_total", {"source": self.get_source()})
+        self.counter(f"{prefix}_success_total").inc()
+        if not is_valid:
+            self.counter(f"{prefix}_invalid_total").inc()
+
+    def cache_key(self, latitude, longitude, parameters):
+        # (source, latitude, longitude, ((name, value), ...) of the key parameters)
+        coordinates=self.__normalize_coordinates(float(latitude), float(longitude))
+        keyed = tuple((p, parameters.get(p)) for p in sorted(self.get_key_parameters()) if p in parameters)
+        return (self.get_source(), coordinates[0], coordinates[1], keyed)
+
+    def get_forecast(self, latitude, longitude, parameters={}):
+        self.__check_parameters(parameters)
+
+        try:
+            key = self.cache_key(latitude, longitude, parameters)
+            if self.hot is not None:
+                self.hot.record(self, key)
+            # concurrent requests for the same forecast wait on the first one instead of all going upstream
+            started = time.perf_counter()
+            forecast, shared = self.flights.do(key, self.__get_forecast_cached, key)
+            if shared:
+                self.counter("weatherService_get_forecast_coalesced_total").inc()
+                stages.observe(self.get_source(), "coalesced", time.perf_counter() - started)
+            self.__record_forecast(forecast, "weatherService_get_forecast")
             return forecast
         except Exception as e:
             # fail for any reason, make sure we have error metric and re-raise the error
-            utility.inc("weatherService_get_forecast_error_total", {"source": self.get_source()})
+            self.counter("weatherService_get_forecast_error_total").inc()
             raise e
 
-    @lru_cache(expires_after=30) # 30 seconds
-    def __get_forecast_cached(self, latitude, longitude, parameters):
+    async def get_forecast_async(self, latitude, longitude, parameters={}):
+        # same as get_forecast without blocking the event loop on upstream calls
+        self.__check_parameters(parameters)
+
         try:
-            forecast = self.get_forecast_implementation(latitude, longitude, parameters)
-            is_valid, _ = self.validate_output(forecast)
-            utility.inc("weatherService_get_forecast_implementation_success_total", {"source": self.get_source()})
-            if not is_valid:
-                utility.inc("weatherService_get_forecast_implementation_invalid_total", {"source": self.get_source()})
+            key = self.cache_key(latitude, longitude, parameters)
+            if self.hot is not None:
+                self.hot.record(self, key)
+            started = time.perf_counter()
+            forecast, shared = await self.async_flights.do(key, self.__get_forecast_cached_async, key)
+            if shared:
+                self.counter("weatherService_get_forecast_coalesced_total").inc()
+                stages.observe(self.get_source(), "coalesced", time.perf_counter() - started)
+            self.__record_forecast(forecast, "weatherService_get_forecast")
+            return forecast
+        except Exception as e:
+            self.counter("weatherService_get_forecast_error_total").inc()
+            raise e
+
+    def refresh(self, latitude, longitude, parameters={}):
+        # fetch upstream now and replace the cached forecast even if it is still fresh, for prefetch.
+        # refreshes have their own flight: a request for a fresh forecast never waits on one, nor
+        # gets its error. a failed refresh leaves the cached forecast in place and raises to prefetch
+        self.__check_parameters(parameters)
+        key = self.cache_key(latitude, longitude, parameters)
+        _, latitude, longitude, keyed = key
+        (forecast, error), _ = self.flights.do(
+            ("refresh",) + key,
+            self.cache.refresh, key, lambda: self.__get_forecast_uncached(latitude, longitude, dict(keyed), ratelimit.BACKGROUND),
+        )
+        if error is not None:
+            raise error
+        return forecast
+
+    def __get_forecast_cached(self, key):
+        # fresh forecasts are served from cache, stale ones are served while refreshed in the background
+        # the source only sees the parameters in the key
+        _, latitude, longitude, keyed = key
+        # a stale refresh is background work, it yields to requests for the upstream budget
+        forecast, state = self.cache.get(
+            key,
+            lambda: self.__get_forecast_uncached(latitude, longitude, dict(keyed), ratelimit.USER),
+            lambda: self.__get_forecast_uncached(latitude, longitude, dict(keyed), ratelimit.BACKGROUND),
+        )
+        self.counter(f"weatherService_forecast_cache_{state}_total").inc()
+        return forecast
+
+    async def __get_forecast_cached_async(self, key):
+        _, latitude, longitude, keyed = key
+        forecast, state = await self.cache.get_async(
+            key,
+            lambda: self.__get_forecast_uncached_async(latitude, longitude, dict(keyed), ratelimit.USER),
+            lambda: self.__get_forecast_uncached_async(latitude, longitude, dict(keyed), ratelimit.BACKGROUND),
+        )
+        self.counter(f"weatherService_forecast_cache_{state}_total").inc()
+        return forecast
+
+    def __upstream_failed(self, response):
+        # a client error (i.e. 404 outside weather.gov coverage) means upstream is up, only server
+        # errors and throttling count against the circuit
+        code = response.status_code
+        return code >= 500 or code == 429
+
+    def __outcome(self, response, error=None):
+        if self.breaker is None:
+            return
+        if error is not None or self.__upstream_failed(response):
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def __get_forecast_uncached(self, latitude, longitude, parameters, priority):
+        try:
+            with stages.timed(self.get_source(), "upstream"):
+                forecast = self.get_forecast_implementation(latitude, longitude, parameters, priority)
+            self.__record_forecast(forecast, "weatherService_get_forecast_implementation")
             return forecast
         except Exception as e:
             # fail for any reason, make sure we have error metric and re-raise the error
-            utility.inc("weatherService_get_forecast_implementation_error_total", {"source": self.get_source()})
+            self.counter("weatherService_get_forecast_implementation_error_total").inc()
             raise e
 
-    def get_forecast_implementation(self, latitude, longitude, parameters={}):
+    async def __get_forecast_uncached_async(self, latitude, longitude, parameters, priority):
+        try:
+            with stages.timed(self.get_source(), "upstream"):
+                forecast = await self.get_forecast_implementation_async(latitude, longitude, parameters, priority)
+            self.__record_forecast(forecast, "weatherService_get_forecast_implementation")
+            return forecast
+        except Exception as e:
+            self.counter("weatherService_get_forecast_implementation_error_total").inc()
+            raise e
+
+    def fetch_forecast(self, latitude, longitude, parameters={}):
+        # implemented by each source as a generator: yield each url to fetch, the response is
+        # sent back in, and return the forecast. the same generator is driven by both the
+        # blocking and the asyncio implementation so each source is written once.
         pass
 
+    def url_stage(self, url):
+        # stage name an upstream call is timed under, sources with more than one call tell them apart
+        return "http"
+
+    def acquire(self, parameters, priority):
+        # one token per upstream call, raises ratelimit.RateLimited instead of waiting
+        if self.limiter is not None:
+            self.limiter.acquire(parameters, priority)
+
+    def __allow(self, parameters, priority):
+        # just before each upstream call, so what a source answers from its own cache (i.e. a
+        # weather.gov grid cell) is still served while the circuit is open.
+        # raises CircuitOpen right away, the cache serves what it has
+        if self.breaker is not None:
+            self.breaker.allow()
+        try:
+            self.acquire(parameters, priority)
+        except ratelimit.RateLimited as e:
+            # never went upstream, give back a half-open probe
+            if self.breaker is not None:
+                self.breaker.release()
+            raise e
+
+    def get_forecast_implementation(self, latitude, longitude, parameters={}, priority=ratelimit.USER):
+        steps = self.fetch_forecast(latitude, longitude, parameters)
+        if steps is None:
+            return None
+        try:
+            url = next(steps)
+            while True:
+                self.__allow(parameters, priority)
+                try:
+                    with stages.timed(self.get_source(), self.url_stage(url)):
+                        response = self.http_get(url)
+                except Exception as e:
+                    self.__outcome(None, e)
+                    raise e
+                self.__outcome(response)
+                url = steps.send(response)
+        except StopIteration as s:
+            return s.value
+
+    async def get_forecast_implementation_async(self, latitude, longitude, parameters={}, priority=ratelimit.USER):
+        steps = self.fetch_forecast(latitude, longitude, parameters)
+        if steps is None:
+            return None
+        try:
+            url = next(steps)
+            while True:
+                self.__allow(parameters, priority)
+                try:
+                    with stages.timed(self.get_source(), self.url_stage(url)):
+                        response = await self.http_get_async(url)
+                except Exception as e:
+                    self.__outcome(None, e)
+                    raise e
+                self.__outcome(response)
+                url = steps.send(response)
+        except StopIteration as s:
+            return s.value
+
     def pretty_print(self, forecast):
-        print(json.dumps(forecast, indent=2))
+        print(json.dumps(forecast.to_dict(), indent=2))
 
     def validate_output(self, output):
-        is_valid = True
-        errors = []
-        if "metadata" not in output:
-            is_valid = False
-            errors.append("missing metadata")
-        if "data" not in output:
-            is_valid = False
-            errors.append("missing data")
-        if "status" not in output:
-            is_valid = False
-            errors.append("missing status")
-
-        for date in output["data"]:
-            # key is the date, check each hour's data
-            for key in output["data"][date]:
-                if key not in [
-                    "dt",
-                    "temperature",
-                    "apparentTemperature",
-                    "dewpoint",
-                    "relativeHumidity",
-                    "skyCover",
-                    "windDirection",
-                    "windSpeed",
-                    "windGust",
-                    "probabilityOfPrecipitation",
-                    "quantitativePrecipitation",
-                    "pressure",
-                    "visibility",
-                    "weather",
-                ]:
-                    is_valid = False
-                    errors.append(f"unexpected key: data.DATE.{key}")
-                    continue
-                
-                if isinstance(output["data"][date][key], dict):
-                    for key2 in output["data"][date][key]:
-                        if key2 not in [
-                            "value",
-                            "uom",
-                        ]:
-                            is_valid = False
-                            errors.append(f"unexpected key: data.DATE.{key}.{key2}")
-                            break
-
-            # check for required fields
-            for key in [
-                "dt",
-            ]:
-                if key not in output["data"][date]:
-                    is_valid = False
-                    errors.append(f"missing required key: data.DATE.{key}")
-                    continue
-                
-        return is_valid, errors
\ No newline at end of file
+        # returns (is_valid, errors), see validation.py
+        if isinstance(output, Forecast):
+            # a forecast never changes, the verdict is kept with it so cache hits don't re-validate
+            if output.validation is None:
+                output.validation = validation.validator.validate_forecast(output)
+            return output.validation
+        return validation.validator.validate(output)
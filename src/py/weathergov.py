@@ -1,21 +1,119 @@
-import requests
 import datetime
+import email.utils
+import functools
+import time
 import isodate
+from threading import Lock
 
 import weather
+import gridindex
+import forecast
+from forecast import Forecast, Hourly, Column, MISSING
+import utility
+import ratelimit
+import circuitbreaker
+import stages
+
+"""
+Forecasts from weather.gov: a point's grid cell from /points (kept in the grid index, see
+gridindex.py), then the cell's raw gridpoint data. Points in the same cell share the parsed
+data until upstream regenerates it.
+
+Metrics:
+    weatherService_weathergov_cell_cache_hit_total
+    weatherService_weathergov_cell_cache_miss_total
+    weatherService_weathergov_cell_cache_size
+"""
 
 API_BASE="https://api.weather.gov"
 
+def weather_description(conditions):
+    # weather is a list of conditions, i.e. "chance rain showers and light snow"
+    w_value=""
+    for v in conditions:
+        if w_value != "":
+            w_value+="and "
+        if "coverage" in v and v["coverage"] is not None:
+            w_value+=v["coverage"]+" "
+        if "intensity" in v and v["intensity"] is not None:
+            w_value+=v["intensity"]+" "
+        if "weather" in v and v["weather"] is not None:
+            w_value+=v["weather"]+" "
+    return w_value.replace("_", " ").strip()
+
+# the gridpoint properties output, a property's uom from upstream overrides the one declared here
+# except where upstream_uom is given: pressure is always converted from Hg, as it always has been
+MAPPINGS = [
+    weather.Mapping("temperature", uom="celsius"),
+    weather.Mapping("apparentTemperature", uom="celsius"),
+    weather.Mapping("dewpoint", uom="celsius"),
+    weather.Mapping("relativeHumidity", uom="percent"),
+    weather.Mapping("skyCover", uom="percent"),
+    weather.Mapping("windDirection", uom="degrees"),
+    weather.Mapping("windSpeed", uom="kph"),
+    weather.Mapping("windGust", uom="kph"),
+    weather.Mapping("probabilityOfPrecipitation", uom="percent"),
+    weather.Mapping("quantitativePrecipitation", uom="mm"),
+    weather.Mapping("pressure", uom="millibars", upstream_uom="Hg"),
+    weather.Mapping("visibility", uom="meters"),
+    weather.Mapping("weather", convert=weather_description),
+]
+
+NORMALIZER = weather.Normalizer(MAPPINGS)
+
+@functools.lru_cache(maxsize=256)
+def duration_hours(duration):
+    # only a handful of distinct durations show up, parse each once
+    dur=isodate.parse_duration(duration)
+    return int(dur.days * 24 + dur.seconds / 3600)
+
 class WeatherGov(weather.Weather):
     def __init__(self):
         self.set_source("weather.gov")
+        self.api_base = API_BASE
+        self.grid_index = gridindex.GridIndex()
+        # parsed hourly data per grid cell: (office, gridX, gridY) -> (hourly, expires)
+        self.cell_cache = {}
+        self.cell_mutex = Lock()
+        self.cell_update_interval = 60*60
+        self.cell_min_ttl = 30
+        self.cell_max_ttl = 3*60*60
+
+    def configure(self, config):
+        super().configure(config)
+        # a section left with only comments under it loads as None
+        section = config.get("weathergov") or {}
+        self.api_base = section.get("api_base") or API_BASE
+        self.limiter = ratelimit.limiter(self.get_source(), config.get("ratelimit") or {}, "weathergov")
+        self.breaker = circuitbreaker.breaker(self.get_source(), config.get("circuitbreaker") or {}, "weathergov")
+        c = section.get("grid_index") or {}
+        self.grid_index = gridindex.GridIndex(
+            path=c.get("path"),
+            ttl=c.get("ttl_days", gridindex.DEFAULT_TTL / 86400) * 86400,
+            seed=c.get("seed"),
+            save_delay=c.get("save_delay", gridindex.DEFAULT_SAVE_DELAY),
+        )
+        # read now rather than on the first request, which may be on the event loop
+        self.grid_index.load()
+        c = section.get("cell_cache") or {}
+        self.cell_update_interval = c.get("update_interval", self.cell_update_interval)
+        self.cell_min_ttl = c.get("min_ttl", self.cell_min_ttl)
+        self.cell_max_ttl = c.get("max_ttl", self.cell_max_ttl)
 
     def get_required_paramters(self):
         return []
 
-    def get_forecast_implementation(self, latitude, longitude, parameters={}):
+    def get_key_parameters(self):
+        return []
+
+    def url_stage(self, url):
+        if url.startswith(f"{self.api_base}/points/"):
+            return "points"
+        return "gridpoint"
+
+    def fetch_forecast(self, latitude, longitude, parameters={}):
         # note parameters are not used at this time
-        request_url_points = f"{API_BASE}/points/{latitude},{longitude}"
+        request_url_points = f"{self.api_base}/points/{latitude},{longitude}"
 
         output = {
             "metadata": {
@@ -25,28 +123,47 @@ class WeatherGov(weather.Weather):
                 ],
                 "coordinates": [latitude,longitude],
             },
-            "data": {},
             "status": {
                 "success": "true",
                 "requested": str(datetime.datetime.now()),
             },
         }
 
-        # get the grid location
-        response = requests.get(request_url_points)
+        # get the grid location, the index saves a call to /points for any point seen before
+        grid = self.grid_index.get(latitude, longitude)
+        if grid is None:
+            response = yield request_url_points
 
-        if response.status_code != 200:
-            output["status"]["success"] = "false"
-            output["status"]["http_response_code"] = response.status_code
-            output["status"]["http_request_url"] = request_url_points
-            output["status"]["responded"] = str(datetime.datetime.now())
-            print(response.content)
-            return output
+            if response.status_code != 200:
+                output["status"]["success"] = "false"
+                output["status"]["http_response_code"] = response.status_code
+                output["status"]["http_request_url"] = request_url_points
+                output["status"]["responded"] = str(datetime.datetime.now())
+                print(response.content)
+                return Forecast(output["metadata"], output["status"])
+
+            properties = response.json()["properties"]
+            grid = self.grid_index.put(
+                latitude,
+                longitude,
+                properties["gridId"],
+                properties["gridX"],
+                properties["gridY"],
+                properties["forecastGridData"],
+            )
 
         # using raw forecast
-        forecast_grid_data = response.json()["properties"]["forecastGridData"]
+        forecast_grid_data = grid["forecastGridData"]
         output["metadata"]["request_urls"].append(forecast_grid_data)
-        response = requests.get(forecast_grid_data)
+
+        # many points share a grid cell, reuse the parsed data for the cell if it's still current
+        cell = (grid["office"], grid["gridX"], grid["gridY"])
+        hourly = self.__get_cell_cached(cell)
+        if hourly is not None:
+            output["status"]["responded"] = str(datetime.datetime.now())
+            return Forecast(output["metadata"], output["status"], hourly)
+
+        response = yield forecast_grid_data
 
         if response.status_code != 200:
             output["status"]["success"] = "false"
@@ -54,95 +171,103 @@ class WeatherGov(weather.Weather):
             output["status"]["http_request_url"] = forecast_grid_data
             output["status"]["responded"] = str(datetime.datetime.now())
             print(response.content)
-            return output
+            return Forecast(output["metadata"], output["status"])
         else:
-            data = response.json()
-
-            # walk the properties I care about
-            for key in data["properties"]:
-                if key not in [
-                    "temperature",
-                    "apparentTemperature",
-                    "dewpoint",
-                    "relativeHumidity",
-                    "skyCover",
-                    "windDirection",
-                    "windSpeed",
-                    "windGust",
-                    "probabilityOfPrecipitation",
-                    "quantitativePrecipitation",
-                    "pressure",
-                    "visibility",
-                    "weather", # special handling
-                ]:
-                    # it isn't one I care about
-                    continue
-            
-                if "values" not in data["properties"][key]:
-                    # there is no data, skip
-                    continue
-
-                uom=""
-                if "uom" in data["properties"][key]:
-                    uom=data["properties"][key]["uom"].split(":")[1]
-                    if uom == "degree_(angle)":
-                        uom="degrees"
-                    elif uom == "km_h-1":
-                        uom="kph"
-                    elif uom == "degC":
-                        uom="celsius"
-                
-                for v in data["properties"][key]["values"]:
-                    # always has 'validTime' and 'value'
-                    # data for value is usually float, but for key="weather" it is an object
-                    # https://en.wikipedia.org/wiki/ISO_8601#Durations
-                    _validTime, _duration=v["validTime"].split("/")
-                    value=v["value"]
-
-                    # convert pressure to millibars, it comes as Hg
-                    if key == "pressure":
-                        uom="millibars"
-                        value=self.convert_Hg_to_millibars(value)
-
-                    # convert to date
-                    validTime=datetime.datetime.strptime(_validTime, "%Y-%m-%dT%H:%M:%S%z")
-
-                    # convert duration (hours)
-                    dur=isodate.parse_duration(_duration)
-                    duration_h=int(dur.days * 24 + dur.seconds / 3600)
-
-                    for i in range(0, duration_h):
-                        o_key=self.output_date(validTime, i)
-
-                        if o_key not in output["data"]:
-                            # always set "dt"!
-                            dt=datetime.datetime.fromisoformat(o_key.replace("Z", "+00:00")).timestamp()
-                            output["data"][o_key] = {
-                                "dt": dt,
-                            }
-
-                        if key != "weather":
-                            output["data"][o_key][key]={
-                                "value": value,
-                                "uom": self.normalized_uom(uom),
-                            }
-                        else:
-                            w_value=""
-                            # value is an array in the case of "weather"
-                            for v in value:
-                                if w_value != "":
-                                    w_value+="and "
-                                if "coverage" in v and v["coverage"] is not None:
-                                    w_value+=v["coverage"]+" "
-                                if "intensity" in v and v["intensity"] is not None:
-                                    w_value+=v["intensity"]+" "
-                                if "weather" in v and v["weather"] is not None:
-                                    w_value+=v["weather"]+" "
-
-                            w_value = w_value.replace("_", " ")
-                            output["data"][o_key][key]={
-                                "value": w_value.strip()
-                            }
-            
+            with stages.timed(self.get_source(), "parse"):
+                data = response.json()
+                hourly = self.parse_gridpoint(data)
+            self.__set_cell_cached(cell, hourly, self.__cell_expires(response, data))
             output["status"]["responded"] = str(datetime.datetime.now())
-            return output
\ No newline at end of file
+            return Forecast(output["metadata"], output["status"], hourly)
+
+    def __get_cell_cached(self, cell):
+        entry = self.cell_cache.get(cell)
+        if entry is None or entry[1] < time.time():
+            utility.inc("weatherService_weathergov_cell_cache_miss_total", {})
+            return None
+        utility.inc("weatherService_weathergov_cell_cache_hit_total", {})
+        return entry[0]
+
+    def __set_cell_cached(self, cell, hourly, expires):
+        with self.cell_mutex:
+            # drop anything expired so the cache only holds cells in active use
+            now = time.time()
+            for k in [k for k, v in self.cell_cache.items() if v[1] < now]:
+                del self.cell_cache[k]
+            self.cell_cache[cell] = (hourly, expires)
+            utility.set("weatherService_weathergov_cell_cache_size", len(self.cell_cache), {})
+
+    def __cell_expires(self, response, data):
+        # prefer what upstream tells us via the Expires header
+        now = time.time()
+        expires = None
+        if "Expires" in response.headers:
+            try:
+                expires = email.utils.parsedate_to_datetime(response.headers["Expires"]).timestamp()
+            except (TypeError, ValueError):
+                pass
+        # else the grid is regenerated on a regular cadence after updateTime
+        if expires is None and "updateTime" in data["properties"]:
+            try:
+                updated = datetime.datetime.fromisoformat(data["properties"]["updateTime"]).timestamp()
+                expires = updated + self.cell_update_interval
+            except (TypeError, ValueError):
+                pass
+        if expires is None:
+            expires = now + self.cell_min_ttl
+        # an old updateTime shouldn't cause a fetch on every request, nor a bad header cache forever
+        return min(max(expires, now + self.cell_min_ttl), now + self.cell_max_ttl)
+
+    def parse_gridpoint(self, data):
+        # each property is a list of intervals "validTime/duration" with one value. rather than
+        # walking every hour of every interval, build one hourly time axis and fill a column per
+        # property with a slice assignment per interval.
+        # upstream intervals always start on the hour, which is what lets them index the axis.
+        intervals = {}
+        start = None
+        end = None
+        tz = None
+        for key in NORMALIZER.fields:
+            if key not in data["properties"] or "values" not in data["properties"][key]:
+                # there is no data, skip
+                continue
+            parsed = []
+            for v in data["properties"][key]["values"]:
+                # always has 'validTime' and 'value'
+                # https://en.wikipedia.org/wiki/ISO_8601#Durations
+                _validTime, _duration = v["validTime"].split("/")
+                validTime = datetime.datetime.fromisoformat(_validTime)
+                hour = int(validTime.timestamp()) // 3600
+                duration_h = duration_hours(_duration)
+                parsed.append((hour, duration_h, v["value"]))
+                if start is None or hour < start:
+                    start = hour
+                if end is None or hour + duration_h > end:
+                    end = hour + duration_h
+                if tz is None:
+                    tz = validTime.tzinfo
+            intervals[key] = parsed
+
+        if start is None:
+            return forecast.EMPTY
+
+        length = end - start
+        columns = {}
+        units = {}
+        # hours covered by at least one property, only those are output
+        covered = bytearray(length)
+        for key, parsed in intervals.items():
+            # i.e. pressure comes as Hg and is output in millibars
+            units[key], convert = NORMALIZER.converter(key, data["properties"][key].get("uom"))
+            column = [MISSING] * length
+            for hour, duration_h, value in parsed:
+                if convert is not None and value is not None:
+                    value = convert(value)
+                i = hour - start
+                column[i:i+duration_h] = [value] * duration_h
+                covered[i:i+duration_h] = b"\x01" * duration_h
+            columns[key] = Column(column)
+
+        # always set "dt"!
+        dt = Column([float((start + i) * 3600) if covered[i] else MISSING for i in range(length)])
+        return Hourly(dt, columns, units, tz)